@@ -0,0 +1,344 @@
+# This is a script to benchmark the line of therapy algorithm on a synthetic cohort (see rwToT_LoT_synthetic):
+# patients per second, rows per second and peak memory of the main scripts and of the key functions,
+# written to a json file so runs can be compared
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import numpy as np
+import pandas as pd
+import psutil
+
+import rwToT_LoT_line as ln
+import rwToT_LoT_functions as fn
+import rwToT_LoT_read_data as rd
+import rwToT_LoT_synthetic as sy
+import rwToT_LoT_main_parallel as mp
+import rwToT_LoT_process as pc
+
+SCRIPTS = ['rwToT_LoT_main.py', 'rwToT_LoT_main_parallel.py']  #  Scripts run end to end by default
+
+###############################################################################
+### Peak RSS                                                                ###
+### samples the resident memory of a process and all its child processes    ###
+### in a background thread, and keeps the largest total                     ###
+###############################################################################
+
+class PeakRSS:
+    def __init__(self, pid = None, interval = 0.05):
+        self.process = psutil.Process(pid)
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target = self.sample, daemon = True)
+
+    def get_rss(self):
+        rss = 0
+        try:
+            for process in [self.process] + self.process.children(recursive = True):
+                rss = rss + process.memory_info().rss
+        except psutil.Error:  # a process ended while it was sampled
+            pass
+        return rss
+
+    def sample(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, self.get_rss())
+            self.stopped.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = self.get_rss()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.get_rss())
+
+###############################################################################
+### Get result function                                                     ###
+### function builds the result record of one benchmark                      ###
+### Inputs: 1) benchmark name, 2) kind, "function" or "script", 3) status,  ###
+###         4) seconds, 5) number of patients, 6) number of rows, 7) peak   ###
+###         RSS in bytes, 8) error message                                  ###
+### Outputs: dictionary with the result of the benchmark                    ###
+###############################################################################
+
+def get_result(name, kind, status, seconds, npatients, nrows, peak_rss, error = None):
+
+    ok = status == 'ok' and seconds > 0
+
+    ############# RETURN #############
+    return({'name' : name,
+            'kind' : kind,
+            'status' : status,
+            'seconds' : seconds,
+            'patients' : int(npatients),
+            'rows' : int(nrows),
+            'patients_per_sec' : npatients / seconds if ok else None,
+            'rows_per_sec' : nrows / seconds if ok else None,
+            'peak_rss_mb' : peak_rss / 2**20,
+            'error' : error})
+
+###############################################################################
+### Benchmark function function                                             ###
+### function times a function of the algorithm in this process, repeat      ###
+### times, and keeps the fastest time                                       ###
+### Inputs: 1) benchmark name, 2) function without arguments, 3) number of  ###
+###         patients and 4) number of rows the function processes,          ###
+###         5) number of repeats                                            ###
+### Outputs: dictionary with the result of the benchmark (see get_result)   ###
+###############################################################################
+
+def benchmark_function(name, function, npatients, nrows, repeat = 3):
+
+    seconds = []
+    with PeakRSS() as peak:
+        for i in range(repeat):
+            start = time.perf_counter()
+            function()
+            seconds.append(time.perf_counter() - start)
+
+    print(name, "best of", repeat, ":", min(seconds), "seconds", flush = True)
+
+    ############# RETURN #############
+    return(get_result(name, 'function', 'ok', min(seconds), npatients, nrows, peak.peak))
+
+###############################################################################
+### Benchmark script function                                               ###
+### function runs a main script of the algorithm end to end in its own      ###
+### process, in a working directory with the reference files and the       ###
+### synthetic claims, and measures its wall time and the peak RSS of the    ###
+### script and its pool of processes                                        ###
+### Inputs: 1) script file name, 2) script arguments, 3) working directory, ###
+###         4) number of patients, 5) number of rows                        ###
+### Outputs: dictionary with the result of the benchmark (see get_result)   ###
+###############################################################################
+
+def benchmark_script(script, args, workdir, npatients, nrows):
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), script)
+    log_path = os.path.join(workdir, script + '.log')
+
+    start = time.perf_counter()
+    with open(log_path, 'w') as log:
+        process = subprocess.Popen([sys.executable, path] + args, cwd = workdir, stdout = log, stderr = subprocess.STDOUT)
+        with PeakRSS(process.pid) as peak:
+            returncode = process.wait()
+    seconds = time.perf_counter() - start
+
+    error = None
+    if returncode != 0:
+        with open(log_path, 'r') as log:
+            lines = [line.strip() for line in log if line.strip()]
+        error = lines[-1] if lines else "exit code " + str(returncode)
+
+    print(script, "exit code", returncode, ":", seconds, "seconds", flush = True)
+
+    ############# RETURN #############
+    return(get_result(script, 'script', 'ok' if returncode == 0 else 'failed', seconds, npatients, nrows, peak.peak, error))
+
+###############################################################################
+### Benchmark functions function                                            ###
+### function benchmarks the key steps of the algorithm on the claims: the   ###
+### typed ingestion, the cost balanced split into chunks, the sorted        ###
+### patient index, the cycles, the first line of every patient (regimen     ###
+### and line data), the history keys, and the processing of the whole       ###
+### cohort as one chunk                                                     ###
+### Inputs: 1) claims dataframe, 2) indication, 3) number of repeats,       ###
+###         4) number of patients the per patient functions are timed on    ###
+### Outputs: list of benchmark results                                      ###
+###############################################################################
+
+def benchmark_functions(claims, indication, repeat = 3, sample_patients = 1000):
+
+    mp.init_process([indication], process_memo_size = mp.MEMO_SIZE, process_line_engine = mp.LINE_ENGINE)
+    cases = mp.cases[indication]
+    parameters = cases.par_general.loc[0]
+
+    # The claims are prepared as in rwToT_LoT_main_parallel.run_job
+    data = rd.normalize_claims(claims)
+    vocabulary = fn.get_drug_vocabulary(data['MED_NAME'], cases.rules)
+    data['DRUG_CODE'] = fn.encode_drug_names(data['MED_NAME'], vocabulary)
+
+    npatients = data['PATIENT_ID'].nunique()
+    nrows = len(data.index)
+    results = []
+
+    results.append(benchmark_function('rd.normalize_claims', lambda: rd.normalize_claims(claims), npatients, nrows, repeat))
+    results.append(benchmark_function('fn.get_patient_tasks', lambda: fn.get_patient_tasks(data['PATIENT_ID'], mp.nchunks, mp.COST_EXPONENT), npatients, nrows, repeat))
+    results.append(benchmark_function('fn.get_patient_index', lambda: fn.get_patient_index(data), npatients, nrows, repeat))
+
+    patient_index = fn.get_patient_index(data)
+    results.append(benchmark_function('fn.get_cycles', lambda: fn.get_cycles(patient_index['data'], cycle_gap = 4), npatients, nrows, repeat))
+
+    patient_index = pc.prepare_chunk(data)
+
+    # The per patient functions are timed on the first sample_patients patients
+    patients = [fn.get_patient_data(patient_index, i) for i in range(min(sample_patients, len(patient_index['patient_id'])))]
+    sample_rows = sum(len(patient.index) for patient in patients)
+
+    def get_first_lines():
+        for patient in patients:
+            regimen = ln.get_regimen(patient, int(parameters['r_window']), ln.DRUG_COLUMN[mp.line_engine])
+            ln.get_line_data(patient, regimen, int(parameters['l_disgap']), 0, False, int(parameters['r_window']), parameters['drug_switch_ignore'],
+                             parameters['combo_dropped_line_advance'], indication, cases, mp.line_engine, vocabulary)
+
+    results.append(benchmark_function('ln.get_regimen + ln.get_line_data', get_first_lines, len(patients), sample_rows, repeat))
+    results.append(benchmark_function('fn.get_history_key', lambda: [fn.get_history_key(patient) for patient in patients], len(patients), sample_rows, repeat))
+
+    # The whole cohort as one chunk, as a process of the pool would process it
+    def process_cohort():
+        chunk = pc.Input(r_window = int(parameters['r_window']),
+                         l_disgap = int(parameters['l_disgap']),
+                         drug_switch_ignore = parameters['drug_switch_ignore'],
+                         combo_dropped_line_advance = parameters['combo_dropped_line_advance'],
+                         indication = indication,
+                         database = 'Synthetic',
+                         filename = None,
+                         outfile = None,
+                         data = data[['PATIENT_ID', 'MED_START', 'MED_END', 'MED_NAME', 'DRUG_CODE']].copy(),
+                         unique_patients = data['PATIENT_ID'].unique())
+        chunk.vocabulary = vocabulary
+        # Every repeat starts with an empty patient history memo
+        mp.memo = None
+        mp.process_chunk(chunk)
+
+    results.append(benchmark_function('mp.process_chunk', process_cohort, npatients, nrows, repeat))
+
+    ############# RETURN #############
+    return(results)
+
+###############################################################################
+### Benchmark scripts function                                              ###
+### function runs the main scripts end to end on the claims, in a temporary ###
+### working directory with a copy of the reference files, where the claims  ###
+### are the Test database of the indication                                 ###
+### Inputs: 1) claims dataframe, 2) indication, 3) list of scripts         ###
+### Outputs: list of benchmark results                                      ###
+###############################################################################
+
+def benchmark_scripts(claims, indication, scripts = SCRIPTS):
+
+    workdir = tempfile.mkdtemp(prefix = 'lot_benchmark_')
+    results = []
+
+    try:
+        shutil.copytree('reference', os.path.join(workdir, 'reference'))
+        os.makedirs(os.path.join(workdir, 'data', indication, 'Test'))
+        claims.to_csv(os.path.join(workdir, 'data', indication, 'Test', 'example_input.csv'), index = False)
+
+        npatients = claims['PATIENT_ID'].nunique()
+        for script in scripts:
+            results.append(benchmark_script(script, [indication], workdir, npatients, len(claims.index)))
+    finally:
+        shutil.rmtree(workdir)
+
+    ############# RETURN #############
+    return(results)
+
+###############################################################################
+### Compare results function                                                ###
+### function prints the speedup of every benchmark of a run over the same   ###
+### benchmark of a previous run                                             ###
+### Inputs: 1) benchmark report of the previous run, 2) benchmark report    ###
+###         of this run                                                     ###
+### Outputs: None                                                           ###
+###############################################################################
+
+def compare_results(previous, current):
+
+    previous_results = {result['name'] : result for result in previous['results']}
+
+    for result in current['results']:
+        before = previous_results.get(result['name'])
+        if before is None or before['status'] != 'ok' or result['status'] != 'ok':
+            print(result['name'], ": no comparison", flush = True)
+            continue
+        print(result['name'], ":", before['seconds'], "->", result['seconds'], "seconds, speedup", before['seconds'] / result['seconds'],
+              ", peak RSS", before['peak_rss_mb'], "->", result['peak_rss_mb'], "MB", flush = True)
+
+###############################################################################
+### Get environment function                                                ###
+### function describes the machine and software versions of a run, so the  ###
+### results of different runs can be compared                              ###
+### Inputs: None                                                            ###
+### Outputs: dictionary with the environment of the run                     ###
+###############################################################################
+
+def get_environment():
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):  # not a git checkout
+        commit = None
+
+    ############# RETURN #############
+    return({'commit' : commit,
+            'python' : platform.python_version(),
+            'pandas' : pd.__version__,
+            'numpy' : np.__version__,
+            'platform' : platform.platform(),
+            'cpu_count' : os.cpu_count(),
+            'memory_gb' : psutil.virtual_memory().total / 2**30,
+            'date' : time.strftime('%Y-%m-%dT%H:%M:%S')})
+
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Benchmark the line of therapy algorithm on a synthetic cohort")
+    parser.add_argument('indication')
+    parser.add_argument('npatients', type = int)
+    parser.add_argument('--mean-records', type = float, default = 20, help = "mean number of records per patient")
+    parser.add_argument('--distribution', default = 'lognormal', choices = sy.RECORD_DISTRIBUTIONS, help = "distribution of the records per patient")
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--repeat', type = int, default = 3, help = "repeats of every function benchmark, the fastest is kept")
+    parser.add_argument('--sample-patients', type = int, default = 1000, help = "patients the per patient functions are timed on")
+    parser.add_argument('--skip-scripts', action = 'store_true', help = "only benchmark the functions")
+    parser.add_argument('--scripts', nargs = '+', default = SCRIPTS, help = "scripts run end to end, by default " + " ".join(SCRIPTS))
+    parser.add_argument('--output', default = None, help = "json file of the results, by default output/benchmark/benchmark_<INDICATION>_<npatients>.json")
+    parser.add_argument('--compare', default = None, help = "json file of a previous run to compare with")
+    args = parser.parse_args()
+
+    indication = args.indication.upper()
+
+    start = time.perf_counter()
+    claims = sy.generate_claims(indication, args.npatients, args.mean_records, args.distribution, args.seed)
+    print("Generated", len(claims.index), "claims of", args.npatients, "patients in", time.perf_counter() - start, "seconds", flush = True)
+
+    results = benchmark_functions(claims, indication, args.repeat, args.sample_patients)
+    if not args.skip_scripts:
+        results.extend(benchmark_scripts(claims, indication, args.scripts))
+
+    report = {'indication' : indication,
+              'cohort' : {'patients' : args.npatients, 'rows' : len(claims.index), 'mean_records' : args.mean_records,
+                          'distribution' : args.distribution, 'seed' : args.seed},
+              'environment' : get_environment(),
+              'results' : results}
+
+    output = args.output or os.path.join('output', 'benchmark', 'benchmark_' + indication + '_' + str(args.npatients) + '.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok = True)
+    with open(output, 'w') as report_file:
+        json.dump(report, report_file, indent = 2)
+    print("Wrote the benchmark results to", output, flush = True)
+
+    for result in results:
+        print(result['name'], result['status'], "patients/sec", result['patients_per_sec'], "rows/sec", result['rows_per_sec'],
+              "peak RSS MB", result['peak_rss_mb'], result['error'] or '', flush = True)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as previous_file:
+            compare_results(json.load(previous_file), report)
+
+
+if __name__ == '__main__':
+    main()
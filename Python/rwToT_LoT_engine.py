@@ -0,0 +1,123 @@
+# This is a script to run the line of therapy algorithm in process: an engine is built once from the special
+# cases of an indication and the general parameters, and returns output_lot and output_doses as data frames,
+# without reading the claims from or writing the output to files
+
+import numpy as np
+import pandas as pd
+
+import rwToT_LoT_line as ln
+import rwToT_LoT_functions as fn
+import rwToT_LoT_read_param as rp
+import rwToT_LoT_read_data as rd
+import rwToT_LoT_process as pc
+
+###############################################################################
+### Line of therapy engine                                                  ###
+### processes claims held in memory, with the columns PATIENT_ID,           ###
+### MED_START, MED_END and MED_NAME, the same way a process of the pool of  ###
+### rwToT_LoT_main_parallel processes a chunk. The special cases are those  ###
+### of the indication in reference_dir, or an explicit rule pack returned   ###
+### by rwToT_LoT_read_param.cases. The general parameters are those of      ###
+### par_general.csv, unless they are given. The drug vocabulary and the     ###
+### patient history memo are kept from one call to the next                ###
+### Inputs: 1) indication, 2) special cases (rule pack), 3) r_window,       ###
+###         4) l_disgap, 5) drug_switch_ignore,                             ###
+###         6) combo_dropped_line_advance, 7) first pass line scan engine,  ###
+###         8) memo size, 9) date format of text dates (None detects it),   ###
+###         10) reference directory                                         ###
+###############################################################################
+
+class LineOfTherapyEngine:
+    def __init__(self,
+                 indication = None,
+                 cases = None,
+                 r_window = None,
+                 l_disgap = None,
+                 drug_switch_ignore = None,
+                 combo_dropped_line_advance = None,
+                 line_engine = "numpy",
+                 memo_size = 10000,
+                 date_format = None,
+                 reference_dir = 'reference'):
+        if cases is None:
+            if indication is None:
+                raise ValueError("A line of therapy engine needs an indication or its special cases")
+            cases = rp.cases(indication, reference_dir)
+        if line_engine not in ln.DRUG_COLUMN:
+            raise ValueError("Unknown line engine " + str(line_engine) + ", expected one of " + str(list(ln.DRUG_COLUMN)))
+        self.cases = cases
+        self.indication = indication.upper() if indication is not None else cases.indication
+        self.r_window = int(cases.par_general.loc[0, 'r_window']) if r_window is None else r_window
+        self.l_disgap = int(cases.par_general.loc[0, 'l_disgap']) if l_disgap is None else l_disgap
+        self.drug_switch_ignore = bool(cases.par_general.loc[0, 'drug_switch_ignore']) if drug_switch_ignore is None else drug_switch_ignore
+        self.combo_dropped_line_advance = bool(cases.par_general.loc[0, 'combo_dropped_line_advance']) if combo_dropped_line_advance is None else combo_dropped_line_advance
+        self.line_engine = line_engine
+        self.memo_size = memo_size
+        self.date_format = date_format
+        self.vocabulary = None
+        self.memo = None
+
+    def update_vocabulary(self, drug_names):
+        # The vocabulary grows with the drug names of the claims processed. The memo is keyed by drug codes,
+        # so it starts anew whenever the codes change
+        names = pd.unique(drug_names.dropna())
+        if self.vocabulary is not None and np.isin(names, self.vocabulary['names']).all():
+            return
+        if self.vocabulary is not None:
+            names = np.concatenate([self.vocabulary['names'], names])
+        self.vocabulary = fn.get_drug_vocabulary(pd.Series(names, dtype = object), self.cases.rules)
+        self.memo = fn.HistoryMemo(self.memo_size) if self.memo_size > 0 else None
+
+    def prepare(self, df, date_format = None):
+        # Typed claims with drug codes, sorted by patient and split into treatment cycles
+        data = rd.normalize_claims(df, date_format or self.date_format)
+        self.update_vocabulary(data['MED_NAME'])
+        data['DRUG_CODE'] = fn.encode_drug_names(data['MED_NAME'], self.vocabulary)
+        return pc.prepare_chunk(data)
+
+    def process_index(self, patient_index):
+        chunk = pc.Input(r_window = self.r_window,
+                         l_disgap = self.l_disgap,
+                         drug_switch_ignore = self.drug_switch_ignore,
+                         combo_dropped_line_advance = self.combo_dropped_line_advance,
+                         indication = self.indication,
+                         database = None,
+                         filename = None,
+                         outfile = None,
+                         data = patient_index['data'],
+                         unique_patients = patient_index['patient_id'])
+        chunk.vocabulary = self.vocabulary
+        output = fn.OutputAccumulator()
+        pc.process_patients(chunk, patient_index, self.cases, output, self.memo, self.line_engine)
+        return output.to_frames()
+
+    def process_frame(self, df):
+        # output_lot and output_doses of all the patients of the claims
+        return self.process_index(self.prepare(df))
+
+    def process_patient(self, records):
+        # output_lot and output_doses of one patient, from a data frame, a list of records or a dictionary of columns
+        df = pd.DataFrame(records)
+        if 'PATIENT_ID' in df.columns and df['PATIENT_ID'].nunique() > 1:
+            raise ValueError("process_patient() takes the claims of one patient, got " + str(df['PATIENT_ID'].nunique()) + " patients")
+        return self.process_frame(df)
+
+    def iter_lines(self, df, batch_patients = 1000):
+        # Generator of output_lot and output_doses of every batch_patients patients of the claims, in patient order.
+        # The claims are prepared once
+        patient_index = self.prepare(df)
+        for first in range(0, len(patient_index['patient_id']), batch_patients):
+            batch = slice(first, first + batch_patients)
+            yield self.process_index({'data' : patient_index['data'],
+                                      'patient_id' : patient_index['patient_id'][batch],
+                                      'start' : patient_index['start'][batch],
+                                      'stop' : patient_index['stop'][batch]})
+
+    def iter_sql(self, url, query, batch_rows = 100000):
+        # Generator of output_lot and output_doses of every batch of complete patients streamed from a database
+        # (see rwToT_LoT_read_data.read_sql_batches). The date format is detected once, on the first batch
+        date_format = self.date_format
+        for batch in rd.read_sql_batches(url, query, batch_rows):
+            if date_format is None:
+                date_format = rd.detect_date_format(batch['MED_START'])
+            yield self.process_index(self.prepare(batch, date_format))
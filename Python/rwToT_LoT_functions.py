@@ -1,4 +1,6 @@
 import pandas as pd 
+import numpy as np
+from collections import OrderedDict
 from datetime import datetime
 from datetime import timedelta
 
@@ -12,11 +14,14 @@ from datetime import timedelta
 ### a subsidiary of Merck & Co., Inc., Kenilworth, NJ, USA.      ###
 ####################################################################
 
-def check_line_name(regimen, drug_summary, cases, input_r_window, input_drug_switch_ignore):
+def check_line_name(regimen, drug_summary, cases, input_r_window, input_drug_switch_ignore, drug_names = None):
     # Parameters
     switched = False
     original_regimen = regimen
 
+    # Drugs are either given by name, or by integer code when drug_names (the drug vocabulary) is given
+    drug_column = 'MED_NAME' if drug_names is None else 'DRUG_CODE'
+
     # Process data inputs
     drug_summary = drug_summary.sort_values('FIRST_SEEN')
     line_start_date = min(drug_summary['FIRST_SEEN'])
@@ -25,39 +30,38 @@ def check_line_name(regimen, drug_summary, cases, input_r_window, input_drug_swi
 
     if input_drug_switch_ignore:
         # Get max last seen date from ineligible drugs, defined as drugs that don't occur after the 28 day regimen window
-        ineligible_drugs = drug_summary[drug_summary['LAST_SEEN'] <= line_start_date + datetime.timedelta(days = input_r_window)]
-        ineligible_drugs_last_seen = max(ineligible_drugs['LAST_SEEN'])
+        ineligible_drugs = drug_summary[drug_summary['LAST_SEEN'] <= line_start_date + timedelta(days = input_r_window)]
     
         # Get all the eligible drugs min first seen date. Eligible drugs are defined as drugs that occur after the 28 day regimen window
-        eligible_drugs = drug_summary[drug_summary['LAST_SEEN'] > line_start_date + datetime.timedelta(days = input_r_window)]
-        eligible_drugs_first_seen = min(eligible_drugs['FIRST_SEEN'])
+        eligible_drugs = drug_summary[drug_summary['LAST_SEEN'] > line_start_date + timedelta(days = input_r_window)]
         
     else: 
         # Get max last seen date from ineligible drugs
-        ineligible_drugs = drug_summary[drug_summary['MED_NAME'].isin(cases) == False]
-        
-        ineligible_drugs_last_seen = max(ineligible_drugs['LAST_SEEN'])
+        ineligible_drugs = drug_summary[drug_summary[drug_column].isin(cases) == False]
         
         # Get all the eligible drugs min first seen date
-        eligible_drugs = drug_summary[drug_summary["MED_NAME"].isin(cases)]
-        if eligible_drugs.empty:
-            eligible_drugs_first_seen = None
-        else:
-            eligible_drugs_first_seen = min(eligible_drugs['FIRST_SEEN'])
+        eligible_drugs = drug_summary[drug_summary[drug_column].isin(cases)]
 
     if (eligible_drugs.empty == False) and (ineligible_drugs.empty == False):
+        ineligible_drugs_last_seen = max(ineligible_drugs['LAST_SEEN'])
+        eligible_drugs_first_seen = min(eligible_drugs['FIRST_SEEN'])
+
         # If max last seen of an ineligible drug is before the min first seen of an eligible drug, then regimen is switched
         if ineligible_drugs_last_seen <= eligible_drugs_first_seen: 
             switched = True
   
     # If switch happened, then regimen is defined by eligible drugs list, otherwise it is from the original regimen
     if (switched):
-        regimen = eligible_drugs['MED_NAME']
+        regimen = eligible_drugs[drug_column]
         line_start_date = min(eligible_drugs['FIRST_SEEN'])
 
     ## regimen = sapply(regimen, capitalize) -- do we need this line
+    # The drug vocabulary is sorted by name, so sorted drug codes give sorted names
     regimen = sorted(regimen)
-    line_name = ','.join(regimen)
+    if drug_names is None:
+        line_name = ','.join(regimen)
+    else:
+        line_name = ','.join(drug_names[regimen])
   
     return({'line_name':line_name, 'line_start':line_start_date, 'line_switched':switched})
         
@@ -77,7 +81,7 @@ def check_combo_dropped_drugs(drug_summary, line_end_date, line_next_start, line
     dropped_drugs = drug_summary[drug_summary['DROPPED'] == 1] 
     for ind in dropped_drugs.index: 
         line_end_date = min(dropped_drugs['LAST_SEEN'])
-        line_next_start = line_end_date + datetime.timedelta(days = 1) # should I change this back to Elena's?
+        line_next_start = line_end_date + timedelta(days = 1) # should I change this back to Elena's?
         # convert line_end_date to date, add one day, convert back to string
         #line_next_start = (((datetime.strptime(line_end_date, '%Y-%m-%d')).date()) + timedelta(days=1)).strftime('%Y-%m-%d')
         line_end_reason = "Combo drug dropped"
@@ -86,10 +90,41 @@ def check_combo_dropped_drugs(drug_summary, line_end_date, line_next_start, line
 
 
 
+##################################################################################
+### Compile rules function                                                     ###
+### This compiles the special cases tables into hashed lookups once per run,   ###
+### so that the eligibility checks below do not filter dataframes per row      ###
+### Input: special cases for substitutions, additions, maintenance, episode    ###
+### gap and line name                                                          ###
+### Output: dictionary with original drug -> set of substitutes, set of        ###
+### additions, maintenance type -> set of drugs, set of episode gap drugs and  ###
+### set of line name drugs (lower case, as the drug names in the claims)       ###
+##################################################################################
+
+def compile_rules(cases_substitutions, cases_additions, cases_maintenance, cases_episode_gap, cases_line_name):
+
+    # Drug names and maintenance types are compared in upper case, except for line names
+    substitutions = {}
+    for original, substitute in cases_substitutions[['original', 'substitute']].dropna().itertuples(index = False):
+        substitutions.setdefault(str(original).upper(), set()).add(str(substitute).upper())
+
+    maintenance = {}
+    for drug, maintenance_type in cases_maintenance[['drug_name', 'maintenance_type']].dropna().itertuples(index = False):
+        maintenance.setdefault(str(maintenance_type).upper(), set()).add(str(drug).upper())
+
+    return({'substitutions' : {original : frozenset(substitute) for original, substitute in substitutions.items()},
+            'additions' : frozenset(str(drug).upper() for drug in cases_additions['drug_name'].dropna()),
+            'maintenance' : {maintenance_type : frozenset(drug) for maintenance_type, drug in maintenance.items()},
+            'episode_gap' : frozenset(str(drug).upper() for drug in cases_episode_gap['drug_name'].dropna()),
+            'line_name' : frozenset(str(drug).lower() for drug in cases_line_name['treatment'].dropna())})
+
+
+
 ##################################################################################
 ### Is eligible drug substitution function                                     ###
 ### This checks for drug substitutions that do not advance the line of therapy ###
-### Input: drug name, regimen, and list of special cases for substitutions     ###
+### Input: drug name, regimen, and special cases for substitutions             ###
+### (original drug -> set of substitutes, see compile_rules)                   ###
 ### Output: True or False                                                      ###
 ### Python Version Copyright (c) 2020 Elena Samota,                            ###
 ### Merck Sharp & Dohme Corp. a subsidiary of Merck & Co., Inc.,               ###
@@ -99,11 +134,10 @@ def check_combo_dropped_drugs(drug_summary, line_end_date, line_next_start, line
 def is_eligible_drug_substitution (drug_name, regimen, cases_substitutions):
 
     drug_name = drug_name.upper()
-    regimen = [r.upper() for r in regimen]
     
     # If regimen is in cases_substitutions original, then are there any of the corresponding 
     #substitutions containing the drug name? If not, return False
-    return(cases_substitutions[cases_substitutions['original'].isin(regimen)]['substitute'].isin([drug_name]).any())
+    return(any(drug_name in cases_substitutions.get(r.upper(), ()) for r in regimen))
 
 
 
@@ -111,7 +145,7 @@ def is_eligible_drug_substitution (drug_name, regimen, cases_substitutions):
 #############################################################################
 ### Is eligible drug addition function                                    ### 
 ### This checks for drug addition that do not advance the line of therapy ###
-### Input: next drug name,and list of special cases for additions         ###
+### Input: next drug name,and set of special cases for additions          ###
 ### Output: True or False                                                 ###
 ### Python Version Copyright (c) 2020 Sona Zalesakova,                    ###
 ### Merck Sharp & Dohme Corp. a subsidiary of Merck & Co., Inc.,          ###
@@ -126,8 +160,8 @@ def is_eligible_drug_addition(drug_name, cases_additions):
 #############################################################################
 ### Is eligible mono/combo maintenance function                           ### 
 ### This checks to see if the line of therapy is a maintenance therapy    ###
-### Input: regimen, line number, drug group (for combo), and list of      ###
-### special cases for maintenance                                         ###
+### Input: regimen, line number, drug group (for combo), and special      ###
+### cases for maintenance (maintenance type -> set of drugs)              ###
 ### Output: True or False                                                 ###
 ### Python Version Copyright (c) 2020 Sona Zalesakova,                    ###
 ### Merck Sharp & Dohme Corp. a subsidiary of Merck & Co., Inc.,          ###
@@ -135,26 +169,21 @@ def is_eligible_drug_addition(drug_name, cases_additions):
 #############################################################################
 
 def is_eligible_switch_maintenance(regimen, cases_maintenance, line_number): 
-    regimen = [x.upper() for x in regimen]    
-    cases_maintenance = pd.DataFrame(data = cases_maintenance)
-    cases_maintenance = cases_maintenance[cases_maintenance['maintenance_type'] == 'SWITCH']
-    return all(drug in regimen for drug in cases_maintenance['drug_name']) and (line_number == 1)
+    regimen = set(x.upper() for x in regimen)
+    return cases_maintenance.get('SWITCH', frozenset()).issubset(regimen) and (line_number == 1)
 
 
 def is_eligible_continuation_maintenance(regimen, cases_maintenance, line_number, drug_group):  
  
-    regimen = [x.upper() for x in regimen]
-    
-    drug_group = pd.DataFrame(data = drug_group)    
-    drug_group = drug_group.apply(lambda x: x.astype(str).str.upper())    
-    drug_group = drug_group[drug_group['MED_NAME'].isin(regimen)]    
+    regimen_set = set(x.upper() for x in regimen)
     
+    drug_group_name = drug_group['MED_NAME'].astype(str).str.upper()
+    drug_group_dropped = drug_group['DROPPED'].astype(str)
+    in_regimen = drug_group_name.isin(regimen_set)
+    drug_group_name = drug_group_name[in_regimen]
+    drug_group_dropped = drug_group_dropped[in_regimen]
     
-    cases_maintenance = pd.DataFrame(data = cases_maintenance)
-    cases_maintenance = cases_maintenance[cases_maintenance['maintenance_type']=='CONTINUATION']    
-    cases_maintenance_set = set(cases_maintenance['drug_name'])    
-    regimen_set = set(regimen)    
-    intersect = list(regimen_set.intersection(cases_maintenance_set))
+    intersect = regimen_set.intersection(cases_maintenance.get('CONTINUATION', frozenset()))
 
     #make sure we have existence of maintenance therapy drug
     if (len(intersect) == 0):
@@ -165,27 +194,56 @@ def is_eligible_continuation_maintenance(regimen, cases_maintenance, line_number
     # Step 2: Checked that there are at least 1 dropped drug
     # Step 3: Checked that not all the drugs are dropped
     elif (len(intersect) != 0):
-        is_element = drug_group[drug_group['DROPPED'] == '0']
-        is_element = (is_element['MED_NAME'])        
+        is_element = drug_group_name[drug_group_dropped == '0']
         is_element = all(drug in intersect for drug in is_element) 
         #!is.element(FALSE,drug_group$MED_NAME[drug_group$DROPPED==0] %in% intersect)
        
         
-        drug_group_dropped_1 = drug_group[drug_group['DROPPED'] == '1']        
-        drug_group_dropped_1 = drug_group_dropped_1['MED_NAME']       
+        drug_group_dropped_1 = drug_group_name[drug_group_dropped == '1']       
         
 
-        is_maintenance_therapy = is_element and (len(drug_group_dropped_1) >= 1) and (len(drug_group_dropped_1) < len(drug_group['MED_NAME']))       
+        is_maintenance_therapy = is_element and (len(drug_group_dropped_1) >= 1) and (len(drug_group_dropped_1) < len(drug_group_name))       
 
         return(is_maintenance_therapy and (line_number == 0))     
 
 
 
 
+def is_eligible_switch_maintenance_array(regimen, vocabulary, line_number):
+    # Same check on integer drug codes of the drug vocabulary
+    in_regimen = np.zeros(len(vocabulary['names']), dtype = bool)
+    in_regimen[regimen] = True
+    return bool(in_regimen[vocabulary['is_switch_maintenance']].all()) and (line_number == 1)
+
+
+def is_eligible_continuation_maintenance_array(regimen, vocabulary, line_number, drug_group):
+    # Same check on integer drug codes of the drug vocabulary
+    is_continuation = vocabulary['is_continuation_maintenance']
+    intersect = regimen[is_continuation[regimen]]
+
+    #make sure we have existence of maintenance therapy drug
+    if (len(intersect) == 0):
+        return False
+
+    in_regimen = drug_group['DRUG_CODE'].isin(regimen).to_numpy()
+    drug_group_code = drug_group['DRUG_CODE'].to_numpy()[in_regimen]
+    drug_group_dropped = drug_group['DROPPED'].to_numpy()[in_regimen]
+
+    # Undropped drugs in the regimen are continuation maintenance drugs, at least one but not all drugs are dropped
+    is_element = is_continuation[drug_group_code[drug_group_dropped == 0]].all()
+    drug_group_dropped_1 = (drug_group_dropped == 1).sum()
+
+    is_maintenance_therapy = bool(is_element) and (drug_group_dropped_1 >= 1) and (drug_group_dropped_1 < len(drug_group_code))
+
+    return(is_maintenance_therapy and (line_number == 0))
+
+
+
+
 ##############################################################################################
 ### Is excluded from gap function                                                          ###
 ### This checks to see if the drug is eligible to be excluded from the discontinuation gap ###
-### Input: Drug name and list of special cases for exclusions from discontinuation gap     ###
+### Input: Drug name and set of special cases for exclusions from discontinuation gap      ###
 ### Output: True or False                                                                  ###
 ### Python Version Copyright (c) 2020 Michal Hustak,                                       ###
 ### Merck Sharp & Dohme Corp.                                                              ###
@@ -211,6 +269,96 @@ def is_excluded_from_gap(regimen, remaining_drugs, cases_episode_gap):
 
 
 
+###############################################################################
+### Get gap exclusions function                                             ###
+### Answers is_excluded_from_gap for every row of the line at once: row i   ###
+### is excluded when the run of regimen drugs starting at row i contains a  ###
+### drug excluded from the discontinuation gap                              ###
+### Input: per row flags 1) drug is in regimen, 2) drug is excluded from    ###
+###        the discontinuation gap                                          ###
+### Output: array of True or False, one per row                             ###
+###############################################################################
+
+def get_gap_exclusions(in_regimen, is_episode_gap):
+
+    in_regimen = np.asarray(in_regimen, dtype = bool)
+    is_episode_gap = np.asarray(is_episode_gap, dtype = bool) & in_regimen
+
+    # Walk the rows backwards once. Every drug outside the regimen closes a run, 
+    # so run ids only grow, and within a run the running maximum of 
+    # 2 * run id + gap flag is odd as soon as a gap drug has been seen
+    in_regimen_backward = in_regimen[::-1]
+    run_id = np.cumsum(~in_regimen_backward)
+    run_key = 2 * run_id + is_episode_gap[::-1]
+    seen_gap_drug = np.maximum.accumulate(run_key) == 2 * run_id + 1
+
+    ############# RETURN #############
+    return((seen_gap_drug & in_regimen_backward)[::-1])
+
+
+###############################################################################
+### Get drug vocabulary function                                            ###
+### function maps every drug name (in lower case) of the claims and of the  ###
+### special cases to an integer code once per run, and evaluates the        ###
+### special cases once per drug code. Codes follow the alphabetical order   ###
+### of the drug names, so sorting codes sorts names                         ###
+### Inputs: 1) drug names of the claims, 2) compiled special cases          ###
+### Outputs: drug vocabulary: drug names and upper case output names        ###
+###          indexed by code, special case flags indexed by code, and the   ###
+###          substitute codes of every drug with substitutes                ###
+###############################################################################
+
+def get_drug_vocabulary(drug_names, rules):
+
+    rule_names = set(rules['additions']).union(rules['episode_gap'], rules['line_name'], rules['substitutions'])
+    for substitute in rules['substitutions'].values():
+        rule_names.update(substitute)
+    for drug in rules['maintenance'].values():
+        rule_names.update(drug)
+
+    names = pd.Series(list(pd.unique(drug_names.dropna().str.lower())) + [name.lower() for name in rule_names])
+    names = np.sort(names.unique()).astype(object)
+    names_upper = np.array([name.upper() for name in names], dtype = object)
+
+    # substitutes[original code] are the codes of the eligible substitutes of the drug. There are only a
+    # handful of substitutions, so they are kept by original code rather than as a codes by codes matrix
+    code = {name : i for i, name in enumerate(names_upper)}
+    substitutes = {code[original] : np.sort(np.array([code[drug] for drug in substitute], dtype = np.int64))
+                   for original, substitute in rules['substitutions'].items()}
+
+    ############# RETURN #############
+    return({'names' : names,
+            'output_names' : names_upper,
+            'is_addition' : np.isin(names_upper, list(rules['additions'])),
+            'is_episode_gap' : np.isin(names_upper, list(rules['episode_gap'])),
+            'is_line_name' : np.isin(names, list(rules['line_name'])),
+            'is_switch_maintenance' : np.isin(names_upper, list(rules['maintenance'].get('SWITCH', frozenset()))),
+            'is_continuation_maintenance' : np.isin(names_upper, list(rules['maintenance'].get('CONTINUATION', frozenset()))),
+            'substitutes' : substitutes})
+
+
+def get_regimen_flags(regimen, vocabulary):
+
+    # Regimen dependent checks for every drug code of the vocabulary
+    in_regimen = np.zeros(len(vocabulary['names']), dtype = bool)
+    in_regimen[regimen] = True
+    is_substitution = np.zeros(len(vocabulary['names']), dtype = bool)
+    for drug in regimen:
+        substitutes = vocabulary['substitutes'].get(drug)
+        if substitutes is not None:
+            is_substitution[substitutes] = True
+
+    ############# RETURN #############
+    return({'in_regimen' : in_regimen, 'is_substitution' : is_substitution})
+
+
+def encode_drug_names(drug_names, vocabulary):
+
+    ############# RETURN #############
+    return(pd.Categorical(drug_names.str.lower(), categories = vocabulary['names']).codes.astype(np.int64))
+
+
+
 ###############################################################################
 ### Cut to first dose function                                              ###
 ### function snips the main dataframe (line.df) such that the first row     ###
@@ -233,23 +381,149 @@ def snip_dataframe(df, cut_date):
     return({'after' : df_after, 'before' : df_before})
 
 
+###############################################################################
+### Get patient index function                                              ###
+### function sorts the claims dataframe once by patient and drug start date ###
+### and records where each patient's rows start and stop, so that patients  ###
+### can be taken as slices instead of scanning the dataframe per patient    ###
+### Inputs: 1) claims dataframe                                             ###
+### Outputs: 1) sorted claims dataframe, 2) patient ids, 3) start offsets,  ###
+###          4) stop offsets                                                ###
+###############################################################################
+
+def get_patient_index(df):
+
+    # Stable sort keeps the original order of drugs given on the same day
+    df = df.sort_values(['PATIENT_ID', 'MED_START'], kind = 'mergesort').reset_index(drop = True)
+    patient_ids = df['PATIENT_ID'].to_numpy()
+
+    # A new patient starts wherever the patient id differs from the previous row
+    is_first_row = np.ones(len(patient_ids), dtype = bool)
+    is_first_row[1:] = patient_ids[1:] != patient_ids[:-1]
+    starts = np.flatnonzero(is_first_row)
+    stops = np.append(starts[1:], len(patient_ids))[:len(starts)]
+
+    ############# RETURN #############
+    return({'data' : df, 'patient_id' : patient_ids[starts], 'start' : starts, 'stop' : stops})
+
+
+def get_patient_data(patient_index, i):
+
+    start = patient_index['start'][i]
+    stop = patient_index['stop'][i]
+
+    ############# RETURN #############
+    return(patient_index['data'].iloc[start:stop].reset_index(drop = True))
+
+
+###############################################################################
+### Get patient tasks function                                              ###
+### function splits the claims rows into ntasks tasks of whole patients     ###
+### with balanced cost. The cost of a patient is estimated as its number    ###
+### of records to the power cost_exponent, since the line scan grows faster ###
+### than linearly with the records. Every task is a range of patients in    ###
+### patient order, cut where the running cost crosses a multiple of the     ###
+### total cost over ntasks, so the outputs of the tasks concatenated in     ###
+### part order are sorted by patient. The tasks are returned heaviest       ###
+### first, so they can be dispatched in that order                          ###
+### Inputs: 1) PATIENT_ID column of the claims, 2) number of tasks,         ###
+###         3) cost exponent                                                ###
+### Outputs: 1) row positions of every task, 2) estimated cost of every     ###
+###          task, 3) part number (position in patient order) of every task ###
+###############################################################################
+
+def get_patient_tasks(patient_id, ntasks, cost_exponent = 2):
+
+    codes, patients = pd.factorize(patient_id, sort = True)
+    patient_cost = np.bincount(codes, minlength = len(patients)).astype(float) ** cost_exponent
+    ntasks = max(min(ntasks, len(patients)), 1)
+
+    # A patient goes to the task its cost midpoint falls in. Tasks left empty by a very heavy patient are dropped
+    midpoint = np.cumsum(patient_cost) - patient_cost / 2
+    patient_task = np.minimum((midpoint * ntasks / max(patient_cost.sum(), 1)).astype(np.int64), ntasks - 1)
+    tasks, patient_task = np.unique(patient_task, return_inverse = True)
+    ntasks = max(len(tasks), 1)
+    task_cost = np.bincount(patient_task, weights = patient_cost, minlength = ntasks)
+
+    # Group the rows by task, keeping their original order within a task
+    row_task = patient_task[codes]
+    row_order = np.argsort(row_task, kind = 'stable')
+    bounds = np.searchsorted(row_task[row_order], np.arange(ntasks + 1))
+    task_order = np.argsort(-task_cost, kind = 'stable')
+
+    ############# RETURN #############
+    return({'rows' : [row_order[bounds[task]:bounds[task + 1]] for task in task_order],
+            'cost' : task_cost[task_order],
+            'part' : task_order})
+
+
+###############################################################################
+### Get cycles function                                                     ###
+### function assigns treatment cycles to every row of a claims dataframe    ###
+### sorted by patient and drug start date (see get_patient_index).          ###
+### A new cycle starts on the first drug date of a patient and on every     ###
+### drug date that is more than cycle_gap days after the previous one       ###
+### Inputs: 1) sorted claims dataframe, 2) cycle gap (days)                 ###
+### Outputs: claims dataframe with CYCLE, CYCLE_START, CYCLE_END,           ###
+###          CYCLE_REGIMEN, PRIOR_CYCLE_REGIMEN and TWO_CYCLES columns      ###
+###############################################################################
+
+def get_cycles(df, cycle_gap = 4):
+
+    df = df.copy()
+
+    # Flag the rows that open a new cycle and number the cycles within each patient
+    is_new_patient = df['PATIENT_ID'] != df['PATIENT_ID'].shift()
+    is_new_cycle = is_new_patient | ((df['MED_START'] - df['MED_START'].shift()) > timedelta(days = cycle_gap))
+    df['CYCLE'] = is_new_cycle.astype(np.int64).groupby(df['PATIENT_ID'], sort = False).cumsum()
+
+    # Cycle key that is unique across patients
+    cycle_key = is_new_cycle.cumsum()
+    df['CYCLE_START'] = df.groupby(cycle_key)['MED_START'].transform('min')
+    df['CYCLE_END'] = df.groupby(cycle_key)['MED_END'].transform('max')
+
+    # Regimen of each cycle is the sorted list of unique drugs given in the cycle
+    cycle_drugs = pd.DataFrame({'CYCLE_KEY' : cycle_key, 'MED_NAME' : df['MED_NAME']}).drop_duplicates()
+    cycle_drugs = cycle_drugs.sort_values(['CYCLE_KEY', 'MED_NAME'], kind = 'mergesort')
+    cycle_regimen = cycle_drugs.groupby('CYCLE_KEY')['MED_NAME'].agg(', '.join)
+
+    # Regimen of the prior cycle, which does not exist for the first cycle of a patient
+    is_first_cycle = is_new_patient[is_new_cycle].to_numpy()
+    prior_cycle_regimen = cycle_regimen.shift().astype(object)
+    prior_cycle_regimen[is_first_cycle] = None
+
+    # The prior and current cycle regimens are compared character by character, 
+    # the same way the original row by row loop compared the two strings
+    two_cycles = pd.Series([(prior is not None) and (set(current) == set(prior)) 
+                            for current, prior in zip(cycle_regimen, prior_cycle_regimen)], 
+                           index = cycle_regimen.index)
+
+    df['CYCLE_REGIMEN'] = cycle_key.map(cycle_regimen)
+    df['PRIOR_CYCLE_REGIMEN'] = cycle_key.map(prior_cycle_regimen)
+    df['TWO_CYCLES'] = cycle_key.map(two_cycles).astype(bool)
+
+    ############# RETURN #############
+    return(df)
+
+
 ########################################################################
 ### Get Drug summary function                                        ###
 ### function summarizes patient drug dosage information in the line  ###
-### Inputs: 1) claims dataframe, 2) line end date                    ###
+### Inputs: 1) claims dataframe, 2) line end date, 3) drug column    ###
+### (MED_NAME, or DRUG_CODE for integer drug codes)                  ###
 ### Outputs: drug summary dataframe                                  ###
 ### Python Version Copyright (c) 2020 Michal Hustak,                 ###
 ### Merck Sharp & Dohme Corp. a subsidiary of Merck & Co., Inc.,     ###
 ### Kenilworth, NJ, USA.                                             ###
 ########################################################################
 
-def get_drug_summary(df, input_r_window, line_end_date):
+def get_drug_summary(df, input_r_window, line_end_date, drug_column = 'MED_NAME'):
     
     line_df = (df.loc[df['MED_START'] <= line_end_date]).sort_values(by = ['MED_START']).reset_index()
     #drug_summary = line_df.groupby(['MED_NAME']).agg(LAST_SEEN = ('MED_END', 'max'), FIRST_SEEN = ('MED_START', 'min')).reset_index(drop = True)
-    drug_summary_last_seen = line_df.groupby('MED_NAME')['MED_END'].agg([('LAST_SEEN', 'max')]).reset_index()
-    drug_summary_first_seen = line_df.groupby('MED_NAME')['MED_START'].agg([('FIRST_SEEN', 'min')]).reset_index()
-    drug_summary = pd.merge(drug_summary_last_seen, drug_summary_first_seen, how = 'left', left_on = 'MED_NAME', right_on = 'MED_NAME')
+    drug_summary_last_seen = line_df.groupby(drug_column)['MED_END'].agg([('LAST_SEEN', 'max')]).reset_index()
+    drug_summary_first_seen = line_df.groupby(drug_column)['MED_START'].agg([('FIRST_SEEN', 'min')]).reset_index()
+    drug_summary = pd.merge(drug_summary_last_seen, drug_summary_first_seen, how = 'left', left_on = drug_column, right_on = drug_column)
     #drug_summary = drug_summary_0.groupby('MED_NAME')['MED_START'].agg([('FIRST_SEEN', 'max')])
     #drug_summary = line_df.groupby('MED_NAME')['MED_START'].agg([('FIRST_SEEN', 'max')])#.groupby('MED_NAME')['MED_START'].agg([('FIRST_SEEN', 'min')])
     #drug_summary = drug_summary.groupby('MED_NAME')['MED_START'].agg([('FIRST_SEEN', 'min')])
@@ -259,3 +533,174 @@ def get_drug_summary(df, input_r_window, line_end_date):
     drug_summary['PATIENT_ID'] = line_df.loc[0, 'PATIENT_ID']
         
     return(drug_summary)
+
+
+###############################################################################
+### Output accumulator                                                      ###
+### collects the line of therapy and dosage output of many lines in         ###
+### growable columns, and builds the output_lot and output_doses data       ###
+### frames once, instead of concatenating one data frame per line. The      ###
+### data frames have compact types: integer patient ids and line numbers,   ###
+### categorical names, line types, end reasons and cohort, boolean flags    ###
+### and datetime64 dates. They are written out as text by                   ###
+### rwToT_LoT_write_data.write_csv                                          ###
+###############################################################################
+
+LOT_COLUMNS = ['PATIENT_ID', 'LINE_NUMBER', 'LINE_NAME', 'START_DATE', 'END_DATE',
+               'LINE_TYPE', 'IS_MAINTENANCE', 
+               'ADD_EXEMPTION', 'SUB_EXEMPTION', 'GAP_EXEMPTION', 'NAME_EXEMPTION',
+               'LINE_END_REASON', 'ENHANCED_COHORT', 'INDEX_DATE']
+
+LOT_CATEGORIES = ['LINE_NAME', 'LINE_TYPE', 'LINE_END_REASON', 'ENHANCED_COHORT']
+LOT_FLAGS = ['IS_MAINTENANCE', 'ADD_EXEMPTION', 'SUB_EXEMPTION', 'GAP_EXEMPTION', 'NAME_EXEMPTION']
+LOT_DATES = ['START_DATE', 'END_DATE', 'INDEX_DATE']
+
+DOSES_COLUMNS = ['PATIENT_ID', 'MED_START', 'MED_END', 'MED_NAME', 'LINE_NUMBER', 'LINE_NAME']
+
+class OutputAccumulator:
+    def __init__(self):
+        self.lot = {column : [] for column in LOT_COLUMNS}
+        self.doses = {column : [] for column in DOSES_COLUMNS}
+
+    def add_line(self, patient_id, line_data, indication, index_date):
+        self.lot['PATIENT_ID'].append(patient_id)
+        self.lot['LINE_NUMBER'].append(line_data['line_number'])
+        self.lot['LINE_NAME'].append(line_data['line_name'])
+        self.lot['START_DATE'].append(line_data['line_start'])
+        self.lot['END_DATE'].append(line_data['line_end'])
+        self.lot['LINE_TYPE'].append(line_data['line_type'])
+        self.lot['IS_MAINTENANCE'].append(line_data['line_is_maintenance'])
+        self.lot['ADD_EXEMPTION'].append(line_data['line_add_exemption'])
+        self.lot['SUB_EXEMPTION'].append(line_data['line_sub_exemption'])
+        self.lot['GAP_EXEMPTION'].append(line_data['line_gap_exemption'])
+        self.lot['NAME_EXEMPTION'].append(line_data['line_name_exemption'])
+        self.lot['LINE_END_REASON'].append(line_data['line_end_reason'])
+        self.lot['ENHANCED_COHORT'].append(indication)
+        self.lot['INDEX_DATE'].append(index_date)
+
+    def add_doses(self, doses, line_number, line_name, med_names = None):
+        # med_names are the upper case drug names of the doses, if they are already known
+        if med_names is None:
+            med_names = doses['MED_NAME'].str.upper().to_numpy()
+        self.doses['PATIENT_ID'].append(doses['PATIENT_ID'].to_numpy())
+        self.doses['MED_START'].append(doses['MED_START'].to_numpy())
+        self.doses['MED_END'].append(doses['MED_END'].to_numpy())
+        self.doses['MED_NAME'].append(np.asarray(med_names))
+        self.doses['LINE_NUMBER'].append(np.full(len(doses.index), line_number))
+        self.doses['LINE_NAME'].append(np.full(len(doses.index), line_name, dtype = object))
+
+    def to_frames(self):
+        # Patient ids are int64, unless they are not numbers
+        output_lot = pd.DataFrame({'PATIENT_ID' : pd.Series(self.lot['PATIENT_ID'], dtype = None if self.lot['PATIENT_ID'] else np.int64),
+                                   'LINE_NUMBER' : pd.Series(self.lot['LINE_NUMBER'], dtype = np.int64)})
+        for column in LOT_CATEGORIES:
+            output_lot[column] = pd.Categorical(self.lot[column])
+        for column in LOT_FLAGS:
+            # A missing flag is kept missing rather than turned into False
+            flags = pd.array(self.lot[column], dtype = 'boolean')
+            output_lot[column] = flags.to_numpy(dtype = bool) if not flags.isna().any() else flags
+        for column in LOT_DATES:
+            output_lot[column] = pd.to_datetime(pd.Series(self.lot[column], dtype = object)).astype('datetime64[s]')
+        output_lot = output_lot[LOT_COLUMNS]
+
+        doses = {column : np.concatenate(values) if values else [] for column, values in self.doses.items()}
+        output_doses = pd.DataFrame({'PATIENT_ID' : pd.Series(doses['PATIENT_ID'], dtype = None if len(doses['PATIENT_ID']) else np.int64),
+                                     'MED_START' : pd.Series(doses['MED_START'], dtype = 'datetime64[s]'),
+                                     'MED_END' : pd.Series(doses['MED_END'], dtype = 'datetime64[s]'),
+                                     'MED_NAME' : pd.Categorical(doses['MED_NAME']),
+                                     'LINE_NUMBER' : pd.Series(doses['LINE_NUMBER'], dtype = np.int64),
+                                     'LINE_NAME' : pd.Categorical(doses['LINE_NAME'])}, 
+                                    columns = DOSES_COLUMNS)
+
+        ############# RETURN #############
+        return(output_lot, output_doses)
+
+
+###############################################################################
+### Get history key function                                                ###
+### function canonicalizes the claims of one patient (see get_patient_data) ###
+### to their drug codes and their original dates relative to the first      ###
+### drug date, so patients with the same history on shifted dates share a   ###
+### key and get the same lines                                              ###
+### Inputs: 1) claims dataframe of one patient                              ###
+### Outputs: history key (bytes)                                            ###
+###############################################################################
+
+def get_history_key(df):
+
+    start = df['ORIGINAL_MED_START'].to_numpy(dtype = 'datetime64[ns]')
+    end = df['ORIGINAL_MED_END'].to_numpy(dtype = 'datetime64[ns]')
+    history = np.stack([(start - start[0]).astype(np.int64), 
+                        (end - start[0]).astype(np.int64), 
+                        df['DRUG_CODE'].to_numpy(dtype = np.int64)], axis = 1)
+
+    ############# RETURN #############
+    return(history.tobytes())
+
+
+def get_relative_dates(line_data, index_date):
+
+    ############# RETURN #############
+    return({key : (pd.Timestamp(value) - index_date) if isinstance(value, (pd.Timestamp, np.datetime64)) else value 
+            for key, value in line_data.items()})
+
+
+def rebase_dates(line_data, index_date):
+
+    ############# RETURN #############
+    return({key : (index_date + value) if isinstance(value, pd.Timedelta) else value 
+            for key, value in line_data.items()})
+
+
+###############################################################################
+### History memo                                                            ###
+### keeps the lines of the most recently seen patient histories, by history ###
+### key, with their dates relative to the index date and the rows of the    ###
+### doses of each line. The least recently used history is evicted once     ###
+### the memo holds size histories                                           ###
+###############################################################################
+
+class HistoryMemo:
+    def __init__(self, size):
+        self.size = size
+        self.lines = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, history_key):
+        lines = self.lines.get(history_key)
+        if lines is None:
+            self.misses = self.misses + 1
+        else:
+            self.hits = self.hits + 1
+            self.lines.move_to_end(history_key)
+        return lines
+
+    def put(self, history_key, lines):
+        self.lines[history_key] = lines
+        if len(self.lines) > self.size:
+            self.lines.popitem(last = False)
+
+###############################################################################
+### Add parameter columns function                                          ###
+### function adds the general parameters a parameter sweep evaluated the    ###
+### output with as the first columns of the output, so the output of all    ###
+### parameter sets can be kept in one long table                            ###
+### Inputs: 1) output_lot or output_doses dataframe, 2) dictionary of       ###
+###         general parameters (see rwToT_LoT_read_param.parameter_sets)    ###
+### Outputs: dataframe with the parameter columns                           ###
+###############################################################################
+
+SWEEP_COLUMNS = {'R_WINDOW' : 'r_window',
+                 'L_DISGAP' : 'l_disgap',
+                 'DRUG_SWITCH_IGNORE' : 'drug_switch_ignore',
+                 'COMBO_DROPPED_LINE_ADVANCE' : 'combo_dropped_line_advance'}
+
+def add_parameter_columns(df, parameters):
+
+    df = df.copy()
+    for i, column in enumerate(SWEEP_COLUMNS):
+        df.insert(i, column, parameters[SWEEP_COLUMNS[column]])
+
+    ############# RETURN #############
+    return(df)
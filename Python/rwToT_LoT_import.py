@@ -2,6 +2,8 @@
 
 import pandas as pd
 
+import rwToT_LoT_functions as fn
+
 def cases(indication):
 
     class Cases():
@@ -9,16 +11,19 @@ def cases(indication):
 
             # This imports special cases for line name (i.e. If within 28 days 
             # patient switches to EGFR, ALK, PD-1/PD-L1, then regimen is called that)
-            self.line_name = pd.read_csv("./reference/" + indication + "/cases_line_name.csv").applymap(str.lower)
+            self.line_name = pd.read_csv("./reference/" + indication + "/cases_line_name.csv").map(str.lower)
 
             # This imports special cases for drug substitutions/additions that do not advance the line of therapy            
-            self.line_substitutions = pd.read_csv("./reference/" + indication + "/cases_substitutions.csv").applymap(str.upper)
-            self.line_additions = pd.read_csv("./reference/" + indication + "/cases_additions.csv").applymap(str.upper)
+            self.line_substitutions = pd.read_csv("./reference/" + indication + "/cases_substitutions.csv").map(str.upper)
+            self.line_additions = pd.read_csv("./reference/" + indication + "/cases_additions.csv").map(str.upper)
         
             # This imports special cases for drugs eligible to be considered maintenance therapy
-            self.line_maintenance = pd.read_csv("./reference/" + indication + "/cases_maintenance.csv").applymap(str.upper)
+            self.line_maintenance = pd.read_csv("./reference/" + indication + "/cases_maintenance.csv").map(str.upper)
         
             # This imports special cases for drugs that are not affected by an episode gap
-            self.episode_gap = pd.read_csv("./reference/" + indication + "/cases_episode_gap.csv").applymap(str.upper)
+            self.episode_gap = pd.read_csv("./reference/" + indication + "/cases_episode_gap.csv").map(str.upper)
+
+            # Special cases compiled into hashed lookups used by the eligibility checks
+            self.rules = fn.compile_rules(self.line_substitutions, self.line_additions, self.line_maintenance, self.episode_gap, self.line_name)
         
     return(Cases(indication))
@@ -1,10 +1,17 @@
 import datetime
 
+import numpy as np
+import pandas as pd
+
 import rwToT_LoT_functions as fn
+import rwToT_LoT_profile as pr
 #import rwToT_LoT_import as im
 #import rwToT_LoT_read_param as rp
 
-def get_regimen(df, r_window):
+# Column holding the drugs for each line engine
+DRUG_COLUMN = {"pandas" : "MED_NAME", "numpy" : "DRUG_CODE"}
+
+def get_regimen(df, r_window, drug_column = "MED_NAME"):
 
     # Start of line from the first row, which is assumed to be first drug epsiode 
     # (accomplished via cut_to_first_dose function)
@@ -22,7 +29,7 @@ def get_regimen(df, r_window):
     # Take the line start date, then project to regimen defining window, 
     # and get unique list of medications
     tmp_regimen = df[df['MED_START'] <= regimen_end_date] 
-    output_regimen = tmp_regimen['MED_NAME'].unique()
+    output_regimen = tmp_regimen[drug_column].unique()
   
     ############# RETURN #############
     return(output_regimen)
@@ -30,60 +37,31 @@ def get_regimen(df, r_window):
 
 
 ################################################################################################
-### Get Line Data Function                                                                   ###
-### function returns relevant line of therapy information such as line name, line end date,  ###
-### is maintenance therapy, next line start date, line type, and line end reason             ###
-### Inputs: 1) claims dataframe, 2) regimen, 3) discontinuation gap (days), 4) line number   ###
-### Outputs: 1) line name, 2) line end date, 3) next line start date, 4) line type,          ###
-### 5) line end reason, 6) is maintenance therapy                                            ###
-### General Steps:                                                                           ###
-### 1. Check if we hit last row of table - if so then there is no further data to analyze    ###
-### and we stop here, setting end date to be the last date activity                          ###
-### 2. Check if there is a gap between the current drug date for that line. If there is,     ###
-### then we move to the second pass of checks                                                ###
-### 3. Check if the the next drug is a drug not within the regimen. If there is,             ###
-### then we move to the second pass of checks                                                ###
-### 4. Second pass - analyze combo treatment and determine the correct discontinuation date  ###
-### and account for drug introduction                                                        ###
-### 5. Second pass - analyze the discontinuations and account for exceptions                 ###
-### to discontinuations based on medication                                                  ###
-### 6. Second pass- analyze if the treatment is maintenance therapy. If it is,               ###
-### then label it as such and do not advance line number                                     ###
-### 7. Compute final outputs and return it                                                   ###
+### Scan Line Data Functions                                                                 ###
+### First pass of get_line_data: scan the claims row by row until the line ends on the last  ###
+### row, on a discontinuation gap or on a new drug outside the regimen                       ###
+### Inputs: 1) claims dataframe, 2) regimen, 3) discontinuation gap (days), 4) special cases  ###
+### Outputs: 1) line end date, 2) line end reason, 3) next line start date, 4) regimen,       ###
+### 5) adjusted line start, 6) addition, substitution and gap exemption flags                ###
+### scan_line_data works on the dataframe, scan_line_data_array gives the same results       ###
+### working on NumPy arrays of day numbers and integer drug codes (the DRUG_CODE column and   ###
+### regimen are codes of the drug vocabulary, see fn.get_drug_vocabulary)                    ###
 ################################################################################################
 
-def get_line_data(df, 
-                  r_regimen, 
-                  l_disgap, 
-                  l_line_number, 
-                  l_is_next_maintenance, 
-                  input_r_window, 
-                  input_drug_switch_ignore, 
-                  input_combo_dropped_line_advance,
-                  input_indication,
-                  cases):
-    #cases = im.cases(input_indication)
-    #cases = rp.cases(input_indication)
-    cases = cases
+def scan_line_data(df, r_regimen, l_disgap, cases):
 
-    # Set assumptions
-    line_is_maintenance = False
-    if (len(r_regimen) > 1):
-        line_type = "combo"
-    else:
-        line_type = "mono"
-    line_line_number = l_line_number
-    line_line_start = None
     adjusted_line_start = None  # V.S. 10/01/20
     line_end_date_less_than_flag = False
-    line_is_next_maintenance = l_is_next_maintenance
-    
+
     has_eligible_drug_addition = False
     has_eligible_drug_substition = False
     has_gap_exemption = False
-    has_line_name_exemption = False
 
-    ############### First Pass Checks #################
+    # Gap exemption of every row, recomputed only when the regimen changes
+    drug_names_upper = df['MED_NAME'].str.upper()
+    is_episode_gap = drug_names_upper.isin(cases.rules['episode_gap']).to_numpy()
+    gap_exclusions = fn.get_gap_exclusions(drug_names_upper.isin([r.upper() for r in r_regimen]).to_numpy(), is_episode_gap)
+
     # If we hit the last row in the claims database, then stop and return outputs
     if (len(df.index) == 1): 
         line_end_date = df.loc[0, 'MED_END']
@@ -99,10 +77,9 @@ def get_line_data(df,
             current_drug_end = df.loc[i-1, 'MED_END']
             next_drug = df.loc[i, 'MED_NAME']
             next_drug_date = df.loc[i, 'MED_START']
-            remaining_drugs = df.loc[i:(len(df.index)-1), :]
-            has_eligible_drug_addition = fn.is_eligible_drug_addition(next_drug, cases.line_additions)
-            has_eligible_drug_substition = fn.is_eligible_drug_substitution(next_drug, r_regimen, cases.line_substitutions)
-            has_gap_exemption = fn.is_excluded_from_gap(r_regimen, remaining_drugs, list(cases.episode_gap['drug_name']))
+            has_eligible_drug_addition = fn.is_eligible_drug_addition(next_drug, cases.rules['additions'])
+            has_eligible_drug_substition = fn.is_eligible_drug_substitution(next_drug, r_regimen, cases.rules['substitutions'])
+            has_gap_exemption = bool(gap_exclusions[i])
 
             two_cycles = df.loc[i-1, 'TWO_CYCLES']      #  V.S. 2020/10/01 - Cycle check
 
@@ -132,6 +109,7 @@ def get_line_data(df,
             # Line is not advanced because two-cycle rule is not met    
             elif (next_drug in r_regimen) == False and (has_eligible_drug_addition == False) and (has_eligible_drug_substition == False) and two_cycles == False:   # V.S. 2020/10/01
                 r_regimen = df[df['CYCLE']==df.loc[i, 'CYCLE']]['MED_NAME'].unique()                                                                                # V.S. 2020/10/01
+                gap_exclusions = fn.get_gap_exclusions(drug_names_upper.isin([r.upper() for r in r_regimen]).to_numpy(), is_episode_gap)
                 drug_dates = df[df['MED_NAME'].isin(r_regimen)]['MED_START']                                                                                        # V.S. 2020/10/01
                 adjusted_line_start = min(drug_dates)                                                                                                               # V.S. 2020/10/01
                 line_end_date = max(drug_dates)                                                                                                                     # V.S. 2020/10/01
@@ -155,16 +133,205 @@ def get_line_data(df,
                 line_next_start = next_drug_date
 
                 break
+
+    ############# RETURN #############
+    return({'line_end' : line_end_date, 
+            'line_end_reason' : line_end_reason, 
+            'line_next_start' : line_next_start, 
+            'regimen' : r_regimen, 
+            'adjusted_line_start' : adjusted_line_start,
+            'line_add_exemption' : has_eligible_drug_addition,
+            'line_sub_exemption' : has_eligible_drug_substition,
+            'line_gap_exemption' : has_gap_exemption})
+
+
+def scan_line_data_array(df, r_regimen, l_disgap, vocabulary):
+
+    adjusted_line_start = None
+
+    has_eligible_drug_addition = False
+    has_eligible_drug_substition = False
+    has_gap_exemption = False
+
+    # Dates are kept as datetime64 values to be returned, and as day numbers for the gap arithmetic
+    start_values = df['MED_START'].to_numpy(dtype = 'datetime64[ns]')
+    end_values = df['MED_END'].to_numpy(dtype = 'datetime64[ns]')
+    start_days = start_values.astype('datetime64[D]').astype(np.int64)
+    end_days = end_values.astype('datetime64[D]').astype(np.int64)
+    cycles = df['CYCLE'].to_numpy()
+    two_cycles = df['TWO_CYCLES'].to_numpy()
+
+    # Drugs and the regimen are integer codes of the drug vocabulary, where the special cases are looked up
+    drug_codes = df['DRUG_CODE'].to_numpy()
+    is_addition = vocabulary['is_addition']
+    regimen_flags = fn.get_regimen_flags(r_regimen, vocabulary)
+    gap_exclusions = fn.get_gap_exclusions(regimen_flags['in_regimen'][drug_codes], vocabulary['is_episode_gap'][drug_codes])
+
+    n_rows = len(drug_codes)
+
+    # If we hit the last row in the claims database, then stop and return outputs
+    if n_rows == 1:
+        line_end_date = pd.Timestamp(end_values[0])
+        line_end_reason = "Last row hit"
+        line_next_start = None
+    else:
+        for i in range(1, n_rows):
+            next_code = drug_codes[i]
+            next_in_regimen = regimen_flags['in_regimen'][next_code]
+            gap = start_days[i] - end_days[i-1]
+            has_eligible_drug_addition = bool(is_addition[next_code])
+            has_eligible_drug_substition = bool(regimen_flags['is_substitution'][next_code])
+            has_gap_exemption = bool(gap_exclusions[i])
+
+            # If you hit the last row in the scan, then stop and return outputs
+            if (i == n_rows-1) and (next_in_regimen or has_eligible_drug_substition or has_eligible_drug_addition):
+                if (gap > l_disgap) and (has_gap_exemption == False):
+                    line_end_date = pd.Timestamp(end_values[i-1])
+                    line_end_reason = "Passed discontinuation gap"
+                    line_next_start = pd.Timestamp(start_values[i])
+                else:
+                    line_end_date = pd.Timestamp(end_values[i])
+                    line_end_reason = "Last row hit"
+                    line_next_start = None
+                break
+
+            # Check if the gap between the next drug and current drug is wider than the discontinuation gap
+            elif gap > l_disgap:
+                if (has_gap_exemption):
+                    continue
+                line_end_date = pd.Timestamp(end_values[i-1])
+                line_end_reason = "Passed discontinuation gap"
+                line_next_start = pd.Timestamp(start_values[i])
+                break
+
+            # Line is not advanced because two-cycle rule is not met, the regimen becomes the drugs of the next cycle
+            elif (next_in_regimen == False) and (has_eligible_drug_addition == False) and (has_eligible_drug_substition == False) and two_cycles[i-1] == False:
+                r_regimen = pd.unique(drug_codes[cycles == cycles[i]])
+                regimen_flags = fn.get_regimen_flags(r_regimen, vocabulary)
+                gap_exclusions = fn.get_gap_exclusions(regimen_flags['in_regimen'][drug_codes], vocabulary['is_episode_gap'][drug_codes])
+                drug_dates = start_values[regimen_flags['in_regimen'][drug_codes]]
+                adjusted_line_start = pd.Timestamp(drug_dates.min())
+                line_end_date = pd.Timestamp(drug_dates.max())
+                line_end_reason = "New line started with new drugs"
+                line_next_start = pd.Timestamp(start_values[i])
+
+            # Check if the next drug is not part of the regimen
+            elif (next_in_regimen == False) and (has_eligible_drug_addition == False) and (has_eligible_drug_substition == False):
+                same_day_codes = drug_codes[start_days == end_days[i-1]]
+                if regimen_flags['in_regimen'][same_day_codes].all():
+                    line_end_dates = start_values[start_days <= end_days[i-1]]
+                else:
+                    line_end_dates = start_values[start_days < end_days[i-1]]
+
+                line_end_date = pd.Timestamp(line_end_dates.max())
+                line_end_reason = "New line started with new drugs"
+                line_next_start = pd.Timestamp(start_values[i])
+                break
+
+    ############# RETURN #############
+    return({'line_end' : line_end_date, 
+            'line_end_reason' : line_end_reason, 
+            'line_next_start' : line_next_start, 
+            'regimen' : r_regimen, 
+            'adjusted_line_start' : adjusted_line_start,
+            'line_add_exemption' : has_eligible_drug_addition,
+            'line_sub_exemption' : has_eligible_drug_substition,
+            'line_gap_exemption' : has_gap_exemption})
+
+
+
+################################################################################################
+### Get Line Data Function                                                                   ###
+### function returns relevant line of therapy information such as line name, line end date,  ###
+### is maintenance therapy, next line start date, line type, and line end reason             ###
+### Inputs: 1) claims dataframe, 2) regimen, 3) discontinuation gap (days), 4) line number   ###
+### Outputs: 1) line name, 2) line end date, 3) next line start date, 4) line type,          ###
+### 5) line end reason, 6) is maintenance therapy                                            ###
+### General Steps:                                                                           ###
+### 1. Check if we hit last row of table - if so then there is no further data to analyze    ###
+### and we stop here, setting end date to be the last date activity                          ###
+### 2. Check if there is a gap between the current drug date for that line. If there is,     ###
+### then we move to the second pass of checks                                                ###
+### 3. Check if the the next drug is a drug not within the regimen. If there is,             ###
+### then we move to the second pass of checks                                                ###
+### 4. Second pass - analyze combo treatment and determine the correct discontinuation date  ###
+### and account for drug introduction                                                        ###
+### 5. Second pass - analyze the discontinuations and account for exceptions                 ###
+### to discontinuations based on medication                                                  ###
+### 6. Second pass- analyze if the treatment is maintenance therapy. If it is,               ###
+### then label it as such and do not advance line number                                     ###
+### 7. Compute final outputs and return it                                                   ###
+################################################################################################
+
+def get_line_data(df, 
+                  r_regimen, 
+                  l_disgap, 
+                  l_line_number, 
+                  l_is_next_maintenance, 
+                  input_r_window, 
+                  input_drug_switch_ignore, 
+                  input_combo_dropped_line_advance,
+                  input_indication,
+                  cases,
+                  line_engine = "pandas",
+                  vocabulary = None):
+    #cases = im.cases(input_indication)
+    #cases = rp.cases(input_indication)
+    cases = cases
+
+    # Set assumptions
+    line_is_maintenance = False
+    if (len(r_regimen) > 1):
+        line_type = "combo"
+    else:
+        line_type = "mono"
+    line_line_number = l_line_number
+    line_line_start = None
+    line_is_next_maintenance = l_is_next_maintenance
+    
+    has_line_name_exemption = False
+
+    # The numpy engine works on the integer drug codes of the drug vocabulary, 
+    # the pandas engine works on the drug names
+    if line_engine == "pandas":
+        drug_names = None
+        line_name_cases = cases.rules['line_name']
+    elif line_engine == "numpy":
+        if vocabulary is None:
+            raise ValueError("The numpy line engine needs a drug vocabulary")
+        drug_names = vocabulary['names']
+        line_name_cases = np.flatnonzero(vocabulary['is_line_name'])
+    else:
+        raise ValueError("Unknown line engine: " + str(line_engine))
+
+    ############### First Pass Checks #################
+    start_time = pr.start()
+    if line_engine == "pandas":
+        first_pass = scan_line_data(df, r_regimen, l_disgap, cases)
+    else:
+        first_pass = scan_line_data_array(df, r_regimen, l_disgap, vocabulary)
+    r_regimen = first_pass['regimen']
+    adjusted_line_start = first_pass['adjusted_line_start']
+    line_end_date = first_pass['line_end']
+    line_end_reason = first_pass['line_end_reason']
+    line_next_start = first_pass['line_next_start']
+    has_eligible_drug_addition = first_pass['line_add_exemption']
+    has_eligible_drug_substition = first_pass['line_sub_exemption']
+    has_gap_exemption = first_pass['line_gap_exemption']
     # End first pass of checks
+    pr.stop('get_line_data.first_pass', start_time)
   
   
     ################### Second pass on combo treatment to detect supressions and gaps ###################
   
     # Get Drug Summary information
-    line_drug_summary = fn.get_drug_summary(df, input_r_window, line_end_date)
+    start_time = pr.start()
+    summary_start_time = pr.start()
+    line_drug_summary = fn.get_drug_summary(df, input_r_window, line_end_date, DRUG_COLUMN[line_engine])
+    pr.stop('get_drug_summary', summary_start_time)
  
     # Re-compute line name and line start date
-    check_line_name = fn.check_line_name(r_regimen, line_drug_summary, cases.line_name, input_r_window, input_drug_switch_ignore)
+    check_line_name = fn.check_line_name(r_regimen, line_drug_summary, line_name_cases, input_r_window, input_drug_switch_ignore, drug_names)
     line_name = check_line_name['line_name']
     line_line_start = check_line_name['line_start']
     if adjusted_line_start:                                 # V.S. 10/01/2020
@@ -194,13 +361,19 @@ def get_line_data(df,
             line_is_maintenance = True
         
         else:
-            line_is_maintenance = fn.is_eligible_switch_maintenance(r_regimen, cases.line_maintenance, line_line_number)
+            if line_engine == "pandas":
+                line_is_maintenance = fn.is_eligible_switch_maintenance(r_regimen, cases.rules['maintenance'], line_line_number)
+            else:
+                line_is_maintenance = fn.is_eligible_switch_maintenance_array(r_regimen, vocabulary, line_line_number)
         
         line_is_next_maintenance = False
 
     # Check for continuation maintenance therapy within the combo treatment
     elif (line_type == "combo") and (line_line_number == 0):
-        line_is_next_maintenance = fn.is_eligible_continuation_maintenance(r_regimen, cases.line_maintenance, line_line_number, line_drug_summary)
+        if line_engine == "pandas":
+            line_is_next_maintenance = fn.is_eligible_continuation_maintenance(r_regimen, cases.rules['maintenance'], line_line_number, line_drug_summary)
+        else:
+            line_is_next_maintenance = fn.is_eligible_continuation_maintenance_array(r_regimen, vocabulary, line_line_number, line_drug_summary)
     
         # If the line is eligible for maintenance and is combo, then split it
         if line_is_next_maintenance:
@@ -212,6 +385,7 @@ def get_line_data(df,
     ########### Compute remaining final outputs ############
     if (line_is_maintenance == False) or (line_line_number == 0):
         line_line_number = line_line_number + 1
+    pr.stop('get_line_data.second_pass', start_time)
 
     ############# RETURN #############
     return({'line_name' : line_name, 
@@ -1,366 +1,531 @@
-from sqlalchemy import create_engine
 import pandas as pd
-import datetime
 import sys 
 import time
 import multiprocessing
 import copy
 import os
+import shutil
 import numpy as np
 import psutil  # to set the NICENESS of the processes
 
-import rwToT_LoT_line as ln
 import rwToT_LoT_functions as fn
+import rwToT_LoT_process as pc
 import rwToT_LoT_read_param as rp
+import rwToT_LoT_read_data as rd
+import rwToT_LoT_write_data as wd
+import rwToT_LoT_shared_data as sd
+import rwToT_LoT_store as st
+import rwToT_LoT_profile as pr
+import rwToT_LoT_progress as pg
 
 nprocesses = (multiprocessing.cpu_count()-1 or 1)
-nchunks = nprocesses
+nchunks = 8 * nprocesses
 
 nprocesses = 1
-nchunks = 1
+nchunks = 8 * nprocesses  #  Every superchunk is split into nchunks cost balanced chunks, more chunks than processes,
+                          #  which are dispatched heaviest first to whichever process is free
+
+COST_EXPONENT = 2  #  The processing cost of a patient is estimated as its number of records to the power COST_EXPONENT
 
 NSUPERCHUNKS = 1  #  The input data is split into N superchunks, and each superchunk then split into nprocesses chunks and processed in parallel
                    #  Each superchunk is processed sequentially and the processing results are appended to the main output data frame
 
+STREAM_BATCH_ROWS = None  #  None loads the whole input file at once.  Otherwise the input file, sorted by PATIENT_ID, is read STREAM_BATCH_ROWS
+                          #  rows at a time, and every batch of complete patients is processed as one superchunk, which bounds the memory used
 
-cases = rp.cases('mcc')  # dummy initialization.  Actual indication will be updated in the main function
-
-
-class Input:
-  def __init__(self,
-               r_window, 
-               l_disgap,
-               drug_switch_ignore,
-               combo_dropped_line_advance,
-               indication,
-               database,
-               filename,
-               outfile,
-               data,
-               unique_patients):
-    self.r_window = r_window
-    self.l_disgap = l_disgap
-    self.drug_switch_ignore = drug_switch_ignore
-    self.combo_dropped_line_advance = combo_dropped_line_advance
-    self.indication = indication
-    self.database = database
-    self.filename = filename
-    self.outfile = outfile
-    self.data = data
-    self.unique_patients = unique_patients
-    self.index_date = pd.to_datetime('2001-01-01')
-    self.last_activity_date = pd.to_datetime('2001-01-01')
-    self.last_enrollment_date = pd.to_datetime('2001-01-01')
-    
-class Patient:
-    def __init__(self):
-        self.data = pd.DataFrame()
-        self.line_number = 0
-        self.line_name = None
-        self.line_type = None
-        self.line_start = None
-        self.line_end = None
-        self.line_next_start = None
-        self.line_end_reason = None
-        self.previous_line = None
-        self.line_is_maintenance = False
-        self.is_next_maintenance = False
-        self.line_add_exemption = None
-        self.line_sub_exemption = None
-        self.line_gap_exemption = None
-        self.line_name_exemption = None
-        self.regimen = list()
-        self.cut = pd.DataFrame()
-
-patient = Patient()
+DATE_FORMAT = None  #  Date format of the claims file, e.g. "%Y-%m-%d" or "%m/%d/%y".  None detects it once per job from the first rows read
+                    #  (see rwToT_LoT_read_data.DATE_FORMATS)
+
+INPUT_FORMAT = "csv"   #  Storage format of the claims file, "csv" or "parquet" (typed schema, requires pyarrow)
+SQL_URL = None         #  Connection url of a database the claims are read from instead of the claims file, e.g. "sqlite:///data/claims.db"
+                       #  (requires sqlalchemy and the driver of the database).  With STREAM_BATCH_ROWS the query result is streamed
+SQL_QUERY = "SELECT PATIENT_ID, MED_START, MED_END, MED_NAME FROM claims ORDER BY PATIENT_ID, MED_START"
+OUTPUT_FORMAT = "csv"  #  Storage format of output_lot and output_doses, "csv" or "parquet" (typed schema, requires pyarrow)
+
+INCREMENTAL = False  #  Reuse the output of the previous run for the patients whose claims haven't changed (see rwToT_LoT_store),
+                     #  as long as the special cases and parameters haven't changed either.  The state is kept in store/<INDICATION>/<outfile>/
+
+MEMO_SIZE = 10000  #  Lines of patients with the same history relative to their index date are computed once per process and reused.
+                   #  MEMO_SIZE is the number of most recently used histories kept in memory, 0 turns the memo off
+
+LINE_ENGINE = "numpy"  #  First pass line scan engine: "numpy" scans arrays of day numbers and drug codes, "pandas" scans the dataframe row by row
+
+PROFILE = False  #  Time the stages of the run (load, date parsing, partitioning, cycles, regimen, line data passes, output, write) in every process,
+                 #  and write run_report.json and run_report.csv next to the output.  Turned off, the stage timers return at once
+
+PROGRESS_INTERVAL = 10  #  Seconds between two progress events of a process, and between two progress lines of the parent with the patients and
+                        #  rows done, the throughput and the ETA of the job.  None turns the progress events off
+PROGRESS_FILE = False   #  Also write the last progress line to progress.json next to the output
+
+
+cases = {}  # special cases of every indication of the run, by indication, loaded once per process by init_process
 
+memo = None  # patient history memo of the process, kept across chunks with the same indication, parameters and drug vocabulary
+memo_context = None
+
+memo_size = 0          # size of the patient history memo and first pass line scan engine of the process, passed by the parent
+line_engine = "numpy"  # to init_process, since a spawned process doesn't see the values the parent set
+
+
+
+def init_process(indications, profile = False, progress_queue = None, progress_interval = None, process_memo_size = 0, process_line_engine = "numpy"):
+
+    # Pool initializer: every process loads the special cases of all indications once and keeps them for all its chunks,
+    # and takes the settings of the run from the parent
+    global memo_size, line_engine
+    memo_size = process_memo_size
+    line_engine = process_line_engine
+    if profile:
+        pr.enable()
+    pg.set_queue(progress_queue, progress_interval)
+    for indication in indications:
+        cases[indication.upper()] = rp.cases(indication)
+    print("Process", os.getpid(), "loaded the special cases for", list(cases), flush = True)
 
 
 def process_chunk(chunk_patients):    # equivalent of just_wait_and_print_len_and_idx(df)
 
-    patient = Patient()
-    
-    output_lot = pd.DataFrame()
-    output_doses = pd.DataFrame()
-    
-    
-    print("Processing chunk")
-    print("Process id ", os.getpid())
-    print("Data frame dimensions: ", chunk_patients.data.shape, flush = True)
-
-    for i in range(len(chunk_patients.unique_patients)):
-        
-        patient.data = chunk_patients.data.query('PATIENT_ID == %s' % chunk_patients.unique_patients[i]).reset_index(drop = True)
-        patient.data = patient.data.sort_values('MED_START').reset_index(drop = True)
-        chunk_patients.index_date = patient.data.loc[0, 'MED_START']
-        chunk_patients.last_activity_date = None # patient.data.loc[0, ['LAST_ACTIVITY_DATE']]
-        chunk_patients.last_enrollment_date = None # patient.data.loc[0, ['LAST_ENROLLMENT_DATE']]
-        # Scan patient claims data to acquire line information on a step-wise line by line basis
-
-        # patient.data is now a dataframe which contains drug administration entries ordered by date
-        # we need to add a column to this indicating the cycle
-        # the cycle should reset with the new line, but here we just increase the cycle number as soon as
-        # it's been more than four days since the last drug administration.  Call this cycle_tmp
-        for entry in patient.data.index:
-            if entry == 0:
-                patient.data.loc[entry, 'CYCLE'] = 1
-                patient.data.loc[entry, 'CYCLE_START'] = patient.data.loc[entry, 'MED_START']
-            else:
-                if patient.data.loc[entry, 'MED_START'] - datetime.timedelta(days = 4) > patient.data.loc[entry - 1, 'MED_START']:
-                    patient.data.loc[entry, 'CYCLE'] = patient.data.loc[entry - 1, 'CYCLE'] + 1
-                else:
-                    patient.data.loc[entry, 'CYCLE'] = patient.data.loc[entry - 1, 'CYCLE']
-        patient.data['CYCLE_START'] = patient.data.groupby('CYCLE')['MED_START'].transform("min")
-        patient.data['CYCLE_END'] = patient.data.groupby('CYCLE')['MED_END'].transform("max")
-        patient.data['CYCLE_REGIMEN'] = patient.data.groupby('CYCLE')['MED_NAME'].transform(lambda x: ', '.join(sorted(x.unique())))
-
-        
-        for entry in patient.data.index:
-            if patient.data.loc[entry, 'CYCLE'] == 1:
-                patient.data.loc[entry, 'PRIOR_CYCLE_REGIMEN'] = None 
-                patient.data.loc[entry, 'TWO_CYCLES'] = False 
-            else:
-                current_cycle = patient.data.loc[entry, 'CYCLE']
-                prior_cycle_index = patient.data.index[patient.data['CYCLE'] == current_cycle - 1].min()
-                prior_cycle_regimen = patient.data.loc[prior_cycle_index, 'CYCLE_REGIMEN']
-                patient.data.loc[entry, 'PRIOR_CYCLE_REGIMEN'] = prior_cycle_regimen
-                if (all(drug in prior_cycle_regimen for drug in patient.data.loc[entry, 'CYCLE_REGIMEN']) 
-                    and all(drug in patient.data.loc[entry, 'CYCLE_REGIMEN'] for drug in prior_cycle_regimen)):
-                    patient.data.loc[entry, 'TWO_CYCLES'] = True 
-                else:
-                    patient.data.loc[entry, 'TWO_CYCLES'] = False 
+    if chunk_patients.indication.upper() not in cases:
+        raise RuntimeError("Process " + str(os.getpid()) + " has no special cases loaded for " + str(chunk_patients.indication))
+    chunk_cases = cases[chunk_patients.indication.upper()]
+
+    start = time.time()
+
+    # Read the drug vocabulary and the rows of the chunk from the shared memory of the superchunk
+    if chunk_patients.shared_chunk is not None:
+        start_time = pr.start()
+        chunk_patients.vocabulary = sd.attach_vocabulary(chunk_patients.shared_chunk)
+        chunk_patients.data = sd.attach_claims(chunk_patients.shared_chunk, chunk_patients.vocabulary)
+        chunk_patients.unique_patients = chunk_patients.data['PATIENT_ID'].unique()
+        pr.stop('attach', start_time)
+
+    # Drug names are encoded once per run as integer drug codes (see main)
+    if chunk_patients.vocabulary is None:
+        chunk_patients.vocabulary = fn.get_drug_vocabulary(chunk_patients.data['MED_NAME'], chunk_cases.rules)
+        chunk_patients.data['DRUG_CODE'] = fn.encode_drug_names(chunk_patients.data['MED_NAME'], chunk_patients.vocabulary)
+
+    # Sort the chunk and add the treatment cycles
+    patient_index = pc.prepare_chunk(chunk_patients.data)
+
+    # The memo of the process is kept as long as the chunks have the same indication and drug vocabulary
+    global memo, memo_context
+    chunk_context = (chunk_patients.indication, line_engine, tuple(chunk_patients.vocabulary['names']))
+    if memo_size <= 0:
+        memo = None
+    elif memo is None or memo_context != chunk_context:
+        memo = fn.HistoryMemo(memo_size)
+        memo_context = chunk_context
+    memo_hits = memo.hits if memo is not None else 0
+    memo_misses = memo.misses if memo is not None else 0
+
+    # A parameter sweep evaluates every parameter set on the prepared chunk, and keeps the output of 
+    # all parameter sets in one long table with the parameters as columns
+    if chunk_patients.parameter_sets is None:
+        output = fn.OutputAccumulator()
+        pc.process_patients(chunk_patients, patient_index, chunk_cases, output, memo, line_engine)
+        start_time = pr.start()
+        output_lot, output_doses = output.to_frames()
+        pr.stop('output', start_time)
+    else:
+        lots = []
+        doses = []
+        for parameters in chunk_patients.parameter_sets:
+            chunk_patients.r_window = parameters['r_window']
+            chunk_patients.l_disgap = parameters['l_disgap']
+            chunk_patients.drug_switch_ignore = parameters['drug_switch_ignore']
+            chunk_patients.combo_dropped_line_advance = parameters['combo_dropped_line_advance']
+            output = fn.OutputAccumulator()
+            pc.process_patients(chunk_patients, patient_index, chunk_cases, output, memo, line_engine)
+            start_time = pr.start()
+            output_lot, output_doses = output.to_frames()
+            lots.append(fn.add_parameter_columns(output_lot, parameters))
+            doses.append(fn.add_parameter_columns(output_doses, parameters))
+            pr.stop('output', start_time)
+        start_time = pr.start()
+        output_lot = pd.concat(lots, ignore_index = True)
+        output_doses = pd.concat(doses, ignore_index = True)
+        pr.stop('output', start_time)
+
+    # Spool the output to the part files of the chunk and only send their paths back to the parent
+    if chunk_patients.part_paths is None:
+        return output_lot, output_doses
+    start_time = pr.start()
+    result = wd.write_part(output_lot, output_doses, chunk_patients.part_paths)
+    pr.stop('write', start_time)
+    pg.flush(chunk_patients.progress)
+
+    # Time the process spent on this chunk, to measure the load balance between the processes
+    result['pid'] = os.getpid()
+    result['busy_time'] = time.time() - start
+    result['stages'] = pr.collect()
+    result['memo_hits'] = memo.hits - memo_hits if memo is not None else 0
+    result['memo_misses'] = memo.misses - memo_misses if memo is not None else 0
+    return result
     
-                
-        # set medication start and medication end the same for all drugs in the same cycle
-        patient.data['ORIGINAL_MED_START'] = patient.data['MED_START']
-        patient.data['ORIGINAL_MED_END'] = patient.data['MED_END']
-        patient.data['MED_START'] = patient.data['CYCLE_START']
-        patient.data['MED_END'] = patient.data['CYCLE_START']
-
-        
-        # Initialize the line number and other parameters to their initial values
-        patient.line_number = 0
-        patient.previous_line = None
-        patient.is_next_maintenance = False
-
-        # while loop here
-        patient.line_next_start = chunk_patients.data.loc[0, 'MED_START'] + datetime.timedelta(days = chunk_patients.r_window)
-
-        while len(patient.data.index) > 0:
-
-            # Get Regimen and Line Start Information
-            patient.regimen = ln.get_regimen(patient.data, chunk_patients.r_window)
-
-             # Acquire rest of line data
-            patient.f_line_data = ln.get_line_data(patient.data, patient.regimen, chunk_patients.l_disgap, patient.line_number, patient.is_next_maintenance, chunk_patients.r_window, chunk_patients.drug_switch_ignore, chunk_patients.combo_dropped_line_advance, chunk_patients.indication, cases)
-            patient.line_name = patient.f_line_data['line_name']
-            patient.line_type = patient.f_line_data['line_type']
-            patient.line_start = patient.f_line_data['line_start']
-            patient.line_end = patient.f_line_data['line_end']
-            patient.line_next_start = patient.f_line_data['line_next_start']
-            patient.line_end_reason = patient.f_line_data['line_end_reason']
-            patient.line_number = patient.f_line_data['line_number']
-            patient.line_is_maintenance = patient.f_line_data['line_is_maintenance']
-            patient.is_next_maintenance = patient.f_line_data['line_is_next_maintenance']
-            patient.line_add_exemption = patient.f_line_data['line_add_exemption']
-            patient.line_sub_exemption = patient.f_line_data['line_sub_exemption']
-            patient.line_gap_exemption = patient.f_line_data['line_gap_exemption']
-            patient.line_name_exemption = patient.f_line_data['line_name_exemption']
-
-            # Acquire dosage information associated with this line
-            if patient.line_next_start == None:
-                patient.output_doses = patient.data
-            else:
-                patient.output_doses = patient.data[patient.data['MED_START'] < patient.line_next_start]
-
-            # Append line data to final output
-            patient.output_lot = pd.DataFrame({'PATIENT_ID' : str(chunk_patients.unique_patients[i]),
-                               'LINE_NUMBER' : str(patient.line_number),
-                               'LINE_NAME' : patient.line_name,
-                               'START_DATE' : patient.line_start,
-                               'END_DATE' : patient.line_end,
-                               'LINE_TYPE' : patient.line_type,
-                               'IS_MAINTENANCE' : patient.line_is_maintenance,
-                               'ADD_EXEMPTION' : patient.line_add_exemption,
-                               'SUB_EXEMPTION' : patient.line_sub_exemption,
-                               'GAP_EXEMPTION' : patient.line_gap_exemption,
-                               'NAME_EXEMPTION' : patient.line_name_exemption,
-                               'LINE_END_REASON' : patient.line_end_reason,
-                               'ENHANCED_COHORT' : chunk_patients.indication,
-                               'INDEX_DATE' : chunk_patients.index_date},
-                                columns=['PATIENT_ID','LINE_NUMBER','LINE_NAME', 'START_DATE', 'END_DATE',
-                                        'LINE_TYPE', 'IS_MAINTENANCE', 
-                                         'ADD_EXEMPTION', 'SUB_EXEMPTION', 'GAP_EXEMPTION', 'NAME_EXEMPTION',
-                                        'LINE_END_REASON', 'ENHANCED_COHORT', 'INDEX_DATE'],
-                                          index = [1])
-            #output_lot = output_lot.append(patient.output_lot, ignore_index = True)
-            output_lot = pd.concat([output_lot, patient.output_lot], ignore_index = True)
-            
-            # Append patient dosage information w/ line information
-            patient.output_doses = patient.output_doses[['PATIENT_ID', 'MED_START', 'MED_END', 'MED_NAME']]
-            patient.output_doses['LINE_NUMBER'] = patient.line_number
-            patient.output_doses['LINE_NAME'] = patient.line_name
-            patient.output_doses['MED_NAME'] = patient.output_doses['MED_NAME'].str.upper()
-            output_doses = pd.concat([output_doses, patient.output_doses], ignore_index = True)
-
-            patient.previous_line = patient.line_number
-
-            # Cut the data to the next line
-            if patient.line_next_start == None:
-                break
-            patient.cut = fn.snip_dataframe(patient.data, patient.line_next_start)
-            patient.data = patient.cut['after']
-        
-    return output_lot, output_doses
+
+
+def get_chunk_input(input, part_paths, shared_chunk):
+
+    # The claims data of the chunk are read by the process from shared memory (see process_chunk)
+
+    chunk = pc.Input(r_window = input.r_window,
+                  l_disgap = input.l_disgap,
+                  drug_switch_ignore = input.drug_switch_ignore,
+                  combo_dropped_line_advance = input.combo_dropped_line_advance,
+                  indication = input.indication,
+                  database = input.database,
+                  filename = input.filename,
+                  outfile = input.outfile,
+                  data = pd.DataFrame(),
+                  unique_patients = list())
+    # The drug vocabulary is read from shared memory too, once per process and superchunk
+    chunk.vocabulary = None
+    chunk.part_paths = part_paths
+    chunk.shared_chunk = shared_chunk
+    chunk.parameter_sets = input.parameter_sets
+    chunk.progress = dict(input.progress) if input.progress is not None else None
+
+    ############# RETURN #############
+    return(chunk)
+
+
+
+def process_superchunks(pool, input, nsuperchunks, part_dir, first_part, monitor = None):
+
+    # Split the patients of input.data into nsuperchunks superchunks, which are processed sequentially,
+    # and every superchunk into nchunks cost balanced chunks, which are processed in parallel by the pool,
+    # heaviest first.  Every chunk writes its output to its own part files in part_dir, numbered from first_part in
+    # patient order, so the parts merged in part order are sorted by patient whatever order the chunks finish in.
+    # The claims of a superchunk are put in shared memory, so the processes only receive the row range of their chunk.
+    # The superchunks are counted in input.progress, and the patients and rows of every superchunk are added to the monitor
+
+    superchunk_size = int(len(input.unique_patients)/nsuperchunks) + 1
+
+    parts = []
+    busy_time = {}
+    memo = {'hits' : 0, 'misses' : 0}
+    stages = []
+
+    starting_patient = 0
+    while (starting_patient < len(input.unique_patients)):
+        print("Starting the next part of the database with patient", starting_patient, flush = True)
+        start_time = pr.start()
+        superchunk = input.data[input.data['PATIENT_ID'].isin(input.unique_patients[starting_patient:(starting_patient + superchunk_size)])]
+        tasks = fn.get_patient_tasks(superchunk['PATIENT_ID'], nchunks, COST_EXPONENT)
+        print("Number of chunks: ", len(tasks['rows']), ", estimated cost of the heaviest and lightest chunk: ", tasks['cost'][0], tasks['cost'][-1], flush = True)
+
+        # The rows of every chunk are made contiguous, so a chunk is a range of rows of the shared superchunk
+        superchunk = superchunk.iloc[np.concatenate(tasks['rows'])]
+        bounds = np.cumsum([0] + [len(rows) for rows in tasks['rows']])
+        shared = sd.share_claims(superchunk, input.vocabulary)
+        pr.stop('partition', start_time)
+
+        if monitor is not None:
+            input.progress['superchunk'] = input.progress['superchunk'] + 1
+            nsets = len(input.parameter_sets) if input.parameter_sets is not None else 1
+            monitor.add_work(input.progress['superchunk'], superchunk['PATIENT_ID'].nunique() * nsets, len(superchunk.index) * nsets)
+
+        chunk_inputs = (get_chunk_input(input,
+                                        wd.get_part_paths(part_dir, first_part + len(parts) + tasks['part'][i], OUTPUT_FORMAT),
+                                        sd.get_shared_chunk(shared, bounds[i], bounds[i + 1]))
+                        for i in range(len(tasks['rows'])))
+
+        # Chunks are handed out one at a time, as processes become free
+        start = time.time()
+        superchunk_parts = []
+        try:
+            for result in pool.imap_unordered(process_chunk, chunk_inputs):
+                print("Part", result['part'], "rows (lot, doses)", result['lot_rows'], result['doses_rows'], "busy time", result['busy_time'], flush = True)
+                busy_time[result['pid']] = busy_time.get(result['pid'], 0) + result['busy_time']
+                memo['hits'] = memo['hits'] + result['memo_hits']
+                memo['misses'] = memo['misses'] + result['memo_misses']
+                stages.append(result['stages'])
+                superchunk_parts.append(result)
+        finally:
+            sd.release_claims(shared)
+        print("Superchunk wall time: ", time.time() - start, flush = True)
+
+        parts.extend(sorted(superchunk_parts, key = lambda part: part['part']))
+
+        starting_patient = starting_patient + superchunk_size
+
+    return({'parts' : parts, 'busy_time' : busy_time, 'memo' : memo, 'stages' : stages})
     
 
 
-def main():
+def get_jobs(argv):
+
+    # Either a single indication, with the default database, input file and output name,
+    # or a manifest csv file with one job per row: indication, database, filename, outfile.
+    # With --sweep <sweep.csv>, every job is a parameter sweep over the parameter sets of sweep.csv.
+    # With --sql <url> [--query <query>], every job reads its claims from the database instead of its claims file
+    options = {'--sweep' : None, '--sql' : SQL_URL, '--query' : SQL_QUERY}
+    for option in options:
+        if option in argv:
+            position = argv.index(option)
+            options[option] = argv[position + 1]
+            argv = argv[:position] + argv[(position + 2):]
+
+    if argv[1] == '--manifest':
+        manifest = pd.read_csv(argv[2], dtype = str)
+        jobs = manifest[['indication', 'database', 'filename', 'outfile']].to_dict('records')
+    else:
+        jobs = [{'indication' : argv[1], 'database' : "Test", 'filename' : "example_input." + INPUT_FORMAT, 'outfile' : "Test"}]
+
+    for job in jobs:
+        job['indication'] = job['indication'].upper()
+        job['sweep'] = options['--sweep']
+        job['sql_url'] = options['--sql']
+        job['sql_query'] = options['--query']
+
+    ############# RETURN #############
+    return(jobs)
+
+
+
+def run_job(pool, job, progress_queue = None):
 
     ##################################
     ### hardcoded input parameters ###
     ##################################
 
-    patient = Patient()
-    
-    global input
-    global cases
-    
-    command_line_indication = sys.argv[1].upper()
-    
-    input = Input(r_window = 28,                       # default value, to be changed by the value in the table
+    input = pc.Input(r_window = 28,                       # default value, to be changed by the value in the table
                   l_disgap = 180,                      # default value, to be changed by the value in the table
                   drug_switch_ignore = False,          # default value, to be changed by the value in the table
                   combo_dropped_line_advance = False,  # default value, to be changed by the value in the table
-                  indication = command_line_indication,
-                  database = "Test",
-                  filename = "example_input.csv",
-                  outfile = "Test",
+                  indication = job['indication'],
+                  database = job['database'],
+                  filename = job['filename'],
+                  outfile = job['outfile'],
                   data = pd.DataFrame(),
                   unique_patients = list())
 
-    cases = rp.cases(input.indication)
+    job_cases = cases[input.indication]
 
     # Reset default input parameters if necessary
-    input.r_window = int(cases.par_general.loc[0, 'r_window'])
-    input.l_disgap = int(cases.par_general.loc[0, 'l_disgap'])
-    input.drug_switch_ignore = cases.par_general.loc[0, 'drug_switch_ignore']
-    input.combo_dropped_line_advance = cases.par_general.loc[0, 'combo_dropped_line_advance']
+    input.r_window = int(job_cases.par_general.loc[0, 'r_window'])
+    input.l_disgap = int(job_cases.par_general.loc[0, 'l_disgap'])
+    input.drug_switch_ignore = job_cases.par_general.loc[0, 'drug_switch_ignore']
+    input.combo_dropped_line_advance = job_cases.par_general.loc[0, 'combo_dropped_line_advance']
+
+    # A parameter sweep evaluates every parameter set of the sweep file instead
+    if job['sweep'] is not None:
+        if INCREMENTAL:
+            raise ValueError("A parameter sweep can't be an incremental run")
+        input.parameter_sets = rp.parameter_sets(job['sweep'])
+        print("Parameter sweep over", len(input.parameter_sets), "parameter sets of", job['sweep'], flush = True)
     
     ##############################
     ### Load Preprocessed Data ### 
     ##############################
 
+    input_path = 'data/' + input.indication + '/' + input.database + '/' + input.filename
+
+    # Either load the whole file (or query result) and split it into NSUPERCHUNKS superchunks, or stream it
+    # in batches of complete patients, where every batch is processed as one superchunk
+    if STREAM_BATCH_ROWS is None:
+        start_time = pr.start()
+        if job['sql_url'] is not None:
+            batches = [rd.read_sql_claims(job['sql_url'], job['sql_query'])]
+        else:
+            batches = [rd.read_claims(input_path, INPUT_FORMAT)]
+        pr.stop('load', start_time)
+        nsuperchunks = NSUPERCHUNKS
+    else:
+        if job['sql_url'] is not None:
+            batches = rd.read_sql_batches(job['sql_url'], job['sql_query'], STREAM_BATCH_ROWS)
+        else:
+            batches = rd.read_patient_batches(input_path, STREAM_BATCH_ROWS, INPUT_FORMAT)
+        batches = pr.iterate('load', batches)
+        nsuperchunks = 1
 
-    input.data = pd.read_csv('data/' + command_line_indication.upper() + '/' + input.database + '/' + input.filename)
-    input.data['MED_START'] = pd.to_datetime(input.data['MED_START'])
-    input.data['MED_END'] = pd.to_datetime(input.data['MED_START'])
-    input.unique_patients = input.data['PATIENT_ID'].unique()
-    print("Number of unique patients: " + str(len(input.unique_patients)))
+    ##################################################
+    ### Output directory and part files            ###
+    ##################################################
 
-    
-    input_chunk = []
-    for i in range(nchunks):
-        print("Initializing chunk ", i, flush = True)    
-        input_chunk.append(Input(r_window = 28,                       # default value, to be changed by the value in the table
-                                 l_disgap = 180,                      # default value, to be changed by the value in the table
-                                 drug_switch_ignore = False,          # default value, to be changed by the value in the table
-                                 combo_dropped_line_advance = False,  # default value, to be changed by the value in the table
-                                 indication = None,
-                                 database = "Test",
-                                 filename = "example_input.csv",
-                                 outfile = "test",
-                                 data = pd.DataFrame(),
-                                 unique_patients = list()))
-
-
-    chunk_size = int(len(input.unique_patients)/nchunks) + 1
-    # try to get only a small part of the database 
-    chunk_size = int(chunk_size/NSUPERCHUNKS) + 1
+    # The output is partitioned by indication: output/<INDICATION>/<outfile>/, and the output of
+    # a parameter sweep, with the parameters as first columns, goes to output/<INDICATION>/<outfile>/sweep/
+    output_dir = './output/' + input.indication + '/' + input.outfile
+    if input.parameter_sets is not None:
+        output_dir = output_dir + '/sweep'
+    part_dir = output_dir + '/parts'
+    wd.reset_part_dir(part_dir)
+
+    parts = []
+    unchanged_part = None
+    integer_ids = True
+    busy_time = {}
+    memo = {'hits' : 0, 'misses' : 0}
+    stages = {}
 
     ##################################################
-    ### Blank template of final output to be saved ###
+    ### Incremental run                            ###
     ##################################################
 
-    output_lot = pd.DataFrame()
-    output_doses = pd.DataFrame()
+    # The previous run can be reused if its key matches and its output files exist
+    store_dir = './store/' + input.indication + '/' + input.outfile
+    if INCREMENTAL:
+        run_key = st.get_run_key(input.indication, {'r_window' : input.r_window,
+                                                    'l_disgap' : input.l_disgap,
+                                                    'drug_switch_ignore' : input.drug_switch_ignore,
+                                                    'combo_dropped_line_advance' : input.combo_dropped_line_advance,
+                                                    'output_format' : OUTPUT_FORMAT})
+        store = st.read_store(store_dir)
+        if not (os.path.exists(output_dir + '/output_lot.' + OUTPUT_FORMAT) and os.path.exists(output_dir + '/output_doses.' + OUTPUT_FORMAT)):
+            store = None
+        st.invalidate_store(store_dir)
+        hashes = []
+        unchanged_patients = []
     
     ####################
     ### Script start ###
     ####################
-    
-    output_lot_tmp = pd.DataFrame()
-    output_doses_tmp = pd.DataFrame()
 
+    print("Starting job", input.indication, input.database, input.filename, input.outfile, flush = True)
     start = time.time()
 
-    
-    
-    
-    starting_patient = 0
-    while (starting_patient < int((len(input.unique_patients) - 1))):  # try a couple of first chapters of BREAST
-        print("Starting the next part of the database with patient", starting_patient, flush = True)
-        for i in range(nchunks):
-            print("Populating data for chunk ", i, flush = True)
-            # Reset default input parameters if necessary
-            input_chunk[i].indication = command_line_indication
-            input_chunk[i].r_window = int(cases.par_general.loc[0, 'r_window'])
-            input_chunk[i].l_disgap = int(cases.par_general.loc[0, 'l_disgap'])
-            input_chunk[i].drug_switch_ignore = cases.par_general.loc[0, 'drug_switch_ignore']
-            input_chunk[i].combo_dropped_line_advance = cases.par_general.loc[0, 'combo_dropped_line_advance']
-            print("Range of patients: ", i*chunk_size+starting_patient, (i+1)*chunk_size+starting_patient)
-            input_chunk[i].data = input.data[input.data['PATIENT_ID'].isin(input.unique_patients[(i*chunk_size+starting_patient):((i+1)*chunk_size+starting_patient)])].reset_index(drop = True)
-            input_chunk[i].unique_patients = input_chunk[i].data['PATIENT_ID'].unique()     
-
-        # Loop through chunks   
-
-        ctx = multiprocessing.get_context('spawn')
-        pool = ctx.Pool(nprocesses)
-        processes = [p.pid for p in pool._pool]
-        for pid in processes:
-            p = psutil.Process(pid)
-            p.nice(5)
-        pool_results = pool.map(process_chunk, input_chunk)
-        pool.close()
-        pool.join()
-        results = []
-        for result in pool_results:
-            results.extend(result)
-        output_lot_tmp = pd.concat(results[::2])
-        output_doses_tmp = pd.concat(results[1::2])
-        
-        print("Output_lot_tmp memory usage", output_lot_tmp.memory_usage(deep = True).sum(), flush = True)
-        print("Output_doses_tmp memory usage", output_doses_tmp.memory_usage(deep = True).sum(), flush = True)
-
-        output_lot = output_lot.append(output_lot_tmp, ignore_index = True)
-        output_doses = output_doses.append(output_doses_tmp, ignore_index = True)
-
-        starting_patient = starting_patient + chunk_size * nchunks
-    
-    
-    
+    # The progress events of the processes of the pool are combined into one progress line of the job
+    monitor = None
+    if progress_queue is not None:
+        job_name = input.indication + '/' + input.outfile + ('/sweep' if input.parameter_sets is not None else '')
+        input.progress = {'job' : job_name, 'superchunk' : 0}
+        monitor = pg.ProgressMonitor(progress_queue, job_name, PROGRESS_INTERVAL, output_dir + '/progress.json' if PROGRESS_FILE else None)
+
+    date_format = DATE_FORMAT
+    for batch in batches:
+        # Typed claims: datetime64 dates parsed with one date format, lower case drug names, no duplicate rows
+        start_time = pr.start()
+        if date_format is None:
+            date_format = rd.detect_date_format(batch['MED_START'])
+        input.data = rd.normalize_claims(batch, date_format)
+        pr.stop('ingest', start_time)
+        integer_ids = pd.api.types.is_integer_dtype(input.data['PATIENT_ID'])
+
+        # Only the patients whose claims changed since the previous run are processed
+        if INCREMENTAL:
+            start_time = pr.start()
+            batch_hashes = st.get_patient_hashes(input.data)
+            batch_unchanged = st.get_unchanged_patients(batch_hashes, store, run_key)
+            hashes.append(batch_hashes)
+            unchanged_patients.append(batch_unchanged)
+            input.data = input.data[~input.data['PATIENT_ID'].isin(batch_unchanged)].reset_index(drop = True)
+            pr.stop('patient_hashes', start_time)
+            print("Patients reused from the previous run: " + str(len(batch_unchanged)))
+            if len(input.data.index) == 0:
+                continue
+
+        input.unique_patients = np.sort(input.data['PATIENT_ID'].unique())
+
+        # Per-run drug vocabulary: every drug name is mapped to an integer drug code once
+        start_time = pr.start()
+        input.vocabulary = fn.get_drug_vocabulary(input.data['MED_NAME'], job_cases.rules)
+        input.data['DRUG_CODE'] = fn.encode_drug_names(input.data['MED_NAME'], input.vocabulary)
+        pr.stop('encode', start_time)
+        print("Number of unique patients: " + str(len(input.unique_patients)))
+
+        output = process_superchunks(pool, input, nsuperchunks, part_dir, len(parts), monitor)
+        parts.extend(output['parts'])
+        for pid in output['busy_time']:
+            busy_time[pid] = busy_time.get(pid, 0) + output['busy_time'][pid]
+        memo['hits'] = memo['hits'] + output['memo']['hits']
+        memo['misses'] = memo['misses'] + output['memo']['misses']
+        for collected in output['stages']:
+            pr.merge_stages(stages, collected)
+
+    # The output of the unchanged patients is copied from the previous output, before it is overwritten
+    if INCREMENTAL and sum(len(patients) for patients in unchanged_patients) > 0:
+        start_time = pr.start()
+        unchanged_patients = np.concatenate(unchanged_patients)
+        unchanged_part = wd.get_part_paths(part_dir, len(parts), OUTPUT_FORMAT)
+        unchanged_part['lot_rows'] = wd.copy_patient_rows(output_dir + '/output_lot.' + OUTPUT_FORMAT, unchanged_part['output_lot'], unchanged_patients, OUTPUT_FORMAT)
+        unchanged_part['doses_rows'] = wd.copy_patient_rows(output_dir + '/output_doses.' + OUTPUT_FORMAT, unchanged_part['output_doses'], unchanged_patients, OUTPUT_FORMAT)
+        pr.stop('copy_unchanged', start_time)
+
+    # Merge the part files written by the workers into the final output. The parts are in patient order, and the
+    # part of the unchanged patients, whose ids are spread over those of the parts, is merged with them by patient
+    start_time = pr.start()
+    sweep = input.parameter_sets is not None
+    for output in ['output_lot', 'output_doses']:
+        path = output_dir + '/' + output + '.' + OUTPUT_FORMAT
+        if unchanged_part is not None:
+            wd.merge_sorted_parts([[part[output] for part in parts], [unchanged_part[output]]], path, OUTPUT_FORMAT, integer_ids)
+        else:
+            wd.merge_parts([part[output] for part in parts], path, OUTPUT_FORMAT, output, sweep)
+    if unchanged_part is not None:
+        parts.append(unchanged_part)
+    shutil.rmtree(part_dir)
+    pr.stop('merge', start_time)
+
+    if monitor is not None:
+        monitor.finish()
+
+    if INCREMENTAL:
+        st.write_store(store_dir, run_key, pd.concat(hashes) if hashes else pd.Series([], dtype = np.int64))
+
     end = time.time()
     
+    print("Final output_lot rows", sum(part['lot_rows'] for part in parts), flush = True)
+    print("Final output_doses rows", sum(part['doses_rows'] for part in parts), flush = True)
     
-    print("Final output_lot dimensions", output_lot.shape, flush = True)
-    print("Final output_lot memory usage", output_lot.memory_usage(deep = True).sum(), flush = True)
-    print("Final output_doses dimensions", output_doses.shape, flush = True)
-    print("Final output_doses memory usage", output_doses.memory_usage(deep = True).sum(), flush = True)
-    
-    print('Time to run the main code: ' + str(end - start) + ' seconds')
+    print('Time to run the job: ' + str(end - start) + ' seconds')
 
-    if not os.path.exists('./output'):
-        os.makedirs('./output')
+    if memo['hits'] + memo['misses'] > 0:
+        print("Patient history memo hits", memo['hits'], "misses", memo['misses'], "hit rate", memo['hits'] / (memo['hits'] + memo['misses']), flush = True)
 
-    if not os.path.exists('./output/' + input.indication.upper()):
-        os.makedirs('./output/' + input.indication.upper())
+    # Busy time of every process; with a good load balance they are all close to the time to run the job
+    for pid in sorted(busy_time):
+        print("Process", pid, "busy time", busy_time[pid], "seconds, utilization", busy_time[pid] / (end - start), flush = True)
+
+    # Run report of the stages of the parent and of all processes of the pool
+    if pr.enabled:
+        pr.merge_stages(stages, pr.collect())
+        pr.write_report(output_dir, {'indication' : input.indication,
+                                     'database' : input.database,
+                                     'filename' : input.filename,
+                                     'outfile' : input.outfile,
+                                     'seconds' : end - start,
+                                     'processes' : nprocesses,
+                                     'lot_rows' : sum(part['lot_rows'] for part in parts),
+                                     'doses_rows' : sum(part['doses_rows'] for part in parts),
+                                     'memo' : memo,
+                                     'busy_time' : busy_time}, stages)
+        print("Wrote the run report to", output_dir + '/run_report.json', flush = True)
+
+
+
+def main():
 
-    if not os.path.exists('./output/' + input.indication.upper() + '/' + input.outfile):
-        os.makedirs('./output/' + input.indication.upper()+ '/' + input.outfile)
+    # Usage: python rwToT_LoT_main_parallel.py <INDICATION> [--sweep <sweep.csv>] [--sql <url> [--query <query>]]
+    #        python rwToT_LoT_main_parallel.py --manifest <manifest.csv> [--sweep <sweep.csv>] [--sql <url> [--query <query>]]
+    jobs = get_jobs(sys.argv)
+    indications = sorted(set(job['indication'] for job in jobs))
 
+    rd.check_storage_format(INPUT_FORMAT)
+    rd.check_storage_format(OUTPUT_FORMAT)
 
-    output_lot.to_csv('./output/' + input.indication.upper() + '/' + input.outfile + '/output_lot.csv', index = False)
-    output_doses.to_csv('./output/' + input.indication.upper() + '/' + input.outfile + '/output_doses.csv', index = False)
+    # The main process and every process of the pool load the special cases of all indications once
+    init_process(indications, PROFILE, None, PROGRESS_INTERVAL, MEMO_SIZE, LINE_ENGINE)
+
+    start = time.time()
+
+    # One pool of processes runs all the jobs
+    ctx = multiprocessing.get_context('spawn')
+    progress_queue = ctx.Queue() if PROGRESS_INTERVAL else None
+    pool = ctx.Pool(nprocesses, initializer = init_process, initargs = (indications, PROFILE, progress_queue, PROGRESS_INTERVAL, MEMO_SIZE, LINE_ENGINE))
+    processes = [p.pid for p in pool._pool]
+    for pid in processes:
+        p = psutil.Process(pid)
+        p.nice(5)
+
+    for job in jobs:
+        run_job(pool, job, progress_queue)
+
+    pool.close()
+    pool.join()
+
+    end = time.time()
+    
+    print('Time to run the main code: ' + str(end - start) + ' seconds')
     
 
 if __name__ == '__main__':
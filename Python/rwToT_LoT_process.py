@@ -0,0 +1,218 @@
+# This is a script with the processing of the claims of a chunk of patients by the line of therapy algorithm:
+# the claims are sorted and split into treatment cycles, and the lines of every patient are scanned one line at
+# a time. It is used by the processes of the pool of rwToT_LoT_main_parallel and by the in process engine
+
+import datetime
+import numpy as np
+import pandas as pd
+
+import rwToT_LoT_line as ln
+import rwToT_LoT_functions as fn
+import rwToT_LoT_profile as pr
+import rwToT_LoT_progress as pg
+
+
+###############################################################################
+### Input and patient classes                                               ###
+### Input holds the general parameters, the claims and the drug vocabulary  ###
+### of a job or of a chunk of it, Patient the state of the line scan of one ###
+### patient                                                                 ###
+###############################################################################
+
+class Input:
+  def __init__(self,
+               r_window, 
+               l_disgap,
+               drug_switch_ignore,
+               combo_dropped_line_advance,
+               indication,
+               database,
+               filename,
+               outfile,
+               data,
+               unique_patients):
+    self.r_window = r_window
+    self.l_disgap = l_disgap
+    self.drug_switch_ignore = drug_switch_ignore
+    self.combo_dropped_line_advance = combo_dropped_line_advance
+    self.indication = indication
+    self.database = database
+    self.filename = filename
+    self.outfile = outfile
+    self.data = data
+    self.unique_patients = unique_patients
+    self.index_date = pd.to_datetime('2001-01-01')
+    self.last_activity_date = pd.to_datetime('2001-01-01')
+    self.last_enrollment_date = pd.to_datetime('2001-01-01')
+    self.vocabulary = None
+    self.part_paths = None
+    self.shared_chunk = None
+    self.parameter_sets = None
+    self.progress = None
+
+class Patient:
+    def __init__(self):
+        self.data = pd.DataFrame()
+        self.line_number = 0
+        self.line_name = None
+        self.line_type = None
+        self.line_start = None
+        self.line_end = None
+        self.line_next_start = None
+        self.line_end_reason = None
+        self.previous_line = None
+        self.line_is_maintenance = False
+        self.is_next_maintenance = False
+        self.line_add_exemption = None
+        self.line_sub_exemption = None
+        self.line_gap_exemption = None
+        self.line_name_exemption = None
+        self.regimen = list()
+        self.cut = pd.DataFrame()
+
+###############################################################################
+### Prepare chunk function                                                  ###
+### function sorts the claims of a chunk by patient, adds the treatment     ###
+### cycles, and moves the dates of every drug to the start of its cycle,    ###
+### before the lines of the patients are scanned                            ###
+### Inputs: 1) claims dataframe with drug codes                             ###
+### Outputs: patient index of the sorted claims (see get_patient_index)     ###
+###############################################################################
+
+def prepare_chunk(data):
+
+    # Sort the chunk once and walk each patient's slice of rows
+    start_time = pr.start()
+    patient_index = fn.get_patient_index(data)
+    pr.stop('patient_index', start_time)
+
+    # Add treatment cycles for the whole chunk: a new cycle starts as soon as 
+    # it's been more than four days since the last drug administration
+    start_time = pr.start()
+    patient_index['data'] = fn.get_cycles(patient_index['data'], cycle_gap = 4)
+    pr.stop('cycles', start_time)
+
+    # set medication start and medication end the same for all drugs in the same cycle
+    patient_index['data']['ORIGINAL_MED_START'] = patient_index['data']['MED_START']
+    patient_index['data']['ORIGINAL_MED_END'] = patient_index['data']['MED_END']
+    patient_index['data']['MED_START'] = patient_index['data']['CYCLE_START']
+    patient_index['data']['MED_END'] = patient_index['data']['CYCLE_START']
+
+    return patient_index
+
+###############################################################################
+### Process patients function                                               ###
+### function scans the lines of every patient of a prepared chunk with the  ###
+### general parameters of chunk_patients, and adds them to the output       ###
+### accumulator. Lines are looked up in and added to the patient history    ###
+### memo, if any                                                            ###
+### Inputs: 1) chunk input, 2) patient index (see prepare_chunk),           ###
+###         3) special cases, 4) output accumulator, 5) patient history     ###
+###         memo or None, 6) first pass line scan engine                    ###
+### Outputs: None                                                           ###
+###############################################################################
+
+def process_patients(chunk_patients, patient_index, chunk_cases, output, memo = None, line_engine = "numpy"):
+
+    patient = Patient()
+
+    # Lines are memoized by history and parameters
+    parameter_key = (chunk_patients.r_window, chunk_patients.l_disgap, chunk_patients.drug_switch_ignore, chunk_patients.combo_dropped_line_advance)
+
+    for i in range(len(patient_index['patient_id'])):
+        
+        patient.data = fn.get_patient_data(patient_index, i)
+        patient.nrows = len(patient.data.index)
+        chunk_patients.index_date = patient.data.loc[0, 'MED_START']
+        chunk_patients.last_activity_date = None # patient.data.loc[0, ['LAST_ACTIVITY_DATE']]
+        chunk_patients.last_enrollment_date = None # patient.data.loc[0, ['LAST_ENROLLMENT_DATE']]
+
+        # A patient with the same relative history as a previous patient gets the same lines, 
+        # with the dates shifted to the patient's index date
+        if memo is not None:
+            start_time = pr.start()
+            patient.history_key = (parameter_key, fn.get_history_key(patient.data))
+            patient.lines = memo.get(patient.history_key)
+            pr.stop('history_memo', start_time)
+            if patient.lines is not None:
+                start_time = pr.start()
+                for line in patient.lines:
+                    line_data = fn.rebase_dates(line['line_data'], chunk_patients.index_date)
+                    output.add_line(patient_index['patient_id'][i], line_data, chunk_patients.indication, chunk_patients.index_date)
+                    doses = patient.data.iloc[line['rows']]
+                    output.add_doses(doses, line_data['line_number'], line_data['line_name'], chunk_patients.vocabulary['output_names'][doses['DRUG_CODE'].to_numpy()])
+                pr.stop('output', start_time)
+                pg.report(chunk_patients.progress, 1, patient.nrows)
+                continue
+            patient.lines = []
+            patient.rows = np.arange(len(patient.data.index))
+        # Scan patient claims data to acquire line information on a step-wise line by line basis
+
+        # Initialize the line number and other parameters to their initial values
+        patient.line_number = 0
+        patient.previous_line = None
+        patient.is_next_maintenance = False
+
+        # while loop here
+        patient.line_next_start = chunk_patients.data.loc[0, 'MED_START'] + datetime.timedelta(days = chunk_patients.r_window)
+
+        while len(patient.data.index) > 0:
+
+            # Get Regimen and Line Start Information
+            start_time = pr.start()
+            patient.regimen = ln.get_regimen(patient.data, chunk_patients.r_window, ln.DRUG_COLUMN[line_engine])
+            pr.stop('get_regimen', start_time)
+
+             # Acquire rest of line data
+            patient.f_line_data = ln.get_line_data(patient.data, patient.regimen, chunk_patients.l_disgap, patient.line_number, patient.is_next_maintenance, chunk_patients.r_window, chunk_patients.drug_switch_ignore, chunk_patients.combo_dropped_line_advance, chunk_patients.indication, chunk_cases, line_engine, chunk_patients.vocabulary)
+            patient.line_name = patient.f_line_data['line_name']
+            patient.line_type = patient.f_line_data['line_type']
+            patient.line_start = patient.f_line_data['line_start']
+            patient.line_end = patient.f_line_data['line_end']
+            patient.line_next_start = patient.f_line_data['line_next_start']
+            patient.line_end_reason = patient.f_line_data['line_end_reason']
+            patient.line_number = patient.f_line_data['line_number']
+            patient.line_is_maintenance = patient.f_line_data['line_is_maintenance']
+            patient.is_next_maintenance = patient.f_line_data['line_is_next_maintenance']
+            patient.line_add_exemption = patient.f_line_data['line_add_exemption']
+            patient.line_sub_exemption = patient.f_line_data['line_sub_exemption']
+            patient.line_gap_exemption = patient.f_line_data['line_gap_exemption']
+            patient.line_name_exemption = patient.f_line_data['line_name_exemption']
+
+            # Acquire dosage information associated with this line
+            if patient.line_next_start == None:
+                patient.output_doses = patient.data
+            else:
+                patient.output_doses = patient.data[patient.data['MED_START'] < patient.line_next_start]
+
+            # Append line data to final output
+            start_time = pr.start()
+            output.add_line(patient_index['patient_id'][i], patient.f_line_data, chunk_patients.indication, chunk_patients.index_date)
+            
+            # Append patient dosage information w/ line information
+            drug_codes = patient.output_doses['DRUG_CODE'].to_numpy()
+            output.add_doses(patient.output_doses, patient.line_number, patient.line_name, chunk_patients.vocabulary['output_names'][drug_codes])
+            pr.stop('output', start_time)
+
+            # Remember the line with relative dates, and the rows of the patient's claims that are its doses
+            if memo is not None:
+                if patient.line_next_start == None:
+                    dose_rows = patient.rows
+                else:
+                    dose_rows = patient.rows[(patient.data['MED_START'] < patient.line_next_start).to_numpy()]
+                patient.lines.append({'line_data' : fn.get_relative_dates(patient.f_line_data, chunk_patients.index_date), 'rows' : dose_rows})
+
+            patient.previous_line = patient.line_number
+
+            # Cut the data to the next line
+            if patient.line_next_start == None:
+                break
+            if memo is not None:
+                patient.rows = patient.rows[(patient.data['MED_START'] >= patient.line_next_start).to_numpy()]
+            patient.cut = fn.snip_dataframe(patient.data, patient.line_next_start)
+            patient.data = patient.cut['after']
+
+        if memo is not None:
+            memo.put(patient.history_key, patient.lines)
+
+        pg.report(chunk_patients.progress, 1, patient.nrows)
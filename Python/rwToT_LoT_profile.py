@@ -0,0 +1,142 @@
+# This is a script to time the stages of the line of therapy algorithm: wall time, number of calls and
+# peak memory of every stage, in every process, aggregated into a run report written next to the output
+
+import os
+import json
+import time
+import pandas as pd
+
+enabled = False  # set by enable(), in the main process and in every process of the pool
+stages = {}      # stage name -> seconds, calls and peak RSS recorded by this process since the last collect()
+process = None
+
+###############################################################################
+### Enable function                                                         ###
+### function turns the stage timers of this process on. While they are off, ###
+### start() and stop() return at once, so the timers can stay in the code   ###
+### Inputs: None                                                            ###
+### Outputs: None                                                           ###
+###############################################################################
+
+def enable():
+
+    # psutil is only needed to record the memory of the stages, so it is imported once the timers are turned on
+    import psutil
+
+    global enabled, process
+    enabled = True
+    process = psutil.Process()
+
+###############################################################################
+### Start and stop functions                                                ###
+### start() returns the start time of a stage, or None if the timers are    ###
+### off. stop() adds the time since the start to the stage, counts the      ###
+### call, and keeps the largest RSS of the process at the end of the stage  ###
+### Inputs: 1) stage name, 2) start time returned by start()                ###
+### Outputs: start time (start), None (stop)                                ###
+###############################################################################
+
+def start():
+
+    if not enabled:
+        return(None)
+
+    ############# RETURN #############
+    return(time.perf_counter())
+
+def stop(name, start_time):
+
+    if start_time is None:
+        return
+
+    seconds = time.perf_counter() - start_time
+    stage = stages.get(name)
+    if stage is None:
+        stage = {'seconds' : 0.0, 'calls' : 0, 'peak_rss' : 0}
+        stages[name] = stage
+    stage['seconds'] = stage['seconds'] + seconds
+    stage['calls'] = stage['calls'] + 1
+    stage['peak_rss'] = max(stage['peak_rss'], process.memory_info().rss)
+
+###############################################################################
+### Iterate function                                                        ###
+### function times every step of an iterator as a call of the stage, e.g.   ###
+### reading the next batch of a streamed claims file                        ###
+### Inputs: 1) stage name, 2) iterable                                      ###
+### Outputs: generator of the items of the iterable                         ###
+###############################################################################
+
+def iterate(name, iterable):
+
+    iterator = iter(iterable)
+    while True:
+        start_time = start()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            stop(name, start_time)
+        yield item
+
+###############################################################################
+### Collect function                                                        ###
+### function returns the stages recorded by this process, with its process  ###
+### id, and starts recording anew, so a worker can send the stages of every ###
+### chunk back to the parent                                                ###
+### Inputs: None                                                            ###
+### Outputs: dictionary with the process id and the recorded stages         ###
+###############################################################################
+
+def collect():
+
+    global stages
+    recorded = stages
+    stages = {}
+
+    ############# RETURN #############
+    return({'pid' : os.getpid(), 'stages' : recorded})
+
+###############################################################################
+### Merge stages function                                                   ###
+### function adds the stages collected by one process (see collect) to the  ###
+### totals of the run: seconds and calls are summed over the processes, the ###
+### peak RSS is the largest of any process                                  ###
+### Inputs: 1) dictionary of the totals by stage, 2) collected stages       ###
+### Outputs: None                                                           ###
+###############################################################################
+
+def merge_stages(totals, collected):
+
+    for name, stage in collected['stages'].items():
+        total = totals.get(name)
+        if total is None:
+            total = {'seconds' : 0.0, 'calls' : 0, 'peak_rss' : 0, 'pids' : set()}
+            totals[name] = total
+        total['seconds'] = total['seconds'] + stage['seconds']
+        total['calls'] = total['calls'] + stage['calls']
+        total['peak_rss'] = max(total['peak_rss'], stage['peak_rss'])
+        total['pids'].add(collected['pid'])
+
+###############################################################################
+### Write report function                                                   ###
+### function writes the run report: a json file with the run information    ###
+### and the stages, and a csv file with one row per stage                   ###
+### Inputs: 1) output directory, 2) dictionary of run information,          ###
+###         3) dictionary of the totals by stage (see merge_stages)         ###
+### Outputs: None                                                           ###
+###############################################################################
+
+def write_report(output_dir, run, totals):
+
+    report = pd.DataFrame({'stage' : list(totals),
+                           'calls' : [totals[name]['calls'] for name in totals],
+                           'seconds' : [totals[name]['seconds'] for name in totals],
+                           'processes' : [len(totals[name]['pids']) for name in totals],
+                           'peak_rss_mb' : [totals[name]['peak_rss'] / 2**20 for name in totals]})
+    report['mean_seconds'] = report['seconds'] / report['calls']
+    report = report[['stage', 'calls', 'seconds', 'mean_seconds', 'processes', 'peak_rss_mb']]
+
+    report.to_csv(os.path.join(output_dir, 'run_report.csv'), index = False)
+    with open(os.path.join(output_dir, 'run_report.json'), 'w') as report_file:
+        json.dump(dict(run, stages = report.to_dict('records')), report_file, indent = 2, default = str)
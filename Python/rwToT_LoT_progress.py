@@ -0,0 +1,144 @@
+# This is a script to report the progress of a run of the line of therapy algorithm: the processes of the pool
+# send progress events to the parent over a queue, and the parent prints one progress line with the throughput
+# and the estimated time to the end of the job, and optionally writes it to a progress file
+
+import os
+import json
+import time
+import queue
+import threading
+
+progress_queue = None  # queue to the parent, set in every process of the pool by set_queue()
+interval = 10          # seconds between two progress events of a process
+pending = {'patients' : 0, 'rows' : 0}
+last_event = 0
+
+###############################################################################
+### Set queue function                                                      ###
+### function sets the queue a process sends its progress events to. Without ###
+### a queue, report() and flush() return at once                            ###
+### Inputs: 1) progress queue, 2) seconds between two progress events       ###
+### Outputs: None                                                           ###
+###############################################################################
+
+def set_queue(queue_to_parent, progress_interval = 10):
+
+    global progress_queue, interval
+    progress_queue = queue_to_parent
+    interval = progress_interval
+
+###############################################################################
+### Report and flush functions                                              ###
+### report() counts the patients and rows a process has done, and sends     ###
+### them to the parent once every interval seconds. flush() sends what is   ###
+### left at the end of a chunk                                              ###
+### Inputs: 1) progress tag of the chunk (job and superchunk), 2) number of ###
+###         patients, 3) number of rows                                     ###
+### Outputs: None                                                           ###
+###############################################################################
+
+def report(tag, patients, rows):
+
+    if progress_queue is None:
+        return
+
+    pending['patients'] = pending['patients'] + patients
+    pending['rows'] = pending['rows'] + rows
+    if time.time() - last_event >= interval:
+        flush(tag)
+
+def flush(tag):
+
+    global last_event
+    if progress_queue is None or (pending['patients'] == 0 and pending['rows'] == 0):
+        return
+
+    progress_queue.put({'job' : tag['job'], 'superchunk' : tag['superchunk'], 'pid' : os.getpid(),
+                        'patients' : pending['patients'], 'rows' : pending['rows']})
+    pending['patients'] = 0
+    pending['rows'] = 0
+    last_event = time.time()
+
+###############################################################################
+### Progress monitor                                                        ###
+### collects the progress events of one job in a thread of the parent, and  ###
+### prints a progress line every interval seconds: patients and rows done   ###
+### out of the patients and rows handed to the pool so far, the throughput  ###
+### and the estimated time to the end. Events of other jobs are ignored.    ###
+### The progress line is also written to a json file if a path is given     ###
+###############################################################################
+
+class ProgressMonitor:
+    def __init__(self, queue_from_workers, job, progress_interval = 10, path = None):
+        self.queue = queue_from_workers
+        self.job = job
+        self.interval = progress_interval
+        self.path = path
+        self.start = time.time()
+        self.progress = {'job' : job, 'superchunk' : None, 'patients_done' : 0, 'rows_done' : 0, 'patients_total' : 0, 'rows_total' : 0}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def add_work(self, superchunk, patients, rows):
+        # Patients and rows handed to the pool, e.g. when a superchunk is dispatched
+        with self.lock:
+            self.progress['superchunk'] = superchunk
+            self.progress['patients_total'] = self.progress['patients_total'] + patients
+            self.progress['rows_total'] = self.progress['rows_total'] + rows
+
+    def add_event(self, event):
+        if event['job'] != self.job:
+            return
+        with self.lock:
+            self.progress['patients_done'] = self.progress['patients_done'] + event['patients']
+            self.progress['rows_done'] = self.progress['rows_done'] + event['rows']
+
+    def get_progress(self):
+        with self.lock:
+            progress = dict(self.progress)
+        progress['elapsed'] = time.time() - self.start
+        progress['patients_per_sec'] = progress['patients_done'] / progress['elapsed'] if progress['elapsed'] > 0 else None
+        progress['rows_per_sec'] = progress['rows_done'] / progress['elapsed'] if progress['elapsed'] > 0 else None
+        progress['eta'] = None
+        if progress['patients_per_sec']:
+            progress['eta'] = (progress['patients_total'] - progress['patients_done']) / progress['patients_per_sec']
+        return progress
+
+    def write(self, progress):
+        line = ("Progress " + str(progress['job']) + ": superchunk " + str(progress['superchunk']) +
+                ", patients " + str(progress['patients_done']) + "/" + str(progress['patients_total']) +
+                ", rows " + str(progress['rows_done']) + "/" + str(progress['rows_total']) +
+                ", " + format(progress['patients_per_sec'] or 0, '.1f') + " patients/s, " + format(progress['rows_per_sec'] or 0, '.0f') + " rows/s" +
+                ", elapsed " + format(progress['elapsed'], '.0f') + " s" +
+                (", ETA " + format(progress['eta'], '.0f') + " s" if progress['eta'] is not None else ""))
+        print(line, flush = True)
+        if self.path is not None:
+            # Replaced in one step, so a reader never sees a partly written file
+            with open(self.path + '.tmp', 'w') as progress_file:
+                json.dump(progress, progress_file)
+            os.replace(self.path + '.tmp', self.path)
+
+    def run(self):
+        next_line = time.time() + self.interval
+        while not self.stopped.is_set():
+            try:
+                # A short timeout, so the thread stops soon after finish()
+                self.add_event(self.queue.get(timeout = min(max(next_line - time.time(), 0.01), 0.1)))
+            except queue.Empty:
+                pass
+            if time.time() >= next_line:
+                self.write(self.get_progress())
+                next_line = time.time() + self.interval
+
+    def finish(self):
+        # All the work of the job is done once its chunks are done, whether or not their last events arrived
+        self.stopped.set()
+        self.thread.join()
+        with self.lock:
+            self.progress['patients_done'] = self.progress['patients_total']
+            self.progress['rows_done'] = self.progress['rows_total']
+        progress = self.get_progress()
+        progress['eta'] = 0
+        self.write(progress)
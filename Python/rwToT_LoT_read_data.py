@@ -0,0 +1,293 @@
+# This is a script to read the claims data processed by the line of therapy algorithm
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is only needed for the parquet storage format
+    pa = None
+    pq = None
+
+try:
+    import sqlalchemy
+except ImportError:  # sqlalchemy is only needed to read the claims from a database
+    sqlalchemy = None
+
+STORAGE_FORMATS = ['csv', 'parquet']
+
+CLAIMS_COLUMNS = ['PATIENT_ID', 'MED_START', 'MED_END', 'MED_NAME']
+
+# Date formats of the claims files, tried in this order: ISO dates, US dates with two and four digit years, other
+# date formats, ISO dates with a time part as written by database exports, and last any ISO 8601 date and time
+DATE_FORMATS = ['%Y-%m-%d', '%m/%d/%y', '%m/%d/%Y', '%Y/%m/%d', '%Y%m%d', '%d%b%Y', '%d-%b-%Y', '%Y-%m-%d %H:%M:%S', 'ISO8601']
+
+###############################################################################
+### Check storage format function                                           ###
+### function checks that the storage format is known, and that pyarrow is   ###
+### installed when the parquet storage format is used                       ###
+### Inputs: 1) storage format, "csv" or "parquet"                           ###
+### Outputs: None                                                           ###
+###############################################################################
+
+def check_storage_format(storage_format):
+
+    if storage_format not in STORAGE_FORMATS:
+        raise ValueError("Unknown storage format " + str(storage_format) + ", expected one of " + str(STORAGE_FORMATS))
+    if storage_format == 'parquet' and pa is None:
+        raise ImportError("The parquet storage format requires pyarrow")
+
+###############################################################################
+### Get patient id type function                                           ###
+### function returns the arrow type of the patient ids: int64 for integer   ###
+### ids, string for text ids such as P10000008                              ###
+### Inputs: 1) column of patient ids, or their arrow type                   ###
+### Outputs: arrow type of the patient ids                                  ###
+###############################################################################
+
+def get_patient_id_type(patient_id):
+
+    if isinstance(patient_id, pa.DataType):
+        is_integer = pa.types.is_integer(patient_id)
+    else:
+        is_integer = pd.api.types.is_integer_dtype(patient_id)
+
+    ############# RETURN #############
+    return(pa.int64() if is_integer else pa.string())
+
+###############################################################################
+### Get claims schema function                                              ###
+### function returns the arrow schema of the claims data: integer or text   ###
+### patient ids, dates without time, and dictionary encoded drug names      ###
+### Inputs: 1) arrow type of the patient ids, int64 if None                 ###
+### Outputs: arrow schema of the claims data                                ###
+###############################################################################
+
+def get_claims_schema(patient_id = None):
+
+    ############# RETURN #############
+    return(pa.schema([('PATIENT_ID', patient_id or pa.int64()),
+                      ('MED_START', pa.date32()),
+                      ('MED_END', pa.date32()),
+                      ('MED_NAME', pa.dictionary(pa.int32(), pa.string()))]))
+
+###############################################################################
+### Claims to pandas function                                               ###
+### function casts an arrow table of claims to the claims schema and        ###
+### converts it to a dataframe with datetime64 dates                        ###
+### Inputs: 1) arrow table or record batch of claims                        ###
+### Outputs: claims dataframe                                               ###
+###############################################################################
+
+def claims_to_pandas(table):
+
+    if isinstance(table, pa.RecordBatch):
+        table = pa.Table.from_batches([table])
+    table = table.select(CLAIMS_COLUMNS)
+    table = table.cast(get_claims_schema(get_patient_id_type(table.schema.field('PATIENT_ID').type)))
+
+    ############# RETURN #############
+    return(table.to_pandas(date_as_object = False))
+
+###############################################################################
+### Read claims function                                                    ###
+### function reads the whole claims file in the given storage format        ###
+### Inputs: 1) path of the claims file, 2) storage format                   ###
+### Outputs: claims dataframe                                               ###
+###############################################################################
+
+def read_claims(path, storage_format = 'csv'):
+
+    check_storage_format(storage_format)
+
+    if storage_format == 'parquet':
+        return(claims_to_pandas(pq.read_table(path, columns = CLAIMS_COLUMNS)))
+
+    ############# RETURN #############
+    return(pd.read_csv(path, encoding = 'utf-8-sig'))
+
+###############################################################################
+### Read patient batches function                                           ###
+### function streams a claims file sorted by PATIENT_ID in chunks of        ###
+### batch_rows rows, and yields batches of complete patients (see           ###
+### get_patient_batches)                                                    ###
+### Inputs: 1) path of the claims file, 2) number of rows read at a time,   ###
+###         3) storage format                                               ###
+### Outputs: generator of claims dataframes with complete patients          ###
+###############################################################################
+
+def read_patient_batches(path, batch_rows, storage_format = 'csv'):
+
+    check_storage_format(storage_format)
+
+    if storage_format == 'parquet':
+        chunks = (claims_to_pandas(batch) for batch in pq.ParquetFile(path).iter_batches(batch_size = batch_rows, columns = CLAIMS_COLUMNS))
+    else:
+        chunks = pd.read_csv(path, chunksize = batch_rows, encoding = 'utf-8-sig')
+
+    yield from get_patient_batches(chunks, "file " + str(path))
+
+###############################################################################
+### Get patient batches function                                            ###
+### function turns chunks of claims sorted by PATIENT_ID into batches of    ###
+### complete patients. The rows of the last patient of a chunk are carried  ###
+### over to the next chunk, so a patient is never split across batches      ###
+### Inputs: 1) iterable of claims dataframes, 2) description of the source  ###
+###         of the claims, for the error message                            ###
+### Outputs: generator of claims dataframes with complete patients          ###
+###############################################################################
+
+def get_patient_batches(chunks, source):
+
+    carry = None
+
+    for chunk in chunks:
+
+        # A query without rows may still give an empty chunk
+        if len(chunk.index) == 0:
+            continue
+
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index = True)
+
+        if not chunk['PATIENT_ID'].is_monotonic_increasing:
+            raise ValueError("Streamed claims " + source + " must be sorted by PATIENT_ID")
+
+        # The last patient of the chunk may continue in the next chunk
+        is_last_patient = (chunk['PATIENT_ID'] == chunk['PATIENT_ID'].iloc[-1]).to_numpy()
+        carry = chunk[is_last_patient]
+        batch = chunk[~is_last_patient]
+
+        if len(batch.index) > 0:
+            yield batch.reset_index(drop = True)
+
+    if carry is not None:
+        yield carry.reset_index(drop = True)
+
+###############################################################################
+### Read sql functions                                                      ###
+### read_sql_claims() reads the whole result of a claims query, and         ###
+### read_sql_batches() streams it in chunks of batch_rows rows through a    ###
+### server side cursor (where the database driver has one), and yields     ###
+### batches of complete patients (see get_patient_batches), so the result   ###
+### is never held in memory as a whole. The query must return the columns   ###
+### PATIENT_ID, MED_START, MED_END and MED_NAME (in any case), and be       ###
+### ordered by PATIENT_ID and MED_START to be streamed                      ###
+### Inputs: 1) sqlalchemy connection url, e.g. sqlite:///claims.db,         ###
+###         2) claims query, 3) number of rows fetched at a time            ###
+### Outputs: claims dataframe (read_sql_claims), generator of claims        ###
+###          dataframes with complete patients (read_sql_batches)           ###
+###############################################################################
+
+def check_sql():
+
+    if sqlalchemy is None:
+        raise ImportError("Reading the claims from a database requires sqlalchemy")
+
+def read_sql_claims(url, query):
+
+    check_sql()
+    engine = sqlalchemy.create_engine(url)
+    try:
+        with engine.connect() as connection:
+            claims = pd.read_sql_query(sqlalchemy.text(query), connection)
+    finally:
+        engine.dispose()
+
+    ############# RETURN #############
+    return(claims.rename(columns = lambda column : str(column).upper()))
+
+def read_sql_batches(url, query, batch_rows):
+
+    check_sql()
+    engine = sqlalchemy.create_engine(url)
+    try:
+        with engine.connect().execution_options(stream_results = True, max_row_buffer = batch_rows) as connection:
+            chunks = pd.read_sql_query(sqlalchemy.text(query), connection, chunksize = batch_rows)
+            chunks = (chunk.rename(columns = lambda column : str(column).upper()) for chunk in chunks)
+            yield from get_patient_batches(chunks, "of the query " + query)
+    finally:
+        engine.dispose()
+
+###############################################################################
+### Detect date format function                                             ###
+### function finds the first of DATE_FORMATS that parses a sample of the    ###
+### distinct dates of a column, so a file is parsed with one fixed format   ###
+### instead of inferring the format of every date                           ###
+### Inputs: 1) column of dates as text, 2) number of distinct dates tried   ###
+### Outputs: date format, or None if the column already holds dates         ###
+###############################################################################
+
+def detect_date_format(values, sample_size = 1000):
+
+    values = pd.Series(values)
+    if pd.api.types.is_datetime64_any_dtype(values) or pd.api.types.is_datetime64_any_dtype(values.dtype):
+        return(None)
+
+    sample = pd.Series(values.dropna().unique()[:sample_size], dtype = object).astype(str).str.strip()
+    for date_format in DATE_FORMATS:
+        if pd.to_datetime(sample, format = date_format, errors = 'coerce').notna().all():
+            return(date_format)
+
+    ############# RETURN #############
+    raise ValueError("Unknown date format of dates like " + str(list(sample[:3])) + ", expected one of " + str(DATE_FORMATS))
+
+###############################################################################
+### Parse dates function                                                    ###
+### function converts a column of dates as text to datetime64 dates, at     ###
+### the resolution of seconds, the coarsest one pandas supports. Claims     ###
+### repeat the same dates many times, so every distinct date is parsed once ###
+### with the fixed date format and the parsed dates are then looked up by   ###
+### their position in the distinct dates                                    ###
+### Inputs: 1) column of dates, 2) date format (see detect_date_format),    ###
+###         None to detect it                                               ###
+### Outputs: column of datetime64 dates                                     ###
+###############################################################################
+
+def parse_dates(values, date_format = None):
+
+    values = pd.Series(values)
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return(values.astype('datetime64[s]'))
+
+    if date_format is None:
+        date_format = detect_date_format(values)
+
+    codes, dates = pd.factorize(values)
+    dates = pd.to_datetime(pd.Series(dates, dtype = object).astype(str).str.strip(), format = date_format).to_numpy(dtype = 'datetime64[s]')
+
+    # Missing dates have the code -1, which picks the NaT added at the end
+    dates = np.append(dates, np.datetime64('NaT', 's'))
+
+    ############# RETURN #############
+    return(pd.Series(dates[codes], index = values.index, name = values.name))
+
+###############################################################################
+### Normalize claims function                                               ###
+### function turns claims as read from a file into the typed claims both    ###
+### main scripts work on: the claims columns without a byte order mark in   ###
+### their names, datetime64 dates, lower case drug names, and no duplicate  ###
+### rows                                                                    ###
+### Inputs: 1) claims dataframe, 2) date format, None to detect it          ###
+### Outputs: typed claims dataframe                                         ###
+###############################################################################
+
+def normalize_claims(df, date_format = None):
+
+    df = df.rename(columns = {column : str(column).lstrip('\ufeff').strip() for column in df.columns})
+    missing = [column for column in CLAIMS_COLUMNS if column not in df.columns]
+    if missing:
+        raise ValueError("Claims are missing the columns " + str(missing))
+
+    # One date format for both date columns
+    if date_format is None:
+        date_format = detect_date_format(df['MED_START'])
+
+    claims = pd.DataFrame({'PATIENT_ID' : df['PATIENT_ID'].to_numpy(),
+                           'MED_START' : parse_dates(df['MED_START'], date_format).to_numpy(),
+                           'MED_END' : parse_dates(df['MED_END'], date_format).to_numpy(),
+                           'MED_NAME' : df['MED_NAME'].str.lower().to_numpy()})
+
+    ############# RETURN #############
+    return(claims.drop_duplicates().reset_index(drop = True))
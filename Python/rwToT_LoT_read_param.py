@@ -1,42 +1,67 @@
 # This is a script to import csv files that contain special cases used in determining line of therapy
 
 import pandas as pd
-from sqlalchemy import create_engine
 
-def cases(indication):
+import rwToT_LoT_functions as fn
+
+def cases(indication, reference_dir = 'reference'):
+
+    # Special cases of the indication, read from reference_dir/<INDICATION>/
 
     class Cases():
         def __init__(self, indication = indication):
 
+            self.indication = indication.upper()
+
             # General parameters
             
-            par_general = pd.read_csv('reference/' + indication.upper() + '/par_general.csv')
+            par_general = pd.read_csv(reference_dir + '/' + indication.upper() + '/par_general.csv')
             par_general = par_general[['r_window', 'l_disgap', 'drug_switch_ignore', 'combo_dropped_line_advance']].reset_index(drop = True)
             self.par_general = par_general
             
            # This imports special cases for line name (i.e. If within 28 days 
             # patient switches to EGFR, ALK, PD-1/PD-L1, then regimen is called that)
-            line_name = pd.read_csv('reference/' + indication.upper() + '/line_name.csv')
+            line_name = pd.read_csv(reference_dir + '/' + indication.upper() + '/line_name.csv')
             line_name = line_name[['treatment']].reset_index(drop = True)
             self.line_name = line_name 
 
             # This imports special cases for drug substitutions/additions that do not advance the line of therapy            
-            line_substitutions = pd.read_csv('reference/' + indication.upper() + '/line_substitutions.csv')   
+            line_substitutions = pd.read_csv(reference_dir + '/' + indication.upper() + '/line_substitutions.csv')   
             line_substitutions = line_substitutions[['original', 'substitute']].reset_index(drop = True)
             self.line_substitutions = line_substitutions
-            line_additions = pd.read_csv('reference/' + indication.upper() + '/line_additions.csv')    
+            line_additions = pd.read_csv(reference_dir + '/' + indication.upper() + '/line_additions.csv')    
             #line_additions = line_additions[line_additions['indication'] == indication.upper()].applymap(str.upper)
             line_additions = line_additions[['drug_name']].reset_index(drop = True)
             self.line_additions = line_additions
         
             # This imports special cases for drugs eligible to be considered maintenance therapy
-            line_maintenance = pd.read_csv('reference/' + indication.upper() + '/line_maintenance.csv')    
+            line_maintenance = pd.read_csv(reference_dir + '/' + indication.upper() + '/line_maintenance.csv')    
             line_maintenance = line_maintenance[['drug_name', 'maintenance_type']].reset_index(drop = True)
             self.line_maintenance = line_maintenance
         
             # This imports special cases for drugs that are not affected by an episode gap
-            episode_gap = pd.read_csv('reference/' + indication.upper() + '/episode_gap.csv')    
+            episode_gap = pd.read_csv(reference_dir + '/' + indication.upper() + '/episode_gap.csv')    
             episode_gap = episode_gap[['drug_name']].reset_index(drop = True)
             self.episode_gap = episode_gap
 
+            # Special cases compiled into hashed lookups used by the eligibility checks
+            self.rules = fn.compile_rules(self.line_substitutions, self.line_additions, self.line_maintenance, self.episode_gap, self.line_name)
+
     return(Cases(indication))
+
+def parameter_sets(path):
+
+    # Sets of general parameters of a parameter sweep, one per row, in the columns of par_general.csv
+    sweep = pd.read_csv(path)
+    sweep = sweep[['r_window', 'l_disgap', 'drug_switch_ignore', 'combo_dropped_line_advance']].reset_index(drop = True)
+
+    for flag in ['drug_switch_ignore', 'combo_dropped_line_advance']:
+        if sweep[flag].dtype != bool:
+            raise ValueError("Column " + flag + " of the parameter sweep " + str(path) + " must be True or False")
+
+    sets = [{'r_window' : int(row.r_window),
+             'l_disgap' : int(row.l_disgap),
+             'drug_switch_ignore' : bool(row.drug_switch_ignore),
+             'combo_dropped_line_advance' : bool(row.combo_dropped_line_advance)} for row in sweep.itertuples()]
+
+    return(sets)
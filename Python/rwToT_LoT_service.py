@@ -0,0 +1,310 @@
+# This is a script to run the line of therapy algorithm as a long running local service: the special cases of
+# the indications are loaded once into a pool of worker processes kept alive, and batches of claims rows sent
+# over http, on a local port or a unix socket, are answered with their lines of therapy
+
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import threading
+import collections
+import multiprocessing
+import socketserver
+import http.server
+import numpy as np
+import pandas as pd
+
+import rwToT_LoT_engine as en
+import rwToT_LoT_read_data as rd
+
+HOST = "127.0.0.1"  #  The service only listens on the local machine
+PORT = 8765
+NWORKERS = 2        #  Worker processes of the pool, 0 processes the requests in the service process itself
+LATENCY_WINDOW = 1000  #  The latency metrics are computed over the last LATENCY_WINDOW requests
+
+
+engines = {}  # line of therapy engine of every indication of the service, by indication, built once per process by init_worker
+engine_lock = threading.Lock()
+
+###############################################################################
+### Init worker function                                                    ###
+### function builds the line of therapy engine of every indication of the   ###
+### service once, in every worker process of the pool and in the service    ###
+### process, with the general parameters of par_general.csv                  ###
+### Inputs: 1) list of indications                                          ###
+### Outputs: None                                                           ###
+###############################################################################
+
+def init_worker(indications):
+
+    for indication in indications:
+        engines[indication.upper()] = en.LineOfTherapyEngine(indication)
+    print("Process", os.getpid(), "loaded the special cases for", list(engines), flush = True)
+
+def init_pool_worker(indications):
+
+    # Ctrl-C and SIGTERM reach the whole process group. The workers leave them to the service process,
+    # which closes the pool: a worker killed while it waits for a task would leave the pool locked
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    init_worker(indications)
+
+###############################################################################
+### Get records function                                                    ###
+### function turns an output dataframe into a list of records that can be  ###
+### written as json: dates as YYYY-MM-DD and missing values as null         ###
+### Inputs: 1) output dataframe                                             ###
+### Outputs: list of records                                                ###
+###############################################################################
+
+def get_records(df):
+
+    df = df.copy()
+    for column in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = df[column].dt.strftime('%Y-%m-%d')
+    df = df.astype(object)
+
+    ############# RETURN #############
+    return(df.where(df.notna(), None).to_dict('records'))
+
+###############################################################################
+### Process claims function                                                 ###
+### function returns the lines of therapy and doses of a batch of claims     ###
+### rows, run by a worker process with the engine of the indication         ###
+### Inputs: 1) indication, 2) claims rows, as a list of records or a        ###
+###         dictionary of columns PATIENT_ID, MED_START, MED_END, MED_NAME  ###
+### Outputs: dictionary of the output_lot and output_doses records, and the ###
+###          patients, rows and seconds of the batch                        ###
+###############################################################################
+
+def process_claims(indication, claims):
+
+    start = time.perf_counter()
+    engine = engines.get(str(indication).upper())
+    if engine is None:
+        raise ValueError("The service has no special cases loaded for " + str(indication) + ", only for " + str(list(engines)))
+
+    # An empty batch has no columns, and is answered with empty lines and doses
+    if len(claims) == 0:
+        claims = pd.DataFrame(columns = rd.CLAIMS_COLUMNS)
+    else:
+        claims = pd.DataFrame(claims)
+    output_lot, output_doses = engine.process_frame(claims)
+
+    ############# RETURN #############
+    return({'output_lot' : get_records(output_lot),
+            'output_doses' : get_records(output_doses),
+            'patients' : int(output_lot['PATIENT_ID'].nunique()),
+            'rows' : len(claims.index),
+            'seconds' : time.perf_counter() - start})
+
+###############################################################################
+### Service metrics                                                         ###
+### counts the requests, errors, patients and rows of the service, the      ###
+### requests in flight and the requests queued for a worker, and the        ###
+### latency of the last LATENCY_WINDOW requests, from the request being     ###
+### read to its response being ready                                        ###
+###############################################################################
+
+class ServiceMetrics:
+    def __init__(self, nworkers):
+        self.nworkers = nworkers
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.patients = 0
+        self.rows = 0
+        self.in_flight = 0
+        self.latencies = collections.deque(maxlen = LATENCY_WINDOW)
+
+    def begin(self):
+        with self.lock:
+            self.in_flight = self.in_flight + 1
+
+    def end(self, seconds, result = None):
+        with self.lock:
+            self.in_flight = self.in_flight - 1
+            self.requests = self.requests + 1
+            self.latencies.append(seconds)
+            if result is None:
+                self.errors = self.errors + 1
+            else:
+                self.patients = self.patients + result['patients']
+                self.rows = self.rows + result['rows']
+
+    def get_metrics(self):
+        with self.lock:
+            latencies = np.array(self.latencies)
+            metrics = {'uptime' : time.time() - self.start,
+                       'workers' : self.nworkers,
+                       'indications' : sorted(engines),
+                       'requests' : self.requests,
+                       'errors' : self.errors,
+                       'patients' : self.patients,
+                       'rows' : self.rows,
+                       'in_flight' : self.in_flight,
+                       # Requests waiting for a free worker
+                       'queue_depth' : max(self.in_flight - max(self.nworkers, 1), 0)}
+        for name, quantile in [('latency_p50', 0.5), ('latency_p95', 0.95), ('latency_p99', 0.99)]:
+            metrics[name] = float(np.quantile(latencies, quantile)) if len(latencies) else None
+        metrics['latency_mean'] = float(latencies.mean()) if len(latencies) else None
+        metrics['latency_max'] = float(latencies.max()) if len(latencies) else None
+        return metrics
+
+###############################################################################
+### Request handler                                                         ###
+### POST /lines with a json body {"indication" : ..., "claims" : [...]}     ###
+### answers the lines of therapy of the claims (see process_claims).        ###
+### GET /metrics answers the service metrics and GET /health answers ok.    ###
+### Bad requests are answered with status 400 and the error                 ###
+###############################################################################
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+
+    # Connections are kept alive between requests, every response has a Content-Length
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, status, body):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {'status' : 'ok'})
+        elif self.path == '/metrics':
+            self.send_json(200, self.server.metrics.get_metrics())
+        else:
+            self.send_json(404, {'error' : "Unknown path " + self.path})
+
+    def do_POST(self):
+        if self.path != '/lines':
+            self.send_json(404, {'error' : "Unknown path " + self.path})
+            return
+
+        start = time.perf_counter()
+        self.server.metrics.begin()
+        result = None
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if not isinstance(request, dict) or 'indication' not in request or 'claims' not in request:
+                raise ValueError("The request must be a json object with an indication and claims")
+            result = self.server.process(request['indication'], request['claims'])
+            status = 200
+            body = result
+        except (ValueError, KeyError, TypeError) as error:
+            status = 400
+            body = {'error' : type(error).__name__ + ": " + str(error)}
+        except Exception as error:
+            status = 500
+            body = {'error' : type(error).__name__ + ": " + str(error)}
+        self.server.metrics.end(time.perf_counter() - start, result)
+        self.send_json(status, body)
+
+    def address_string(self):
+        # A unix socket has no client address
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            sys.stderr.write(self.address_string() + " - " + format % args + "\n")
+
+class ServiceMixIn(socketserver.ThreadingMixIn):
+    daemon_threads = True
+
+    def setup_service(self, pool, nworkers, quiet):
+        self.pool = pool
+        self.metrics = ServiceMetrics(nworkers)
+        self.quiet = quiet
+
+    def process(self, indication, claims):
+        # Every request thread waits for its batch on a worker of the pool. Without a pool, the engines of the
+        # service process are used by one request at a time
+        if self.pool is not None:
+            return self.pool.apply(process_claims, (indication, claims))
+        with engine_lock:
+            return process_claims(indication, claims)
+
+class TCPService(ServiceMixIn, http.server.HTTPServer):
+    pass
+
+class UnixService(ServiceMixIn, socketserver.UnixStreamServer):
+    pass
+
+###############################################################################
+### Start service function                                                  ###
+### function loads the special cases of the indications, starts the pool of ###
+### worker processes and the http server, on a local port or on a unix      ###
+### socket if a socket path is given. The server handles every request in a ###
+### thread; serve_forever() runs it                                         ###
+### Inputs: 1) list of indications, 2) number of worker processes,          ###
+###         3) port, 4) unix socket path, 5) quiet (no request log)         ###
+### Outputs: server                                                         ###
+###############################################################################
+
+def start_service(indications, nworkers = NWORKERS, port = PORT, socket_path = None, quiet = False):
+
+    indications = sorted(set(indication.upper() for indication in indications))
+
+    # The service process loads the special cases too, so missing reference files fail here rather than in the pool
+    init_worker(indications)
+
+    pool = None
+    if nworkers > 0:
+        ctx = multiprocessing.get_context('spawn')
+        pool = ctx.Pool(nworkers, initializer = init_pool_worker, initargs = (indications,))
+
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixService(socket_path, RequestHandler)
+    else:
+        server = TCPService((HOST, port), RequestHandler)
+    server.setup_service(pool, nworkers, quiet)
+
+    ############# RETURN #############
+    return(server)
+
+def stop_service(server):
+
+    server.server_close()
+    if server.pool is not None:
+        server.pool.close()
+        server.pool.join()
+    if isinstance(server, UnixService) and os.path.exists(server.server_address):
+        os.remove(server.server_address)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Serve the lines of therapy of batches of claims on a local port or unix socket")
+    parser.add_argument('indications', nargs = '+')
+    parser.add_argument('--port', type = int, default = PORT)
+    parser.add_argument('--socket', default = None, help = "unix socket path, instead of the local port")
+    parser.add_argument('--workers', type = int, default = NWORKERS, help = "worker processes, 0 processes the requests in the service process")
+    parser.add_argument('--quiet', action = 'store_true', help = "don't log the requests")
+    args = parser.parse_args()
+
+    server = start_service(args.indications, args.workers, args.port, args.socket, args.quiet)
+    print("Serving the lines of therapy of", sorted(engines), "on", args.socket or (HOST + ":" + str(args.port)),
+          "with", args.workers, "worker processes", flush = True)
+
+    # SIGTERM stops the service like Ctrl-C, so the pool and the unix socket are cleaned up
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target = server.shutdown).start())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_service(server)
+
+
+if __name__ == '__main__':
+    main()
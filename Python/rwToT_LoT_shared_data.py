@@ -0,0 +1,140 @@
+# This is a script to share the claims data of a superchunk with the worker processes
+
+import pickle
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+
+SHARED_COLUMNS = ['PATIENT_ID', 'MED_START', 'MED_END', 'DRUG_CODE']
+
+vocabulary_cache = {'name' : None, 'vocabulary' : None}  # drug vocabulary of the superchunk, read once per process by attach_vocabulary
+
+###############################################################################
+### Share claims function                                                   ###
+### function copies the columns needed by the line scan into shared memory  ###
+### blocks, one block per column. MED_NAME is not shared, since it is       ###
+### given by DRUG_CODE and the drug vocabulary, which is pickled into a     ###
+### block of its own, so it isn't sent with every chunk. Patient ids that   ###
+### are not numbers can't be put in shared memory and are left to be sent   ###
+### with every chunk (see get_shared_chunk)                                 ###
+### Inputs: 1) claims dataframe with DRUG_CODE, 2) drug vocabulary          ###
+### Outputs: dictionary with the shared memory blocks, the column           ###
+###          descriptors (block name, dtype, number of rows), the           ###
+###          vocabulary descriptor (block name, size) and the patient ids   ###
+###          that are not shared                                            ###
+###############################################################################
+
+def share_claims(df, vocabulary = None):
+
+    blocks = []
+    columns = {}
+    patient_id = None
+
+    for column in SHARED_COLUMNS:
+        values = df[column].to_numpy()
+        if column == 'PATIENT_ID' and values.dtype.kind not in 'iuf':
+            patient_id = values
+            continue
+        # A shared memory block can't be empty
+        block = shared_memory.SharedMemory(create = True, size = max(values.nbytes, 1))
+        np.ndarray(values.shape, dtype = values.dtype, buffer = block.buf)[:] = values
+        blocks.append(block)
+        columns[column] = (block.name, values.dtype.str, len(values))
+
+    shared_vocabulary = None
+    if vocabulary is not None:
+        payload = pickle.dumps(vocabulary, protocol = pickle.HIGHEST_PROTOCOL)
+        block = shared_memory.SharedMemory(create = True, size = len(payload))
+        block.buf[:len(payload)] = payload
+        blocks.append(block)
+        shared_vocabulary = (block.name, len(payload))
+
+    ############# RETURN #############
+    return({'blocks' : blocks, 'columns' : columns, 'vocabulary' : shared_vocabulary, 'patient_id' : patient_id})
+
+###############################################################################
+### Get shared chunk function                                               ###
+### function returns the small descriptor a worker needs to read its chunk, ###
+### rows start to stop of the shared claims                                 ###
+### Inputs: 1) shared claims (see share_claims), 2) first row, 3) end row   ###
+### Outputs: dictionary with the column and vocabulary descriptors, the     ###
+###          row range and the patient ids of the chunk if they are not     ###
+###          shared                                                         ###
+###############################################################################
+
+def get_shared_chunk(shared, start, stop):
+
+    patient_id = None
+    if shared['patient_id'] is not None:
+        patient_id = shared['patient_id'][start:stop]
+
+    ############# RETURN #############
+    return({'columns' : shared['columns'], 'vocabulary' : shared['vocabulary'], 'start' : start, 'stop' : stop, 'patient_id' : patient_id})
+
+###############################################################################
+### Attach vocabulary function                                              ###
+### function reads the drug vocabulary of the superchunk of a chunk from    ###
+### shared memory. It is unpickled once per process and superchunk, and    ###
+### kept for the next chunks of the superchunk                              ###
+### Inputs: 1) shared chunk (see get_shared_chunk)                          ###
+### Outputs: drug vocabulary                                                ###
+###############################################################################
+
+def attach_vocabulary(shared_chunk):
+
+    name, size = shared_chunk['vocabulary']
+    if vocabulary_cache['name'] != name:
+        block = shared_memory.SharedMemory(name = name)
+        payload = bytes(block.buf[:size])
+        block.close()
+        vocabulary_cache['vocabulary'] = pickle.loads(payload)
+        vocabulary_cache['name'] = name
+
+    ############# RETURN #############
+    return(vocabulary_cache['vocabulary'])
+
+###############################################################################
+### Attach claims function                                                  ###
+### function attaches a worker to the shared memory blocks and copies the   ###
+### rows of its chunk into a claims dataframe. The rows are copied rather   ###
+### than viewed: the blocks are closed here and unlinked by the parent      ###
+### after the superchunk, while pandas may keep views of the columns in the ###
+### frames derived from the chunk (an already sorted chunk is not copied by ###
+### sort_values under copy on write), which would then point to unmapped    ###
+### memory. The copy is of the rows of the chunk only, and the dataframe    ###
+### takes the copied columns without copying them again                    ###
+### Inputs: 1) shared chunk (see get_shared_chunk), 2) drug vocabulary      ###
+### Outputs: claims dataframe of the chunk                                  ###
+###############################################################################
+
+def attach_claims(shared_chunk, vocabulary):
+
+    start = shared_chunk['start']
+    stop = shared_chunk['stop']
+    data = {}
+
+    for column, (name, dtype, length) in shared_chunk['columns'].items():
+        block = shared_memory.SharedMemory(name = name)
+        data[column] = np.ndarray((length, ), dtype = np.dtype(dtype), buffer = block.buf)[start:stop].copy()
+        block.close()
+
+    if shared_chunk['patient_id'] is not None:
+        data['PATIENT_ID'] = shared_chunk['patient_id']
+
+    data['MED_NAME'] = vocabulary['names'][data['DRUG_CODE']]
+
+    ############# RETURN #############
+    return(pd.DataFrame(data, columns = ['PATIENT_ID', 'MED_START', 'MED_END', 'MED_NAME', 'DRUG_CODE'], copy = False))
+
+###############################################################################
+### Release claims function                                                 ###
+### function frees the shared memory blocks once all chunks are processed   ###
+### Inputs: 1) shared claims (see share_claims)                             ###
+### Outputs: None                                                           ###
+###############################################################################
+
+def release_claims(shared):
+
+    for block in shared['blocks']:
+        block.close()
+        block.unlink()
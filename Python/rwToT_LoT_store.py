@@ -0,0 +1,139 @@
+# This is a script to keep the state of incremental runs of the line of therapy algorithm:
+# a content hash of every patient's claims, and a key of the special cases and parameters of the run
+
+import os
+import glob
+import hashlib
+import numpy as np
+import pandas as pd
+
+STORE_VERSION = '2'  # to be changed whenever the algorithm changes its output for the same claims
+
+###############################################################################
+### Get patient hashes function                                             ###
+### function computes a content hash of the claims of every patient, over   ###
+### the patient's MED_START, MED_END and MED_NAME rows in sorted order, so  ###
+### a patient's hash only changes when the patient's history changes       ###
+### Inputs: 1) claims dataframe                                             ###
+### Outputs: series of patient hashes (int64) indexed by PATIENT_ID         ###
+###############################################################################
+
+def get_patient_hashes(df):
+
+    df = df[['PATIENT_ID', 'MED_START', 'MED_END', 'MED_NAME']].sort_values(['PATIENT_ID', 'MED_START', 'MED_END', 'MED_NAME'], kind = 'mergesort')
+    patient_ids = df['PATIENT_ID'].to_numpy()
+
+    is_first_row = np.ones(len(patient_ids), dtype = bool)
+    is_first_row[1:] = patient_ids[1:] != patient_ids[:-1]
+    starts = np.flatnonzero(is_first_row)
+    if len(starts) == 0:
+        return(pd.Series([], dtype = np.int64))
+
+    # Every row is hashed with its position within the patient, and the row hashes of a patient are summed,
+    # so the patient hash depends on the order of the rows. Dates are hashed at a fixed resolution
+    position = np.arange(len(patient_ids)) - np.repeat(starts, np.diff(np.append(starts, len(patient_ids))))
+    rows = pd.DataFrame({'POSITION' : position,
+                         'MED_START' : df['MED_START'].to_numpy().astype('datetime64[ns]'),
+                         'MED_END' : df['MED_END'].to_numpy().astype('datetime64[ns]'),
+                         'MED_NAME' : df['MED_NAME'].astype(str).to_numpy()})
+    row_hash = pd.util.hash_pandas_object(rows, index = False).to_numpy()
+
+    ############# RETURN #############
+    return(pd.Series(np.add.reduceat(row_hash, starts).view(np.int64), index = patient_ids[starts]))
+
+###############################################################################
+### Get run key function                                                    ###
+### function computes a key of everything besides the claims that the      ###
+### output depends on: the special cases files of the indication and the    ###
+### run parameters. Stored results are only reused under the same key       ###
+### Inputs: 1) indication, 2) dictionary of run parameters                  ###
+### Outputs: run key (hex string)                                           ###
+###############################################################################
+
+def get_run_key(indication, parameters):
+
+    key = hashlib.sha256(('version ' + STORE_VERSION + '\n').encode())
+
+    for path in sorted(glob.glob('reference/' + indication.upper() + '/*')):
+        key.update(os.path.basename(path).encode() + b'\n')
+        with open(path, 'rb') as reference:
+            key.update(reference.read())
+
+    for name in sorted(parameters):
+        key.update((name + ' ' + str(parameters[name]) + '\n').encode())
+
+    ############# RETURN #############
+    return(key.hexdigest())
+
+###############################################################################
+### Read store function                                                     ###
+### function reads the run key and patient hashes of the previous run       ###
+### Inputs: 1) store directory                                              ###
+### Outputs: dictionary with the run key and the patient hashes, or None    ###
+###          if there is no previous run                                    ###
+###############################################################################
+
+def read_store(store_dir):
+
+    run_key_path = os.path.join(store_dir, 'run_key.txt')
+    hashes_path = os.path.join(store_dir, 'patient_hashes.csv')
+    if not (os.path.exists(run_key_path) and os.path.exists(hashes_path)):
+        return(None)
+
+    with open(run_key_path, 'r') as run_key_file:
+        run_key = run_key_file.read().strip()
+    hashes = pd.read_csv(hashes_path, dtype = {'PATIENT_ID' : str})
+
+    ############# RETURN #############
+    return({'run_key' : run_key, 'hashes' : pd.Series(hashes['PATIENT_HASH'].to_numpy(np.int64), index = hashes['PATIENT_ID'].to_numpy())})
+
+###############################################################################
+### Invalidate store function                                               ###
+### function removes the run key of the previous run before its output is   ###
+### overwritten, so an interrupted run leaves no valid store behind         ###
+### Inputs: 1) store directory                                              ###
+### Outputs: None                                                           ###
+###############################################################################
+
+def invalidate_store(store_dir):
+
+    run_key_path = os.path.join(store_dir, 'run_key.txt')
+    if os.path.exists(run_key_path):
+        os.remove(run_key_path)
+
+###############################################################################
+### Write store function                                                    ###
+### function writes the run key and patient hashes of the run. The run key  ###
+### is written last, once the output of the run is complete                 ###
+### Inputs: 1) store directory, 2) run key, 3) patient hashes               ###
+### Outputs: None                                                           ###
+###############################################################################
+
+def write_store(store_dir, run_key, hashes):
+
+    os.makedirs(store_dir, exist_ok = True)
+    run_key_path = os.path.join(store_dir, 'run_key.txt')
+
+    pd.DataFrame({'PATIENT_ID' : hashes.index, 'PATIENT_HASH' : hashes.to_numpy()}).to_csv(os.path.join(store_dir, 'patient_hashes.csv'), index = False)
+    with open(run_key_path, 'w') as run_key_file:
+        run_key_file.write(run_key + '\n')
+
+###############################################################################
+### Get unchanged patients function                                         ###
+### function compares the patient hashes of the claims with the stored      ###
+### ones of the previous run                                                ###
+### Inputs: 1) patient hashes, 2) stored run (see read_store), 3) run key   ###
+### Outputs: array of the patients whose stored results can be reused       ###
+###############################################################################
+
+def get_unchanged_patients(hashes, store, run_key):
+
+    if store is None or store['run_key'] != run_key:
+        return(hashes.index[:0].to_numpy())
+
+    # Patient ids are compared as text, as they are read back from the store
+    position = pd.Index(store['hashes'].index).get_indexer(hashes.index.astype(str))
+    is_unchanged = (position >= 0) & (store['hashes'].to_numpy()[position] == hashes.to_numpy())
+
+    ############# RETURN #############
+    return(hashes.index[is_unchanged].to_numpy())
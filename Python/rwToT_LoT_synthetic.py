@@ -0,0 +1,221 @@
+# This is a script to generate synthetic claims data for the line of therapy algorithm,
+# with the drugs of an indication's special cases, to measure the throughput of the algorithm
+
+import os
+import sys
+import glob
+import numpy as np
+import pandas as pd
+
+import rwToT_LoT_read_data as rd
+import rwToT_LoT_write_data as wd
+
+RECORD_DISTRIBUTIONS = ['poisson', 'geometric', 'lognormal']
+
+###############################################################################
+### Get reference drugs function                                            ###
+### function collects the drug vocabulary of an indication from the special ###
+### cases files in reference/<INDICATION>, by the role the drugs play in    ###
+### the special cases: substitutions, additions, maintenance drugs and      ###
+### drugs not affected by an episode gap (oral drugs with refills). Drug    ###
+### names of a med name reference file are added as other drugs             ###
+### Inputs: 1) indication                                                   ###
+### Outputs: dictionary with the lower case drug names of every role        ###
+###############################################################################
+
+def get_reference_drugs(indication):
+
+    drugs = {'substitutions' : [], 'additions' : [], 'maintenance' : [], 'episode_gap' : [], 'other' : []}
+
+    for path in sorted(glob.glob('reference/' + indication.upper() + '/*.csv')):
+        name = os.path.basename(path)[:-len('.csv')]
+        table = pd.read_csv(path, encoding = 'utf-8-sig')
+        table.columns = [column.lower() for column in table.columns]
+        if name.endswith('substitutions'):
+            drugs['substitutions'] = list(zip(table['original'].str.lower(), table['substitute'].str.lower()))
+        elif name.endswith('additions'):
+            drugs['additions'] = list(table['drug_name'].str.lower())
+        elif name.endswith('maintenance'):
+            drugs['maintenance'] = list(table['drug_name'].str.lower())
+        elif name.endswith('episode_gap'):
+            drugs['episode_gap'] = list(table['drug_name'].str.lower())
+        elif name.endswith('med_name'):
+            if 'ind_exclude' in table.columns:
+                table = table[table['ind_exclude'] == 0]
+            drugs['other'] = list(table['standard_name'].str.lower())
+
+    for role in ['additions', 'maintenance', 'episode_gap', 'other']:
+        drugs[role] = list(dict.fromkeys(drugs[role]))
+
+    # Every drug that is not taken orally can be given as an infusion
+    special = set(drug for pair in drugs['substitutions'] for drug in pair) | set(drugs['additions']) | set(drugs['maintenance'])
+    drugs['infusion'] = sorted((special | set(drugs['other'])) - set(drugs['episode_gap']))
+    if len(drugs['infusion']) == 0 and len(drugs['episode_gap']) == 0:
+        raise ValueError("No drugs found in the special cases of " + str(indication))
+
+    ############# RETURN #############
+    return(drugs)
+
+###############################################################################
+### Get records per patient function                                        ###
+### function draws the number of records of every patient from the given   ###
+### distribution with the given mean, at least one record per patient       ###
+### Inputs: 1) random generator, 2) number of patients, 3) mean number of   ###
+###         records, 4) distribution, "poisson", "geometric" or "lognormal" ###
+### Outputs: array of the numbers of records of the patients                ###
+###############################################################################
+
+def get_records_per_patient(rng, npatients, mean_records, distribution = 'lognormal'):
+
+    if distribution not in RECORD_DISTRIBUTIONS:
+        raise ValueError("Unknown distribution of records per patient " + str(distribution) + ", expected one of " + str(RECORD_DISTRIBUTIONS))
+
+    if distribution == 'poisson':
+        records = rng.poisson(mean_records, npatients)
+    elif distribution == 'geometric':
+        records = rng.geometric(1 / max(mean_records, 1), npatients)
+    else:
+        # A heavy tail of patients with long treatment histories, as in real claims
+        sigma = 0.8
+        records = rng.lognormal(np.log(mean_records) - sigma**2 / 2, sigma, npatients)
+
+    ############# RETURN #############
+    return(np.maximum(np.round(records).astype(np.int64), 1))
+
+###############################################################################
+### Get line claims function                                                ###
+### function generates the claims of one line of therapy starting on day    ###
+### start: a combination with a substitution within the line and a drop to  ###
+### continuation maintenance, a monotherapy given in cycles, or an oral     ###
+### drug refilled every month. Drugs may be added within the line, and      ###
+### some claims are a few days off the cycle                                ###
+### Inputs: 1) random generator, 2) reference drugs, 3) first day of the    ###
+###         line                                                            ###
+### Outputs: dictionary with the days and drug names of the claims, and     ###
+###          the day after the last claim                                   ###
+###############################################################################
+
+def get_line_claims(rng, drugs, start):
+
+    days = []
+    names = []
+    pattern = rng.random()
+
+    if pattern < 0.2 and len(drugs['episode_gap']) > 0 or len(drugs['infusion']) == 0:
+        # Oral drug, refilled every month
+        drug = drugs['episode_gap'][rng.integers(len(drugs['episode_gap']))]
+        for cycle in range(int(rng.integers(2, 13))):
+            days.append(start + 30 * cycle + int(rng.integers(-2, 3)))
+            names.append(drug)
+        return({'days' : days, 'names' : names, 'end' : max(days) + 30})
+
+    step = int(rng.choice([14, 21, 28]))
+    ncycles = int(rng.integers(1, 13))
+
+    if pattern < 0.6 and len(drugs['substitutions']) > 0:
+        # Combination of a drug that can be substituted and a partner, often a maintenance drug
+        original, substitute = drugs['substitutions'][rng.integers(len(drugs['substitutions']))]
+        partners = [drug for drug in drugs['maintenance'] + drugs['infusion'] if drug not in (original, substitute)]
+        regimen = [original] + ([partners[rng.integers(len(partners))]] if partners else [])
+        switch_cycle = int(rng.integers(1, ncycles + 1)) if rng.random() < 0.2 else None
+        maintenance_cycle = 4 if len(regimen) > 1 and regimen[1] in drugs['maintenance'] and rng.random() < 0.5 else None
+        if maintenance_cycle is not None:
+            ncycles = ncycles + int(rng.integers(2, 9))
+    else:
+        # Monotherapy
+        regimen = [drugs['infusion'][rng.integers(len(drugs['infusion']))]]
+        switch_cycle = None
+        maintenance_cycle = None
+
+    addition = None
+    if len(drugs['additions']) > 0 and rng.random() < 0.1:
+        addition = (int(rng.integers(0, ncycles)), drugs['additions'][rng.integers(len(drugs['additions']))])
+
+    for cycle in range(ncycles):
+        cycle_drugs = list(regimen)
+        if switch_cycle is not None and cycle >= switch_cycle:
+            cycle_drugs[0] = substitute
+        if maintenance_cycle is not None and cycle >= maintenance_cycle:
+            cycle_drugs = cycle_drugs[1:]
+        if addition is not None and cycle >= addition[0]:
+            cycle_drugs.append(addition[1])
+        day = start + step * cycle
+        for drug in cycle_drugs:
+            days.append(day + (int(rng.integers(1, 3)) if rng.random() < 0.1 else 0))
+            names.append(drug)
+
+    ############# RETURN #############
+    return({'days' : days, 'names' : names, 'end' : max(days) + step})
+
+###############################################################################
+### Generate claims function                                                ###
+### function generates a synthetic cohort of claims: every patient has a    ###
+### number of records drawn from the records distribution, and lines of     ###
+### therapy one after the other, with gaps between lines and sometimes a    ###
+### treatment break longer than the discontinuation gap, until the patient  ###
+### has that number of records                                              ###
+### Inputs: 1) indication, 2) number of patients, 3) mean number of         ###
+###         records per patient, 4) distribution of the records per         ###
+###         patient, 5) random seed                                         ###
+### Outputs: claims dataframe sorted by PATIENT_ID and MED_START            ###
+###############################################################################
+
+def generate_claims(indication, npatients, mean_records = 20, distribution = 'lognormal', seed = 0):
+
+    rng = np.random.default_rng(seed)
+    drugs = get_reference_drugs(indication)
+    records = get_records_per_patient(rng, npatients, mean_records, distribution)
+
+    patient_ids = []
+    days = []
+    names = []
+
+    for i in range(npatients):
+        patient_days = []
+        patient_names = []
+        day = int(rng.integers(0, 2000))
+        while len(patient_days) < records[i]:
+            line = get_line_claims(rng, drugs, day)
+            patient_days.extend(line['days'])
+            patient_names.extend(line['names'])
+            # Gap to the next line, sometimes a treatment break
+            day = line['end'] + (int(rng.integers(90, 400)) if rng.random() < 0.15 else int(rng.integers(0, 60)))
+        patient_ids.append(np.full(records[i], 10000000 + i, dtype = np.int64))
+        days.append(np.asarray(patient_days[:records[i]], dtype = np.int64))
+        names.extend(patient_names[:records[i]])
+
+    med_start = np.datetime64('2015-01-01') + np.concatenate(days).astype('timedelta64[D]')
+    claims = pd.DataFrame({'PATIENT_ID' : np.concatenate(patient_ids),
+                           'MED_START' : med_start,
+                           'MED_END' : med_start,
+                           'MED_NAME' : names})
+    claims = claims.sort_values(['PATIENT_ID', 'MED_START'], kind = 'mergesort').reset_index(drop = True)
+    claims['MED_START'] = claims['MED_START'].dt.strftime('%Y-%m-%d')
+    claims['MED_END'] = claims['MED_END'].dt.strftime('%Y-%m-%d')
+
+    ############# RETURN #############
+    return(claims)
+
+
+
+def main():
+
+    # Usage: python rwToT_LoT_synthetic.py <INDICATION> <number of patients> <path> [<mean records per patient> [<distribution> [<seed>]]]
+    # The claims are written as parquet if the path ends in .parquet, and as csv otherwise
+    indication = sys.argv[1].upper()
+    npatients = int(sys.argv[2])
+    path = sys.argv[3]
+    mean_records = float(sys.argv[4]) if len(sys.argv) > 4 else 20
+    distribution = sys.argv[5] if len(sys.argv) > 5 else 'lognormal'
+    seed = int(sys.argv[6]) if len(sys.argv) > 6 else 0
+
+    storage_format = 'parquet' if path.endswith('.parquet') else 'csv'
+    rd.check_storage_format(storage_format)
+
+    claims = generate_claims(indication, npatients, mean_records, distribution, seed)
+    wd.write_claims(claims, path, storage_format)
+    print("Wrote", len(claims.index), "claims of", npatients, "patients to", path, flush = True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,368 @@
+# This is a script to write the output of the line of therapy algorithm
+
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+import rwToT_LoT_functions as fn
+import rwToT_LoT_read_data as rd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.compute as pc
+except ImportError:  # pyarrow is only needed for the parquet storage format
+    pa = None
+    pq = None
+    pc = None
+
+###############################################################################
+### Get output schemas function                                             ###
+### function returns the arrow schemas of the output tables: integer or    ###
+### text patient ids as in the claims, integer line numbers, dates without  ###
+### time, dictionary encoded names and boolean flags. The output of a       ###
+### parameter sweep starts with the columns of the parameters (see          ###
+### rwToT_LoT_functions.add_parameter_columns)                              ###
+### Inputs: 1) whether the output is the output of a parameter sweep,       ###
+###         2) arrow type of the patient ids, int64 if None                 ###
+### Outputs: dictionary with the schemas of output_lot and output_doses     ###
+###############################################################################
+
+def get_output_schemas(sweep = False, patient_id = None):
+
+    name = pa.dictionary(pa.int32(), pa.string())
+    patient_id = patient_id or pa.int64()
+
+    output_lot = pa.schema([('PATIENT_ID', patient_id),
+                            ('LINE_NUMBER', pa.int64()),
+                            ('LINE_NAME', name),
+                            ('START_DATE', pa.date32()),
+                            ('END_DATE', pa.date32()),
+                            ('LINE_TYPE', name),
+                            ('IS_MAINTENANCE', pa.bool_()),
+                            ('ADD_EXEMPTION', pa.bool_()),
+                            ('SUB_EXEMPTION', pa.bool_()),
+                            ('GAP_EXEMPTION', pa.bool_()),
+                            ('NAME_EXEMPTION', pa.bool_()),
+                            ('LINE_END_REASON', name),
+                            ('ENHANCED_COHORT', name),
+                            ('INDEX_DATE', pa.date32())])
+
+    output_doses = pa.schema([('PATIENT_ID', patient_id),
+                              ('MED_START', pa.date32()),
+                              ('MED_END', pa.date32()),
+                              ('MED_NAME', name),
+                              ('LINE_NUMBER', pa.int64()),
+                              ('LINE_NAME', name)])
+
+    if sweep:
+        parameters = [('R_WINDOW', pa.int64()),
+                      ('L_DISGAP', pa.int64()),
+                      ('DRUG_SWITCH_IGNORE', pa.bool_()),
+                      ('COMBO_DROPPED_LINE_ADVANCE', pa.bool_())]
+        output_lot = pa.schema(parameters + list(output_lot))
+        output_doses = pa.schema(parameters + list(output_doses))
+
+    ############# RETURN #############
+    return({'output_lot' : output_lot, 'output_doses' : output_doses})
+
+###############################################################################
+### To arrow table function                                                 ###
+### function converts a dataframe to an arrow table with the given schema   ###
+### Inputs: 1) dataframe, 2) arrow schema                                   ###
+### Outputs: arrow table                                                    ###
+###############################################################################
+
+def to_arrow_table(df, schema):
+
+    # Columns of an empty dataframe may not have a type that can be cast
+    if len(df.index) == 0:
+        return(schema.empty_table())
+
+    columns = [pa.array(df[field.name], from_pandas = True).cast(field.type) for field in schema]
+
+    ############# RETURN #############
+    return(pa.Table.from_arrays(columns, schema = schema))
+
+###############################################################################
+### Write csv function                                                      ###
+### function writes an output dataframe with compact types (see             ###
+### rwToT_LoT_functions.OutputAccumulator) to a csv file in the text layout ###
+### of the output: plain numbers and names, True/False flags and dates      ###
+### without time                                                            ###
+### Inputs: 1) dataframe, 2) path                                           ###
+### Outputs: None                                                           ###
+###############################################################################
+
+def write_csv(df, path):
+
+    df.to_csv(path, index = False, date_format = '%Y-%m-%d')
+
+###############################################################################
+### Write claims function                                                   ###
+### function writes claims data in the given storage format, e.g. to        ###
+### convert a csv claims file to parquet                                    ###
+### Inputs: 1) claims dataframe, 2) path, 3) storage format                 ###
+### Outputs: None                                                           ###
+###############################################################################
+
+def write_claims(df, path, storage_format = 'csv'):
+
+    rd.check_storage_format(storage_format)
+
+    if storage_format == 'parquet':
+        df = df.assign(MED_START = pd.to_datetime(df['MED_START']), MED_END = pd.to_datetime(df['MED_END']))
+        pq.write_table(to_arrow_table(df, rd.get_claims_schema(rd.get_patient_id_type(df['PATIENT_ID']))), path)
+    else:
+        df.to_csv(path, index = False)
+
+###############################################################################
+### Get part paths function                                                 ###
+### function returns the paths of the output part files written by one      ###
+### chunk of patients in the parts directory of the output                  ###
+### Inputs: 1) parts directory, 2) part number, 3) storage format           ###
+### Outputs: dictionary with the paths of the lot and doses part files,     ###
+###          their storage format and the part number                       ###
+###############################################################################
+
+def get_part_paths(part_dir, part, storage_format = 'csv'):
+
+    ############# RETURN #############
+    return({'output_lot' : os.path.join(part_dir, 'output_lot_' + str(part).zfill(5) + '.' + storage_format),
+            'output_doses' : os.path.join(part_dir, 'output_doses_' + str(part).zfill(5) + '.' + storage_format),
+            'storage_format' : storage_format,
+            'part' : part})
+
+###############################################################################
+### Write part function                                                     ###
+### function writes the output of one chunk of patients to its part files,  ###
+### so the output doesn't have to be sent back to the parent process        ###
+### Inputs: 1) output_lot, 2) output_doses, 3) part file paths              ###
+### Outputs: dictionary with the part number, the part file paths and       ###
+###          their numbers of rows                                          ###
+###############################################################################
+
+def write_part(output_lot, output_doses, part_paths):
+
+    if part_paths['storage_format'] == 'parquet':
+        sweep = 'R_WINDOW' in output_lot.columns
+        lot_schema = get_output_schemas(sweep, rd.get_patient_id_type(output_lot['PATIENT_ID']))['output_lot']
+        doses_schema = get_output_schemas(sweep, rd.get_patient_id_type(output_doses['PATIENT_ID']))['output_doses']
+        pq.write_table(to_arrow_table(output_lot, lot_schema), part_paths['output_lot'])
+        pq.write_table(to_arrow_table(output_doses, doses_schema), part_paths['output_doses'])
+    else:
+        write_csv(output_lot, part_paths['output_lot'])
+        write_csv(output_doses, part_paths['output_doses'])
+
+    ############# RETURN #############
+    return({'part' : part_paths['part'],
+            'output_lot' : part_paths['output_lot'],
+            'output_doses' : part_paths['output_doses'],
+            'lot_rows' : len(output_lot.index),
+            'doses_rows' : len(output_doses.index)})
+
+###############################################################################
+### Merge parts function                                                    ###
+### function concatenates part files into one file. Csv parts are copied    ###
+### block by block and only the header of the first part is kept, parquet   ###
+### parts are appended as row groups, so memory use doesn't depend on the   ###
+### size of the output. Without parts, an output without rows is written:  ###
+### the header of the output columns for csv, the schema for parquet        ###
+### Inputs: 1) list of part file paths, 2) path of the merged file,         ###
+###         3) storage format, 4) output name (output_lot or output_doses), ###
+###         5) sweep output (with the parameter columns)                    ###
+### Outputs: None                                                           ###
+###############################################################################
+
+def merge_parts(part_files, path, storage_format = 'csv', output = 'output_lot', sweep = False):
+
+    if storage_format == 'parquet':
+        if len(part_files) == 0:
+            pq.write_table(get_output_schemas(sweep)[output].empty_table(), path)
+            return
+        # A part without rows has int64 patient ids even when the ids are text, so the schema is taken from
+        # the first part with rows, and the parts without rows are left out
+        rows = [pq.read_metadata(part_file).num_rows for part_file in part_files]
+        part_files = [part_file for part_file, part_rows in zip(part_files, rows) if part_rows > 0] or part_files[:1]
+        writer = pq.ParquetWriter(path, pq.read_schema(part_files[0]))
+        for part_file in part_files:
+            writer.write_table(pq.read_table(part_file))
+        writer.close()
+        return
+
+    if len(part_files) == 0:
+        columns = {'output_lot' : fn.LOT_COLUMNS, 'output_doses' : fn.DOSES_COLUMNS}[output]
+        write_csv(pd.DataFrame(columns = (list(fn.SWEEP_COLUMNS) if sweep else []) + columns), path)
+        return
+
+    with open(path, 'w', newline = '') as merged:
+        for i, part_file in enumerate(part_files):
+            with open(part_file, 'r', newline = '') as part:
+                header = part.readline()
+                if i == 0:
+                    merged.write(header)
+                shutil.copyfileobj(part, merged)
+
+###############################################################################
+### Merge sorted batches function                                           ###
+### function merges streams of batches of rows, every stream sorted by      ###
+### patient, into batches sorted by patient. A patient may continue in the  ###
+### next batch of its stream, so only the rows before the smallest last     ###
+### patient of the streams still being read are complete and merged, and   ###
+### the stream with that last patient is read further. The batches are     ###
+### dataframes or arrow tables, handled by the given functions              ###
+### Inputs: 1) list of iterators of batches, 2) function returning the      ###
+###         patient ids of a batch as an array, 3) function concatenating  ###
+###         batches, 4) function taking the rows of a batch at positions    ###
+### Outputs: generator of batches sorted by patient                         ###
+###############################################################################
+
+def merge_sorted_batches(streams, get_patient_ids, concat, take):
+
+    buffers = [None] * len(streams)
+    is_open = [True] * len(streams)
+
+    def read(i):
+        batch = next(streams[i], None)
+        if batch is None:
+            is_open[i] = False
+        else:
+            buffers[i] = batch if buffers[i] is None else concat([buffers[i], batch])
+
+    while True:
+        for i in range(len(streams)):
+            while is_open[i] and (buffers[i] is None or len(get_patient_ids(buffers[i])) == 0):
+                read(i)
+        open_streams = [i for i in range(len(streams)) if is_open[i]]
+        if open_streams:
+            bound = min(get_patient_ids(buffers[i])[-1] for i in open_streams)
+
+        ready = []
+        ready_ids = []
+        for i in range(len(streams)):
+            if buffers[i] is None:
+                continue
+            patient_ids = get_patient_ids(buffers[i])
+            nready = np.searchsorted(patient_ids, bound, side = 'left') if open_streams else len(patient_ids)
+            if nready > 0:
+                ready.append(take(buffers[i], np.arange(nready)))
+                ready_ids.append(patient_ids[:nready])
+                buffers[i] = take(buffers[i], np.arange(nready, len(patient_ids)))
+        if ready:
+            yield take(concat(ready), np.argsort(np.concatenate(ready_ids), kind = 'stable'))
+
+        if not open_streams:
+            return
+        for i in open_streams:
+            if get_patient_ids(buffers[i])[-1] == bound:
+                read(i)
+
+###############################################################################
+### Merge sorted parts function                                             ###
+### function merges streams of part files into one file sorted by patient,  ###
+### where the part files of a stream follow each other in patient order,    ###
+### e.g. the parts of the patients processed by an incremental run and the  ###
+### part of the patients copied from the previous run. Every stream is read ###
+### batch_rows rows at a time (see merge_sorted_batches). Csv rows are read ###
+### as text and written back as they were                                   ###
+### Inputs: 1) list of streams, every stream a list of part file paths,     ###
+###         2) path of the merged file, 3) storage format, 4) whether the   ###
+###         patient ids are integers (csv), 5) number of rows read at a     ###
+###         time                                                            ###
+### Outputs: None                                                           ###
+###############################################################################
+
+def merge_sorted_parts(streams, path, storage_format = 'csv', integer_ids = True, batch_rows = 1000000):
+
+    part_files = [part_file for stream in streams for part_file in stream]
+
+    if storage_format == 'parquet':
+        # The schema is taken from the first part with rows (see merge_parts)
+        rows = [pq.read_metadata(part_file).num_rows for part_file in part_files]
+        schema = pq.read_schema(([part_file for part_file, part_rows in zip(part_files, rows) if part_rows > 0] or part_files)[0])
+
+        def read_stream(stream):
+            for part_file in stream:
+                for batch in pq.ParquetFile(part_file).iter_batches(batch_size = batch_rows):
+                    yield pa.Table.from_batches([batch]).cast(schema)
+
+        writer = pq.ParquetWriter(path, schema)
+        for batch in merge_sorted_batches([read_stream(stream) for stream in streams],
+                                          lambda table : table['PATIENT_ID'].to_numpy(),
+                                          pa.concat_tables,
+                                          lambda table, rows : table.take(rows)):
+            writer.write_table(batch)
+        writer.close()
+        return
+
+    def read_stream(stream):
+        for part_file in stream:
+            yield from pd.read_csv(part_file, dtype = str, keep_default_na = False, chunksize = batch_rows)
+
+    def get_patient_ids(df):
+        return df['PATIENT_ID'].astype(np.int64 if integer_ids else object).to_numpy()
+
+    with open(part_files[0], 'r', newline = '') as part, open(path, 'w', newline = '') as merged:
+        merged.write(part.readline())
+    for batch in merge_sorted_batches([read_stream(stream) for stream in streams],
+                                      get_patient_ids,
+                                      lambda batches : pd.concat(batches, ignore_index = True),
+                                      lambda df, rows : df.iloc[rows]):
+        batch.to_csv(path, mode = 'a', header = False, index = False)
+
+###############################################################################
+### Reset part directory function                                           ###
+### function creates an empty parts directory, removing the part files      ###
+### left over by a previous run                                             ###
+### Inputs: 1) parts directory                                              ###
+### Outputs: None                                                           ###
+###############################################################################
+
+def reset_part_dir(part_dir):
+
+    if os.path.exists(part_dir):
+        shutil.rmtree(part_dir)
+    os.makedirs(part_dir)
+
+###############################################################################
+### Copy patient rows function                                              ###
+### function copies the rows of the given patients from an output file of a ###
+### previous run to a part file, reading the output file in batches of      ###
+### batch_rows rows. Csv rows are copied as text, so they are written back  ###
+### exactly as they were                                                    ###
+### Inputs: 1) path of the output file, 2) path of the part file,           ###
+###         3) patient ids, 4) storage format, 5) number of rows read at    ###
+###         a time                                                          ###
+### Outputs: number of rows copied                                          ###
+###############################################################################
+
+def copy_patient_rows(source_path, part_path, patient_ids, storage_format = 'csv', batch_rows = 1000000):
+
+    rows = 0
+
+    if storage_format == 'parquet':
+        source = pq.ParquetFile(source_path)
+        is_patient = pa.array(pd.Series(patient_ids)).cast(source.schema_arrow.field('PATIENT_ID').type)
+        writer = pq.ParquetWriter(part_path, source.schema_arrow)
+        for batch in source.iter_batches(batch_size = batch_rows):
+            batch = batch.filter(pc.is_in(batch['PATIENT_ID'], value_set = is_patient))
+            writer.write_table(pa.Table.from_batches([batch], schema = source.schema_arrow))
+            rows = rows + batch.num_rows
+        writer.close()
+
+    else:
+        is_patient = set(pd.Series(patient_ids).astype(str))
+        header = True
+        for batch in pd.read_csv(source_path, dtype = str, keep_default_na = False, chunksize = batch_rows):
+            batch = batch[batch['PATIENT_ID'].isin(is_patient)]
+            batch.to_csv(part_path, mode = 'w' if header else 'a', header = header, index = False)
+            header = False
+            rows = rows + len(batch.index)
+        # An output file without rows still gives a part file with the header
+        if header:
+            with open(source_path, 'r', newline = '') as source, open(part_path, 'w', newline = '') as part:
+                part.write(source.readline())
+
+    ############# RETURN #############
+    return(rows)
@@ -0,0 +1,15 @@
+# The modules of the line of therapy algorithm are imported from the Python directory, and read the
+# reference files relative to it, so every test runs from there
+
+import os
+import sys
+
+import pytest
+
+PYTHON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PYTHON_DIR)
+
+
+@pytest.fixture(autouse = True)
+def python_dir(monkeypatch):
+    monkeypatch.chdir(PYTHON_DIR)
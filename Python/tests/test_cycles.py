@@ -0,0 +1,77 @@
+import os
+import glob
+import datetime
+
+import pandas as pd
+import pytest
+
+import rwToT_LoT_functions as fn
+import rwToT_LoT_read_data as rd
+import rwToT_LoT_synthetic as sy
+
+TEST_DATA = sorted(glob.glob(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', '*', 'Test', '*.csv')))
+
+
+def get_patient_cycles(data):
+
+    # The row by row cycle assignment process_chunk ran on every patient before get_cycles
+    data = data.copy()
+    for entry in data.index:
+        if entry == 0:
+            data.loc[entry, 'CYCLE'] = 1
+            data.loc[entry, 'CYCLE_START'] = data.loc[entry, 'MED_START']
+        else:
+            if data.loc[entry, 'MED_START'] - datetime.timedelta(days = 4) > data.loc[entry - 1, 'MED_START']:
+                data.loc[entry, 'CYCLE'] = data.loc[entry - 1, 'CYCLE'] + 1
+            else:
+                data.loc[entry, 'CYCLE'] = data.loc[entry - 1, 'CYCLE']
+    data['CYCLE_START'] = data.groupby('CYCLE')['MED_START'].transform("min")
+    data['CYCLE_END'] = data.groupby('CYCLE')['MED_END'].transform("max")
+    data['CYCLE_REGIMEN'] = data.groupby('CYCLE')['MED_NAME'].transform(lambda x: ', '.join(sorted(x.unique())))
+
+    for entry in data.index:
+        if data.loc[entry, 'CYCLE'] == 1:
+            data.loc[entry, 'PRIOR_CYCLE_REGIMEN'] = None
+            data.loc[entry, 'TWO_CYCLES'] = False
+        else:
+            current_cycle = data.loc[entry, 'CYCLE']
+            prior_cycle_index = data.index[data['CYCLE'] == current_cycle - 1].min()
+            prior_cycle_regimen = data.loc[prior_cycle_index, 'CYCLE_REGIMEN']
+            data.loc[entry, 'PRIOR_CYCLE_REGIMEN'] = prior_cycle_regimen
+            if (all(drug in prior_cycle_regimen for drug in data.loc[entry, 'CYCLE_REGIMEN'])
+                and all(drug in data.loc[entry, 'CYCLE_REGIMEN'] for drug in prior_cycle_regimen)):
+                data.loc[entry, 'TWO_CYCLES'] = True
+            else:
+                data.loc[entry, 'TWO_CYCLES'] = False
+    return data
+
+
+def get_regimens(values):
+    return [None if pd.isna(value) else value for value in values]
+
+
+def assert_same_cycles(claims):
+
+    patient_index = fn.get_patient_index(rd.normalize_claims(claims))
+    cycles = fn.get_cycles(patient_index['data'], cycle_gap = 4)
+
+    expected = pd.concat([get_patient_cycles(fn.get_patient_data(patient_index, i)) for i in range(len(patient_index['patient_id']))],
+                         ignore_index = True)
+
+    assert cycles['CYCLE'].tolist() == expected['CYCLE'].astype(int).tolist()
+    assert cycles['CYCLE_START'].tolist() == expected['CYCLE_START'].tolist()
+    assert cycles['CYCLE_END'].tolist() == expected['CYCLE_END'].tolist()
+    assert cycles['CYCLE_REGIMEN'].tolist() == expected['CYCLE_REGIMEN'].tolist()
+    assert get_regimens(cycles['PRIOR_CYCLE_REGIMEN']) == get_regimens(expected['PRIOR_CYCLE_REGIMEN'])
+    assert cycles['TWO_CYCLES'].tolist() == expected['TWO_CYCLES'].astype(bool).tolist()
+
+
+@pytest.mark.parametrize('path', TEST_DATA, ids = lambda path: path.split(os.sep)[-3])
+def test_cycles_of_test_data(path):
+    assert_same_cycles(pd.read_csv(path, encoding = 'utf-8-sig'))
+
+
+@pytest.mark.parametrize('indication', ['MCC', 'NSCLC'])
+@pytest.mark.parametrize('distribution', sy.RECORD_DISTRIBUTIONS)
+def test_cycles_of_synthetic_cohorts(indication, distribution):
+    assert_same_cycles(sy.generate_claims(indication, 40, 15, distribution, seed = 7))
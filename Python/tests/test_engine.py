@@ -0,0 +1,59 @@
+import pandas as pd
+import pytest
+
+import rwToT_LoT_read_data as rd
+import rwToT_LoT_engine as en
+import rwToT_LoT_main_parallel as mp
+import rwToT_LoT_process as pc
+import rwToT_LoT_synthetic as sy
+
+
+def concat_names(frames):
+    # The names are categories of every call, so only their text is compared
+    df = pd.concat(frames, ignore_index = True)
+    return df.astype({column : str for column in df.columns if isinstance(df[column].dtype, pd.CategoricalDtype) or df[column].dtype == 'str'})
+
+
+@pytest.fixture
+def claims():
+    return sy.generate_claims('MCC', 30, 15, 'lognormal', seed = 8)
+
+
+def test_engine_lines_equal_the_lines_of_a_chunk(claims):
+    # The batch script processes the claims as one chunk with the general parameters of par_general.csv
+    mp.init_process(['MCC'])
+    data = rd.normalize_claims(claims)
+    par_general = mp.cases['MCC'].par_general
+    chunk = pc.Input(r_window = int(par_general.loc[0, 'r_window']),
+                     l_disgap = int(par_general.loc[0, 'l_disgap']),
+                     drug_switch_ignore = bool(par_general.loc[0, 'drug_switch_ignore']),
+                     combo_dropped_line_advance = bool(par_general.loc[0, 'combo_dropped_line_advance']),
+                     indication = 'MCC', database = 'Test', filename = None, outfile = None,
+                     data = data, unique_patients = data['PATIENT_ID'].unique())
+    chunk_lot, chunk_doses = mp.process_chunk(chunk)
+
+    output_lot, output_doses = en.LineOfTherapyEngine('MCC').process_frame(claims)
+
+    pd.testing.assert_frame_equal(output_lot, chunk_lot)
+    pd.testing.assert_frame_equal(output_doses, chunk_doses)
+
+
+def test_engine_calls_give_the_same_lines(claims):
+    engine = en.LineOfTherapyEngine('MCC')
+    output_lot, output_doses = engine.process_frame(claims)
+    assert len(output_lot.index) > 0
+
+    # Batches of patients, and one patient at a time with the vocabulary and memo of the previous calls
+    batches = list(engine.iter_lines(claims, batch_patients = 7))
+    assert len(batches) == 5
+    patients = [engine.process_patient(patient_claims.to_dict('list')) for _, patient_claims in claims.groupby('PATIENT_ID')]
+    for outputs in [batches, patients]:
+        pd.testing.assert_frame_equal(concat_names([lot for lot, doses in outputs]), concat_names([output_lot]))
+        pd.testing.assert_frame_equal(concat_names([doses for lot, doses in outputs]), concat_names([output_doses]))
+
+    # Dates given as datetime64 or as text give the same lines
+    typed_lot, typed_doses = engine.process_frame(rd.normalize_claims(claims))
+    pd.testing.assert_frame_equal(typed_lot, output_lot)
+
+    with pytest.raises(ValueError, match = "one patient"):
+        engine.process_patient(claims)
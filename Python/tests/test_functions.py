@@ -0,0 +1,66 @@
+# Tests of rwToT_LoT_functions
+
+import pickle
+
+import numpy as np
+import pandas as pd
+
+import rwToT_LoT_functions as fn
+
+
+def test_check_combo_dropped_drugs_starts_the_next_line_after_the_first_dropped_drug():
+    drug_summary = pd.DataFrame({'MED_NAME' : ['carboplatin', 'docetaxel', 'pemetrexed'],
+                                 'DROPPED' : [1, 0, 1],
+                                 'LAST_SEEN' : pd.to_datetime(['2020-03-01', '2020-06-01', '2020-02-15'])})
+
+    result = fn.check_combo_dropped_drugs(drug_summary, pd.Timestamp('2020-06-01'), None, "Last row hit")
+
+    assert result['line_end_date'] == pd.Timestamp('2020-02-15')
+    assert result['line_next_start'] == pd.Timestamp('2020-02-16')
+    assert result['line_end_reason'] == "Combo drug dropped"
+
+
+def test_check_combo_dropped_drugs_keeps_the_line_without_dropped_drugs():
+    drug_summary = pd.DataFrame({'MED_NAME' : ['carboplatin', 'docetaxel'],
+                                 'DROPPED' : [0, 0],
+                                 'LAST_SEEN' : pd.to_datetime(['2020-03-01', '2020-06-01'])})
+
+    result = fn.check_combo_dropped_drugs(drug_summary, pd.Timestamp('2020-06-01'), pd.Timestamp('2020-07-01'), "Last row hit")
+
+    assert result == {'line_end_date' : pd.Timestamp('2020-06-01'),
+                      'line_next_start' : pd.Timestamp('2020-07-01'),
+                      'line_end_reason' : "Last row hit"}
+
+
+def test_regimen_flags_mark_the_substitutes_of_the_regimen():
+    rules = fn.compile_rules(pd.DataFrame({'original' : ['CISPLATIN', 'CARBOPLATIN', 'PACLITAXEL'],
+                                           'substitute' : ['CARBOPLATIN', 'CISPLATIN', 'NAB-PACLITAXEL']}),
+                             pd.DataFrame({'drug_name' : []}),
+                             pd.DataFrame({'drug_name' : [], 'maintenance_type' : []}),
+                             pd.DataFrame({'drug_name' : []}),
+                             pd.DataFrame({'treatment' : []}))
+    vocabulary = fn.get_drug_vocabulary(pd.Series(['cisplatin', 'pemetrexed'] + ['drug ' + str(i) for i in range(3000)]), rules)
+    code = {name : i for i, name in enumerate(vocabulary['names'])}
+
+    flags = fn.get_regimen_flags(np.array([code['cisplatin'], code['paclitaxel'], code['pemetrexed']]), vocabulary)
+
+    assert set(vocabulary['names'][flags['is_substitution']]) == {'carboplatin', 'nab-paclitaxel'}
+    assert set(vocabulary['names'][flags['in_regimen']]) == {'cisplatin', 'paclitaxel', 'pemetrexed'}
+    # The substitutions are kept by drug, not as a drugs by drugs matrix
+    assert len(pickle.dumps(vocabulary)) < 1000000
+
+
+def test_patient_index_keeps_the_order_of_same_day_rows():
+    # Two patients with 3 drugs a day in a different order every day, days given latest first
+    days = pd.date_range('2020-01-01', periods = 30, freq = '7D')[::-1]
+    drugs = ['carboplatin', 'paclitaxel', 'pembrolizumab']
+    rows = [(patient, day, drugs[(d + k) % 3]) for d, day in enumerate(days) for patient in [2, 1] for k in range(3)]
+    claims = pd.DataFrame(rows, columns = ['PATIENT_ID', 'MED_START', 'MED_NAME'])
+
+    patient_index = fn.get_patient_index(claims)
+
+    assert patient_index['patient_id'].tolist() == [1, 2]
+    for i, patient_id in enumerate(patient_index['patient_id']):
+        # Days in date order, and the drugs of a day in the order of the claims
+        expected = pd.concat([day_rows for _, day_rows in claims[claims['PATIENT_ID'] == patient_id].groupby('MED_START')])
+        assert fn.get_patient_data(patient_index, i)['MED_NAME'].tolist() == expected['MED_NAME'].tolist()
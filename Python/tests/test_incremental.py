@@ -0,0 +1,60 @@
+import os
+import shutil
+import multiprocessing
+
+import pandas as pd
+import pytest
+
+import rwToT_LoT_main_parallel as mp
+import rwToT_LoT_synthetic as sy
+
+PYTHON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def pool(tmp_path, monkeypatch):
+    # The processes of the pool work in the directory of the test run, with the reference files of the algorithm
+    monkeypatch.chdir(tmp_path)
+    shutil.copytree(os.path.join(PYTHON_DIR, 'reference'), 'reference')
+    mp.init_process(['MCC'])
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(2, initializer = mp.init_process, initargs = (['MCC'], False, None, None, mp.MEMO_SIZE, mp.LINE_ENGINE)) as pool:
+        yield pool
+
+
+def run(pool, outfile):
+    job = mp.get_jobs(['rwToT_LoT_main_parallel.py', 'MCC'])[0]
+    job['outfile'] = outfile
+    mp.run_job(pool, job)
+    return 'output/MCC/' + outfile + '/'
+
+
+@pytest.mark.parametrize('output_format', ['csv', 'parquet'])
+def test_incremental_run_equals_full_run(monkeypatch, pool, output_format):
+    if output_format == 'parquet':
+        pytest.importorskip('pyarrow')
+    os.makedirs('data/MCC/Test')
+    monkeypatch.setattr(mp, 'OUTPUT_FORMAT', output_format)
+    monkeypatch.setattr(mp, 'nchunks', 4)
+
+    claims = sy.generate_claims('MCC', 60, 10, 'poisson', seed = 3)
+    claims.to_csv('data/MCC/Test/example_input.csv', index = False)
+    monkeypatch.setattr(mp, 'INCREMENTAL', True)
+    run(pool, 'Test')
+
+    # A patient in the middle of the id range changes drug
+    patient_ids = claims['PATIENT_ID'].unique()
+    changed = claims['PATIENT_ID'] == patient_ids[len(patient_ids) // 2]
+    claims.loc[changed, 'MED_NAME'] = 'pembrolizumab'
+    claims.to_csv('data/MCC/Test/example_input.csv', index = False)
+    incremental = run(pool, 'Test')
+
+    monkeypatch.setattr(mp, 'INCREMENTAL', False)
+    full = run(pool, 'Full')
+
+    for output in ['output_lot', 'output_doses']:
+        if output_format == 'csv':
+            with open(incremental + output + '.csv', 'rb') as incremental_file, open(full + output + '.csv', 'rb') as full_file:
+                assert incremental_file.read() == full_file.read()
+        else:
+            pd.testing.assert_frame_equal(pd.read_parquet(incremental + output + '.parquet'), pd.read_parquet(full + output + '.parquet'))
@@ -0,0 +1,50 @@
+import os
+import glob
+
+import pandas as pd
+import pytest
+
+import rwToT_LoT_read_param as rp
+import rwToT_LoT_engine as en
+import rwToT_LoT_synthetic as sy
+
+PYTHON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_DATA = sorted(glob.glob(os.path.join(PYTHON_DIR, 'data', '*', 'Test', '*.csv')))
+
+# Only MCC has the special cases files read by rwToT_LoT_read_param, so the claims of every indication
+# are run with the special cases of MCC
+CASES = rp.cases('MCC', os.path.join(PYTHON_DIR, 'reference'))
+
+
+def assert_same_lines(claims, drug_switch_ignore = None, combo_dropped_line_advance = None):
+
+    # Without the memo, every patient goes through the first pass line scan of the engine
+    outputs = {}
+    for line_engine in ['numpy', 'pandas']:
+        engine = en.LineOfTherapyEngine(cases = CASES, line_engine = line_engine, memo_size = 0,
+                                        drug_switch_ignore = drug_switch_ignore,
+                                        combo_dropped_line_advance = combo_dropped_line_advance)
+        outputs[line_engine] = engine.process_frame(claims)
+
+    output_lot, output_doses = outputs['numpy']
+    pandas_lot, pandas_doses = outputs['pandas']
+    assert len(output_lot.index) > 0
+    pd.testing.assert_frame_equal(output_lot, pandas_lot)
+    pd.testing.assert_frame_equal(output_doses, pandas_doses)
+
+
+@pytest.mark.parametrize('path', TEST_DATA, ids = lambda path: path.split(os.sep)[-3])
+def test_line_engines_on_test_data(path):
+    assert_same_lines(pd.read_csv(path, encoding = 'utf-8-sig'))
+
+
+@pytest.mark.parametrize('indication', ['MCC', 'NSCLC'])
+@pytest.mark.parametrize('distribution', sy.RECORD_DISTRIBUTIONS)
+def test_line_engines_on_synthetic_cohorts(indication, distribution):
+    assert_same_lines(sy.generate_claims(indication, 40, 15, distribution, seed = 11))
+
+
+@pytest.mark.parametrize('drug_switch_ignore', [False, True])
+@pytest.mark.parametrize('combo_dropped_line_advance', [False, True])
+def test_line_engines_with_general_parameters(drug_switch_ignore, combo_dropped_line_advance):
+    assert_same_lines(sy.generate_claims('NSCLC', 40, 15, 'lognormal', seed = 12), drug_switch_ignore, combo_dropped_line_advance)
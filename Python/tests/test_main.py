@@ -0,0 +1,27 @@
+import os
+import sys
+import shutil
+
+import pandas as pd
+
+import rwToT_LoT_main as main
+
+PYTHON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_main_on_test_data(tmp_path, monkeypatch):
+    # The script runs in a directory with the reference files and the Test database of MCC
+    monkeypatch.chdir(tmp_path)
+    shutil.copytree(os.path.join(PYTHON_DIR, 'reference'), 'reference')
+    shutil.copytree(os.path.join(PYTHON_DIR, 'data', 'MCC', 'Test'), os.path.join('data', 'MCC', 'Test'))
+    monkeypatch.setattr(sys, 'argv', ['rwToT_LoT_main.py', 'MCC'])
+
+    main.main()
+
+    processed_input = pd.read_csv('output/MCC/Test/processed_input_test.csv')
+    output_lot = pd.read_csv('output/MCC/Test/output_lot_test.csv')
+    output_doses = pd.read_csv('output/MCC/Test/output_doses_test.csv')
+    assert sorted(output_lot['PATIENT_ID'].unique()) == sorted(processed_input['PATIENT_ID'].unique())
+    assert (output_lot.groupby('PATIENT_ID')['LINE_NUMBER'].min() == 1).all()
+    # Every claim is a dose of one line
+    assert len(output_doses.index) == len(processed_input.index)
@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import rwToT_LoT_functions as fn
+import rwToT_LoT_read_data as rd
+import rwToT_LoT_engine as en
+import rwToT_LoT_main_parallel as mp
+import rwToT_LoT_process as pc
+import rwToT_LoT_synthetic as sy
+
+PARAMETER_SETS = [{'r_window' : 28, 'l_disgap' : 60, 'drug_switch_ignore' : False, 'combo_dropped_line_advance' : False},
+                  {'r_window' : 21, 'l_disgap' : 90, 'drug_switch_ignore' : True, 'combo_dropped_line_advance' : True}]
+
+
+def get_duplicates(claims, seed = 0):
+    # Every patient again, with a new patient id and all its dates shifted by the same number of days
+    rng = np.random.default_rng(seed)
+    patient_ids = claims['PATIENT_ID'].unique()
+    shifts = pd.Series(rng.integers(1, 2000, len(patient_ids)), index = patient_ids)
+    days = pd.to_timedelta(claims['PATIENT_ID'].map(shifts), unit = 'D')
+    return pd.DataFrame({'PATIENT_ID' : claims['PATIENT_ID'] + 1000000,
+                         'MED_START' : claims['MED_START'] + days,
+                         'MED_END' : claims['MED_END'] + days,
+                         'MED_NAME' : claims['MED_NAME']})
+
+
+@pytest.mark.parametrize('line_engine', ['numpy', 'pandas'])
+def test_memo_gives_the_lines_of_the_scan(line_engine):
+    claims = rd.normalize_claims(sy.generate_claims('MCC', 40, 15, 'lognormal', seed = 5))
+    claims = pd.concat([claims, get_duplicates(claims)], ignore_index = True)
+
+    outputs = {}
+    for memo_size in [0, 10000]:
+        engine = en.LineOfTherapyEngine('MCC', line_engine = line_engine, memo_size = memo_size)
+        outputs[memo_size] = engine.process_frame(claims)
+
+    # Every duplicate has the history of its patient
+    assert engine.memo.hits >= 40
+    for output, memo_output in zip(outputs[0], outputs[10000]):
+        pd.testing.assert_frame_equal(output, memo_output)
+
+
+def test_memo_is_kept_across_the_chunks_of_a_sweep(monkeypatch):
+    mp.init_process(['MCC'])
+    claims = rd.normalize_claims(sy.generate_claims('MCC', 30, 15, 'poisson', seed = 6))
+    chunks = [claims, get_duplicates(claims)]
+    vocabulary = fn.get_drug_vocabulary(pd.concat(chunks)['MED_NAME'], mp.cases['MCC'].rules)
+
+    def get_chunk(data):
+        chunk = pc.Input(r_window = 28, l_disgap = 60, drug_switch_ignore = False, combo_dropped_line_advance = False,
+                         indication = 'MCC', database = 'Test', filename = None, outfile = None,
+                         data = data.assign(DRUG_CODE = fn.encode_drug_names(data['MED_NAME'], vocabulary)),
+                         unique_patients = data['PATIENT_ID'].unique())
+        chunk.vocabulary = vocabulary
+        chunk.parameter_sets = PARAMETER_SETS
+        return chunk
+
+    outputs = {}
+    for memo_size in [0, 10000]:
+        monkeypatch.setattr(mp, 'memo_size', memo_size)
+        monkeypatch.setattr(mp, 'memo', None)
+        outputs[memo_size] = [mp.process_chunk(get_chunk(data)) for data in chunks]
+        if memo_size > 0:
+            # The second chunk only has duplicates of the patients of the first one, for both parameter sets
+            assert mp.memo.hits == 2 * claims['PATIENT_ID'].nunique()
+
+    for output, memo_output in zip(outputs[0], outputs[10000]):
+        pd.testing.assert_frame_equal(output[0], memo_output[0])
+        pd.testing.assert_frame_equal(output[1], memo_output[1])
@@ -0,0 +1,65 @@
+import sqlite3
+
+import pandas as pd
+import pytest
+
+import rwToT_LoT_read_data as rd
+
+CLAIMS = pd.DataFrame({'patient_id' : [1, 1, 2, 2, 2, 3],
+                       'med_start' : ['2020-01-01', '2020-01-22', '2020-02-01', '2020-02-22', '2020-03-14', '2020-04-01'],
+                       'med_end' : ['2020-01-01', '2020-01-22', '2020-02-01', '2020-02-22', '2020-03-14', '2020-04-01'],
+                       'med_name' : ['cisplatin', 'cisplatin', 'avelumab', 'avelumab', 'avelumab', 'carboplatin']})
+
+QUERY = "SELECT patient_id, med_start, med_end, med_name FROM claims ORDER BY patient_id, med_start"
+
+
+@pytest.fixture
+def claims_url(tmp_path):
+    pytest.importorskip('sqlalchemy')
+    path = tmp_path / 'claims.db'
+    with sqlite3.connect(str(path)) as connection:
+        CLAIMS.to_sql('claims', connection, index = False)
+    return 'sqlite:///' + str(path)
+
+
+def test_read_sql_claims_upper_cases_columns(claims_url):
+    claims = rd.read_sql_claims(claims_url, QUERY)
+
+    assert list(claims.columns) == rd.CLAIMS_COLUMNS
+    assert claims['PATIENT_ID'].tolist() == CLAIMS['patient_id'].tolist()
+
+
+def test_read_sql_batches_keeps_patients_whole(claims_url):
+    # With 4 rows a read, patient 2 is split between the first and second read
+    batches = list(rd.read_sql_batches(claims_url, QUERY, 4))
+
+    assert all(list(batch.columns) == rd.CLAIMS_COLUMNS for batch in batches)
+    assert [batch['PATIENT_ID'].unique().tolist() for batch in batches] == [[1], [2], [3]]
+    assert pd.concat(batches, ignore_index = True)['MED_START'].tolist() == CLAIMS['med_start'].tolist()
+
+
+def test_read_sql_batches_empty_result(claims_url):
+    assert list(rd.read_sql_batches(claims_url, "SELECT * FROM claims WHERE patient_id < 0", 4)) == []
+
+
+def test_read_sql_batches_unordered_query(claims_url):
+    with pytest.raises(ValueError, match = "must be sorted by PATIENT_ID"):
+        list(rd.read_sql_batches(claims_url, "SELECT * FROM claims ORDER BY patient_id DESC", 4))
+
+
+@pytest.mark.parametrize('dates, date_format', [(['2020-01-01', '2020-02-03'], '%Y-%m-%d'),
+                                                (['4/19/18', '12/1/18'], '%m/%d/%y'),
+                                                (['2020-01-01 00:00:00', '2020-02-03 00:00:00'], '%Y-%m-%d %H:%M:%S'),
+                                                (['2020-01-01T00:00:00', '2020-02-03T00:00:00'], 'ISO8601')])
+def test_detect_date_format(dates, date_format):
+    assert rd.detect_date_format(pd.Series(dates)) == date_format
+
+
+def test_normalize_claims_with_time_part():
+    claims = CLAIMS.rename(columns = str.upper)
+    claims['MED_START'] = claims['MED_START'] + ' 00:00:00'
+    claims['MED_END'] = claims['MED_END'] + ' 00:00:00'
+
+    normalized = rd.normalize_claims(claims)
+
+    assert normalized['MED_START'].tolist() == pd.to_datetime(CLAIMS['med_start']).tolist()
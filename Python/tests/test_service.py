@@ -0,0 +1,56 @@
+import json
+import threading
+import http.client
+
+import pandas as pd
+import pytest
+
+import rwToT_LoT_service as sv
+
+
+@pytest.fixture
+def service():
+    # The service processes the requests in the test process, on a free local port
+    server = sv.start_service(['MCC'], nworkers = 0, port = 0, quiet = True)
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+    sv.stop_service(server)
+
+
+def request(server, method, path, body = None):
+    connection = http.client.HTTPConnection(sv.HOST, server.server_address[1], timeout = 60)
+    try:
+        connection.request(method, path, json.dumps(body) if body is not None else None, {'Content-Type' : 'application/json'})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def test_service_lines_health_and_metrics(service):
+    claims = pd.read_csv('data/MCC/Test/example_input.csv', encoding = 'utf-8-sig')
+
+    assert request(service, 'GET', '/health') == (200, {'status' : 'ok'})
+
+    status, result = request(service, 'POST', '/lines', {'indication' : 'mcc', 'claims' : claims.to_dict('records')})
+    assert status == 200
+    assert result['patients'] == claims['PATIENT_ID'].nunique()
+    assert result['rows'] == len(claims.index)
+    assert len(result['output_lot']) > 0
+    assert {line['PATIENT_ID'] for line in result['output_lot']} == set(claims['PATIENT_ID'])
+
+    # An empty batch has no lines
+    status, result = request(service, 'POST', '/lines', {'indication' : 'MCC', 'claims' : []})
+    assert status == 200
+    assert (result['output_lot'], result['output_doses'], result['patients'], result['rows']) == ([], [], 0, 0)
+
+    status, result = request(service, 'POST', '/lines', {'indication' : 'NSCLC', 'claims' : []})
+    assert status == 400
+
+    status, metrics = request(service, 'GET', '/metrics')
+    assert status == 200
+    assert (metrics['requests'], metrics['errors'], metrics['rows'], metrics['in_flight']) == (3, 1, len(claims.index), 0)
+    assert metrics['indications'] == ['MCC']
@@ -0,0 +1,44 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+
+import rwToT_LoT_functions as fn
+import rwToT_LoT_read_data as rd
+import rwToT_LoT_read_param as rp
+import rwToT_LoT_shared_data as sd
+import rwToT_LoT_main_parallel as mp
+import rwToT_LoT_process as pc
+
+
+def get_input(nnames):
+    cases = rp.cases('MCC')
+    data = rd.normalize_claims(pd.read_csv('data/MCC/Test/example_input.csv'))
+    input = pc.Input(r_window = 28, l_disgap = 180, drug_switch_ignore = False, combo_dropped_line_advance = False,
+                     indication = 'MCC', database = 'Test', filename = 'example_input.csv', outfile = 'Test',
+                     data = data, unique_patients = data['PATIENT_ID'].unique())
+    # A large vocabulary, as in claims extracts with thousands of distinct drug names
+    drug_names = pd.concat([data['MED_NAME'], pd.Series(['drug ' + str(i) for i in range(nnames)])])
+    input.vocabulary = fn.get_drug_vocabulary(drug_names, cases.rules)
+    input.data['DRUG_CODE'] = fn.encode_drug_names(input.data['MED_NAME'], input.vocabulary)
+    return input
+
+
+def test_chunks_read_the_vocabulary_from_shared_memory():
+    input = get_input(8000)
+    shared = sd.share_claims(input.data, input.vocabulary)
+    try:
+        chunks = [mp.get_chunk_input(input, {}, sd.get_shared_chunk(shared, start, stop)) for start, stop in [(0, 40), (40, len(input.data.index))]]
+
+        # The tasks sent to the processes don't hold the vocabulary
+        assert all(len(pickle.dumps(chunk)) < 10000 for chunk in chunks)
+
+        sd.vocabulary_cache['name'] = None
+        vocabulary = sd.attach_vocabulary(chunks[0].shared_chunk)
+        assert np.array_equal(vocabulary['names'], input.vocabulary['names'])
+        assert sd.attach_vocabulary(chunks[1].shared_chunk) is vocabulary
+
+        data = pd.concat([sd.attach_claims(chunk.shared_chunk, vocabulary) for chunk in chunks], ignore_index = True)
+        pd.testing.assert_frame_equal(data, input.data[data.columns], check_dtype = False)
+    finally:
+        sd.release_claims(shared)
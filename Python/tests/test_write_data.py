@@ -0,0 +1,92 @@
+import pandas as pd
+import pytest
+
+import rwToT_LoT_functions as fn
+import rwToT_LoT_read_data as rd
+import rwToT_LoT_write_data as wd
+import rwToT_LoT_engine as en
+
+
+@pytest.mark.parametrize('output', ['output_lot', 'output_doses'])
+@pytest.mark.parametrize('sweep', [False, True])
+def test_merge_no_parquet_parts_writes_empty_output(tmp_path, output, sweep):
+    pq = pytest.importorskip('pyarrow.parquet')
+    path = str(tmp_path / (output + '.parquet'))
+
+    wd.merge_parts([], path, 'parquet', output, sweep)
+
+    table = pq.read_table(path)
+    assert table.num_rows == 0
+    assert table.schema == wd.get_output_schemas(sweep)[output]
+
+
+@pytest.mark.parametrize('output', ['output_lot', 'output_doses'])
+@pytest.mark.parametrize('sweep', [False, True])
+def test_merge_no_csv_parts_writes_header(tmp_path, output, sweep):
+    path = tmp_path / (output + '.csv')
+
+    wd.merge_parts([], str(path), 'csv', output, sweep)
+
+    merged = pd.read_csv(path)
+    assert len(merged.index) == 0
+    columns = {'output_lot' : fn.LOT_COLUMNS, 'output_doses' : fn.DOSES_COLUMNS}[output]
+    assert list(merged.columns) == (list(fn.SWEEP_COLUMNS) if sweep else []) + columns
+
+
+def test_merge_csv_parts_keeps_one_header(tmp_path):
+    parts = []
+    for i, rows in enumerate([["1,a"], ["2,b", "3,c"]]):
+        part = tmp_path / ('part_' + str(i) + '.csv')
+        part.write_text("PATIENT_ID,LINE_NAME\n" + "\n".join(rows) + "\n")
+        parts.append(str(part))
+    path = tmp_path / 'output_lot.csv'
+
+    wd.merge_parts(parts, str(path), 'csv')
+
+    assert path.read_text() == "PATIENT_ID,LINE_NAME\n1,a\n2,b\n3,c\n"
+
+
+def test_parquet_text_patient_ids(tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    claims = pd.read_csv('data/MCC/Test/example_input.csv')
+    claims['PATIENT_ID'] = 'P' + claims['PATIENT_ID'].astype(str)
+
+    # Claims with text ids are written and read back with string ids
+    claims_path = str(tmp_path / 'claims.parquet')
+    wd.write_claims(claims, claims_path, 'parquet')
+    assert rd.read_claims(claims_path, 'parquet')['PATIENT_ID'].tolist() == claims['PATIENT_ID'].tolist()
+
+    # The output parts are written with string ids, and a part without rows doesn't change the merged schema
+    output_lot, output_doses = en.LineOfTherapyEngine('MCC').process_frame(claims)
+    empty_lot, empty_doses = fn.OutputAccumulator().to_frames()
+    parts = [wd.write_part(output_lot, output_doses, wd.get_part_paths(str(tmp_path), 0, 'parquet')),
+             wd.write_part(empty_lot, empty_doses, wd.get_part_paths(str(tmp_path), 1, 'parquet'))]
+    path = str(tmp_path / 'output_lot.parquet')
+    wd.merge_parts([part['output_lot'] for part in parts], path, 'parquet')
+
+    merged = pq.read_table(path)
+    assert merged.schema.field('PATIENT_ID').type == 'string'
+    assert merged.column('PATIENT_ID').to_pylist() == output_lot['PATIENT_ID'].tolist()
+
+    # The rows of some patients are copied from a previous output with string ids
+    copied = str(tmp_path / 'copied.parquet')
+    patients = output_lot['PATIENT_ID'].unique()[:2]
+    rows = wd.copy_patient_rows(path, copied, patients, 'parquet')
+    assert rows == output_lot['PATIENT_ID'].isin(patients).sum()
+
+
+@pytest.mark.parametrize('batch_rows', [1, 2, 100])
+def test_merge_sorted_csv_parts(tmp_path, batch_rows):
+    # Every stream is sorted by patient, and patient 3 has rows in two parts of the first stream
+    streams = []
+    for s, stream in enumerate([[["1,a", "3,b"], ["3,c", "10,d"]], [["2,e", "2,f", "4,g"], ["11,h"]]]):
+        streams.append([])
+        for i, rows in enumerate(stream):
+            part = tmp_path / ('part_' + str(s) + '_' + str(i) + '.csv')
+            part.write_text("PATIENT_ID,LINE_NAME\n" + "\n".join(rows) + "\n")
+            streams[-1].append(str(part))
+    path = tmp_path / 'output_lot.csv'
+
+    wd.merge_sorted_parts(streams, str(path), 'csv', True, batch_rows)
+
+    assert path.read_text() == "PATIENT_ID,LINE_NAME\n1,a\n2,e\n2,f\n3,b\n3,c\n4,g\n10,d\n11,h\n"